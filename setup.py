@@ -16,6 +16,9 @@ setup(
     package_dir={"": "src"},
     python_requires=">=3.12",
     install_requires=requirements,
+    # Optional backends, which raise an ImportError naming the package when
+    # selected without it.
+    extras_require={"faiss": ["faiss-cpu"], "redis": ["redis"]},
     classifiers=[
         "Natural Language :: English",
         "Intended Audience :: Developers",
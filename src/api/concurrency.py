@@ -0,0 +1,361 @@
+import asyncio
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Generator, Iterator, Optional, TypeVar
+
+from loguru import logger
+
+MAX_CONCURRENT_QUERIES = 16
+MAX_QUEUED_QUERIES = 64
+QUEUE_TIMEOUT = 30.0
+QUERY_WORKERS = 8
+MAX_PENDING_JOBS = 256
+BATCH_WORKERS = 2
+MAX_PENDING_BATCHES = 16
+# Weight of the latest query in the running average of query time, which
+# the Retry-After estimates are based on.
+LATENCY_SMOOTHING = 0.1
+
+T = TypeVar("T")
+
+
+class Overloaded(Exception):
+    """
+    Raised when a query is turned away, with the seconds after which a
+    retry is likely to be admitted and the HTTP status to answer with: 429
+    when the queue is full, 503 when the query waited too long in it.
+    """
+
+    def __init__(self, status_code: int, retry_after: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+@dataclass
+class LimiterStats:
+    admitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    running: int = 0
+    queued: int = 0
+    average_seconds: float = 0.0
+
+
+class QueryLimiter:
+    """
+    Runs blocking queries from async endpoints on a dedicated thread pool of
+    `max_concurrency` threads, so the event loop and the default threadpool
+    stay free, and at most that many queries call Bedrock and DynamoDB at
+    once. Up to `max_queue` more queries wait for a thread; further queries
+    are rejected at once rather than queued without limit, and queries
+    that wait longer than `queue_timeout` seconds give up. Under a burst,
+    admitted queries keep a steady latency and the excess is told when to
+    retry. Background work on threads of its own takes places with `slot`.
+
+    Args:
+        max_concurrency (int): Queries run at once.
+        max_queue (int): Queries waiting for a thread before new ones are
+            rejected.
+        queue_timeout (float): Seconds a query waits for a thread.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENT_QUERIES,
+        max_queue: int = MAX_QUEUED_QUERIES,
+        queue_timeout: float = QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.stats = LimiterStats()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="query"
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # The loop the limiter is created on, which `slot` waits on from
+        # other threads.
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+    def retry_after(self) -> int:
+        """
+        Returns the seconds until the queries queued now have likely run.
+        """
+
+        waiting = self.stats.queued + self.stats.running
+        seconds = self.stats.average_seconds * waiting / self.max_concurrency
+        return max(1, math.ceil(seconds))
+
+    async def acquire(self):
+        """
+        Waits for a free query thread and takes it, or raises `Overloaded`
+        if the query cannot be admitted. The thread must be given back with
+        `release`.
+        """
+
+        stats = self.stats
+        if stats.queued >= self.max_queue and self._slots.locked():
+            stats.rejected += 1
+            raise Overloaded(429, self.retry_after(), "Too many queries queued")
+        stats.queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            stats.timed_out += 1
+            raise Overloaded(
+                503, self.retry_after(), "Timed out waiting for a query slot"
+            )
+        finally:
+            stats.queued -= 1
+        stats.admitted += 1
+        stats.running += 1
+
+    def release(self, seconds: Optional[float] = None):
+        """
+        Gives back a query thread, with the time the query took, or None if
+        it failed.
+        """
+
+        stats = self.stats
+        stats.running -= 1
+        self._slots.release()
+        if seconds is None:
+            stats.failed += 1
+            return
+        stats.completed += 1
+        if stats.completed == 1:
+            stats.average_seconds = seconds
+        else:
+            stats.average_seconds += LATENCY_SMOOTHING * (
+                seconds - stats.average_seconds
+            )
+
+    async def _take_slot(self):
+        await self._slots.acquire()
+        self.stats.admitted += 1
+        self.stats.running += 1
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Holds one of the `max_concurrency` places from a thread outside the
+        event loop, so background work, such as query batches, counts
+        against the same limit as the queries of requests. It waits for a
+        place as long as it takes and is not counted as queued, so it never
+        causes a request to be rejected. The limiter must have been created
+        on a running event loop.
+        """
+
+        asyncio.run_coroutine_threadsafe(self._take_slot(), self._loop).result()
+        started = time.perf_counter()
+        seconds = None
+        try:
+            yield
+            seconds = time.perf_counter() - started
+        finally:
+            self._loop.call_soon_threadsafe(self.release, seconds)
+
+    def _release_when_done(self, future: asyncio.Future, started: float):
+        def done(future: asyncio.Future):
+            failed = future.cancelled() or future.exception() is not None
+            self.release(None if failed else time.perf_counter() - started)
+
+        future.add_done_callback(done)
+
+    async def run(self, function: Callable[..., T], *args) -> T:
+        """
+        Runs `function(*args)` on the query pool once a thread is free, and
+        raises `Overloaded` if the query cannot be admitted.
+        """
+
+        await self.acquire()
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+        self._release_when_done(future, started)
+        # A request cancelled by its client leaves the query running, and
+        # its thread taken, until it is done.
+        return await asyncio.shield(future)
+
+    async def iterate(
+        self, iterator: Generator[T, None, None], slot: "StreamSlot"
+    ) -> AsyncIterator[T]:
+        """
+        Yields the items of a blocking generator, which must not yield None,
+        each produced on the query thread `slot` taken by `acquire`, and
+        releases the thread at the end.
+        """
+
+        if not slot.take():
+            # The slot was given back before the stream started.
+            iterator.close()
+            return
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        future = None
+        try:
+            while True:
+                future = loop.run_in_executor(self.executor, next, iterator, None)
+                item = await asyncio.shield(future)
+                if item is None:
+                    break
+                yield item
+            future = None
+        finally:
+            if future is None:
+                self.release(time.perf_counter() - started)
+            else:
+                # The stream was abandoned: the iterator is closed once the
+                # item it is producing is done.
+                future.add_done_callback(
+                    lambda _future: self.executor.submit(iterator.close)
+                )
+                self._release_when_done(future, started)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class StreamSlot:
+    """
+    The query thread taken with `QueryLimiter.acquire` for a stream. Once
+    the stream has started, `QueryLimiter.iterate` gives it back; if it
+    never starts, for instance because the client disconnected before the
+    response body was sent, `release_unused` does. It is given back once
+    either way.
+    """
+
+    def __init__(self, limiter: QueryLimiter):
+        self.limiter = limiter
+        self.taken = False
+
+    def take(self) -> bool:
+        if self.taken:
+            return False
+        self.taken = True
+        return True
+
+    def release_unused(self):
+        if self.take():
+            self.limiter.release()
+
+
+@dataclass
+class WorkerStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    pending: int = 0
+    average_seconds: float = 0.0
+
+
+class BackgroundWorkers:
+    """
+    Runs jobs on `workers` threads of their own, so they do not hold a
+    request open, and the number of workers is set apart from the request
+    limits. At most `max_pending` jobs wait for a worker: a place must be
+    taken with `reserve` before a job is submitted, so a job is turned away
+    before anything is written for it.
+
+    Args:
+        workers (int): Jobs run at once.
+        max_pending (int): Jobs waiting for a worker.
+        name (str): Prefix of the worker thread names.
+    """
+
+    def __init__(
+        self,
+        workers: int = QUERY_WORKERS,
+        max_pending: int = MAX_PENDING_JOBS,
+        name: str = "job",
+    ):
+        self.workers = workers
+        self.stats = WorkerStats()
+        self._places = threading.Semaphore(workers + max_pending)
+        self._jobs: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def reserve(self):
+        """
+        Takes a place for one job, or raises `Overloaded` if none is free.
+        """
+
+        if not self._places.acquire(blocking=False):
+            with self._lock:
+                self.stats.rejected += 1
+                seconds = self.stats.average_seconds * (
+                    self.stats.pending / self.workers + 1
+                )
+            raise Overloaded(429, max(1, math.ceil(seconds)), "Too many jobs pending")
+
+    def cancel(self):
+        """
+        Gives back a place taken with `reserve` for a job not submitted.
+        """
+
+        self._places.release()
+
+    def submit(self, function: Callable, *args):
+        with self._lock:
+            self.stats.submitted += 1
+            self.stats.pending += 1
+        self._jobs.put((function, args))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, args = job
+            started = time.perf_counter()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Background job failed")
+                failed = True
+            else:
+                failed = False
+            seconds = time.perf_counter() - started
+            self._places.release()
+            with self._lock:
+                stats = self.stats
+                stats.pending -= 1
+                if failed:
+                    stats.failed += 1
+                    continue
+                stats.completed += 1
+                if stats.completed == 1:
+                    stats.average_seconds = seconds
+                else:
+                    stats.average_seconds += LATENCY_SMOOTHING * (
+                        seconds - stats.average_seconds
+                    )
+
+    def shutdown(self):
+        """
+        Stops the workers once the jobs already submitted are done.
+        """
+
+        for _thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -1,33 +1,437 @@
+import functools
+import json
 import os
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from typing import Callable, ContextManager, Optional
 
 from botocore.exceptions import ClientError
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Path, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from loguru import logger
 from pydantic import BaseModel, Field
 
+from api.concurrency import (
+    BATCH_WORKERS,
+    MAX_CONCURRENT_QUERIES,
+    MAX_PENDING_BATCHES,
+    MAX_PENDING_JOBS,
+    MAX_QUEUED_QUERIES,
+    QUERY_WORKERS,
+    QUEUE_TIMEOUT,
+    BackgroundWorkers,
+    Overloaded,
+    QueryLimiter,
+    StreamSlot,
+)
 from config import load_aws_client
+from models.micro_batcher import MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW
 from models.query_model import QueryModel
-from scripts.main import query_rag
+from models.rag_engine import CHROMA_PATH, RagEngine, RetrievalMode
+from models.vector_store import VectorBackend, VectorPrecision
+from utils.context_builder import CONTEXT_TOKEN_BUDGET
+from utils.query_batch import (
+    BATCH_CONCURRENCY,
+    RETRIEVAL_BATCH_SIZE,
+    BatchLock,
+    BatchRunning,
+    QueryBatchStats,
+    answer_questions,
+    pending_questions,
+    read_batch_status,
+    read_questions,
+    write_batch_status,
+)
 
-app = FastAPI()
 TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME")
+BATCH_OUTPUT_DIR = "data/batches"
+# Batch IDs name result files, so they are kept to safe file names.
+BATCH_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+MAX_BATCH_CONCURRENCY = 64
+MAX_RETRIEVAL_BATCH_SIZE = 256
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One engine per worker process, shared by all of its requests.
+    app.state.rag_engine = RagEngine(
+        chroma_path=os.getenv("CHROMA_PATH", CHROMA_PATH),
+        embedding_cache_path=os.getenv("EMBEDDING_CACHE_PATH"),
+        query_cache_url=os.getenv("QUERY_CACHE_URL"),
+        retrieval_mode=RetrievalMode(os.getenv("RETRIEVAL_MODE", RetrievalMode.VECTOR)),
+        vector_backend=VectorBackend(os.getenv("VECTOR_BACKEND", VectorBackend.CHROMA)),
+        vector_precision=VectorPrecision(
+            os.getenv("VECTOR_PRECISION", VectorPrecision.FLOAT32)
+        ),
+        mmr=os.getenv("MMR", "").lower() in ("1", "true"),
+        context_token_budget=int(
+            os.getenv("CONTEXT_TOKEN_BUDGET", CONTEXT_TOKEN_BUDGET)
+        ),
+        micro_batch=os.getenv("MICRO_BATCH", "").lower() in ("1", "true"),
+        micro_batch_window=float(os.getenv("MICRO_BATCH_WINDOW", MICRO_BATCH_WINDOW)),
+        micro_batch_size=int(os.getenv("MICRO_BATCH_SIZE", MICRO_BATCH_SIZE)),
+    )
+    app.state.query_limiter = QueryLimiter(
+        max_concurrency=int(
+            os.getenv("MAX_CONCURRENT_QUERIES", MAX_CONCURRENT_QUERIES)
+        ),
+        max_queue=int(os.getenv("MAX_QUEUED_QUERIES", MAX_QUEUED_QUERIES)),
+        queue_timeout=float(os.getenv("QUEUE_TIMEOUT", QUEUE_TIMEOUT)),
+    )
+    app.state.query_workers = BackgroundWorkers(
+        workers=int(os.getenv("QUERY_WORKERS", QUERY_WORKERS)),
+        max_pending=int(os.getenv("MAX_PENDING_JOBS", MAX_PENDING_JOBS)),
+    )
+    # Batches can run for hours, so they get workers of their own and never
+    # hold up the background queries.
+    app.state.batch_workers = BackgroundWorkers(
+        workers=int(os.getenv("BATCH_WORKERS", BATCH_WORKERS)),
+        max_pending=int(os.getenv("MAX_PENDING_BATCHES", MAX_PENDING_BATCHES)),
+        name="batch",
+    )
+    app.state.batch_output_dir = os.getenv("BATCH_OUTPUT_DIR", BATCH_OUTPUT_DIR)
+    app.state.rag_engine.warm_up()
+    yield
+    # Batches still running take query slots on the event loop, so it must
+    # keep running while they finish.
+    await run_in_threadpool(app.state.batch_workers.shutdown)
+    await run_in_threadpool(app.state.query_workers.shutdown)
+    app.state.query_limiter.shutdown()
+    app.state.rag_engine.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class SubmitQueryRequest(BaseModel):
     query_text: str = Field(default="Total revenue in Q1 2024?")
+    bypass_cache: bool = False
+    retrieval_mode: Optional[RetrievalMode] = None
+    # Return the incomplete query at once and answer it in the background;
+    # poll GET /query/{query_id} for the answer.
+    background: bool = False
 
 
-@app.post("/submit_query")
-def submit_query_endpoint(request: SubmitQueryRequest) -> QueryModel:
-    new_query = QueryModel(query_text=request.query_text)
-    query_response = query_rag(request.query_text)
+def overloaded_error(error: Overloaded) -> HTTPException:
+    return HTTPException(
+        status_code=error.status_code,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+def answer_query(
+    rag_engine: RagEngine,
+    request: SubmitQueryRequest,
+    new_query: Optional[QueryModel] = None,
+) -> QueryModel:
+    new_query = new_query or QueryModel(query_text=request.query_text)
+    query_response = rag_engine.query(
+        request.query_text,
+        bypass_cache=request.bypass_cache,
+        mode=request.retrieval_mode,
+    )
     new_query.answer_text = query_response.response_text
     new_query.sources = query_response.sources
+    new_query.cached = query_response.cached
     new_query.is_complete = True
     new_query.put_item()
+    return new_query
+
+
+def answer_query_job(
+    rag_engine: RagEngine,
+    request: SubmitQueryRequest,
+    new_query: QueryModel,
+    query_slot: Callable[[], ContextManager],
+):
+    try:
+        # Background queries count against MAX_CONCURRENT_QUERIES with the
+        # queries of requests.
+        with query_slot():
+            answer_query(rag_engine, request, new_query)
+    except Exception as error:
+        # Pollers are told the query failed instead of waiting forever.
+        new_query.error = str(error)
+        new_query.is_complete = True
+        new_query.put_item()
+        raise
+
+
+@app.post("/submit_query")
+async def submit_query_endpoint(
+    request: SubmitQueryRequest, http_request: Request
+) -> QueryModel:
+    if request.background:
+        return await submit_query_job(request, http_request)
+    # The query blocks on Bedrock and DynamoDB, so it runs on the limiter's
+    # own threads, which also bound how many run at once.
+    try:
+        return await http_request.app.state.query_limiter.run(
+            answer_query, http_request.app.state.rag_engine, request
+        )
+    except Overloaded as error:
+        raise overloaded_error(error)
 
+
+async def submit_query_job(
+    request: SubmitQueryRequest, http_request: Request
+) -> QueryModel:
+    query_workers = http_request.app.state.query_workers
+    try:
+        query_workers.reserve()
+    except Overloaded as error:
+        raise overloaded_error(error)
+    new_query = QueryModel(query_text=request.query_text)
+    try:
+        # Written before the job starts, so the complete item cannot be
+        # overwritten by this one.
+        await run_in_threadpool(new_query.put_item)
+    except Exception:
+        query_workers.cancel()
+        raise
+    query_workers.submit(
+        answer_query_job,
+        http_request.app.state.rag_engine,
+        request,
+        new_query,
+        http_request.app.state.query_limiter.slot,
+    )
     return new_query
 
 
+@app.get("/query/{query_id}")
+async def get_query_endpoint(query_id: str) -> QueryModel:
+    query = await run_in_threadpool(QueryModel.get_item, query_id)
+    if query is None:
+        raise HTTPException(status_code=404, detail=f"Query {query_id} not found")
+    return query
+
+
+def start_query_batch(
+    questions: list[str], output_path: str, stats: QueryBatchStats
+) -> list[str]:
+    pending = pending_questions(questions, output_path, stats)
+    write_batch_status(output_path, stats)
+    return pending
+
+
+def answer_query_batch(
+    rag_engine: RagEngine,
+    questions: list[str],
+    output_path: str,
+    stats: QueryBatchStats,
+    lock: BatchLock,
+    **options,
+):
+    try:
+        answer_questions(rag_engine, questions, output_path, stats=stats, **options)
+    finally:
+        lock.release()
+
+
+def batch_output_path(http_request: Request, batch_id: str) -> str:
+    return os.path.join(http_request.app.state.batch_output_dir, f"{batch_id}.jsonl")
+
+
+@app.post("/submit_queries")
+async def submit_queries_endpoint(
+    http_request: Request,
+    batch_id: Optional[str] = Query(default=None, pattern=BATCH_ID_PATTERN),
+    concurrency: int = Query(default=BATCH_CONCURRENCY, ge=1, le=MAX_BATCH_CONCURRENCY),
+    batch_size: int = Query(
+        default=RETRIEVAL_BATCH_SIZE, ge=1, le=MAX_RETRIEVAL_BATCH_SIZE
+    ),
+    bypass_cache: bool = False,
+    retrieval_mode: Optional[RetrievalMode] = None,
+) -> dict:
+    """
+    Answers the questions of a JSONL body, one `{"query_text": ...}` per
+    line, in the background, and returns the batch with its progress. Each
+    answer is stored in DynamoDB and appended to the batch results, read
+    with GET /query_batch/{batch_id}/results. Submitting the same
+    `batch_id` again answers only the questions not answered yet.
+    """
+
+    try:
+        questions = read_questions((await http_request.body()).decode().splitlines())
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    batch_id = batch_id or uuid.uuid4().hex
+    output_path = batch_output_path(http_request, batch_id)
+    # The lock is held on the results file until the batch is done, so a
+    # batch runs once across all worker processes.
+    lock = BatchLock(output_path)
+    try:
+        lock.acquire()
+    except BatchRunning:
+        raise HTTPException(
+            status_code=409, detail=f"Batch {batch_id} is already running"
+        )
+    batch_workers = http_request.app.state.batch_workers
+    try:
+        batch_workers.reserve()
+    except Overloaded as error:
+        lock.release()
+        raise overloaded_error(error)
+    stats = QueryBatchStats()
+    try:
+        pending = await run_in_threadpool(
+            start_query_batch, questions, output_path, stats
+        )
+    except Exception:
+        batch_workers.cancel()
+        lock.release()
+        raise
+    batch_workers.submit(
+        functools.partial(
+            answer_query_batch,
+            http_request.app.state.rag_engine,
+            pending,
+            output_path,
+            stats,
+            lock,
+            concurrency=concurrency,
+            batch_size=batch_size,
+            bypass_cache=bypass_cache,
+            mode=retrieval_mode,
+            # Batch queries count against MAX_CONCURRENT_QUERIES with the
+            # queries of requests.
+            query_slot=http_request.app.state.query_limiter.slot,
+        )
+    )
+    return {"batch_id": batch_id, **asdict(stats)}
+
+
+@app.get("/query_batch/{batch_id}")
+async def get_query_batch_endpoint(
+    http_request: Request, batch_id: str = Path(pattern=BATCH_ID_PATTERN)
+) -> dict:
+    # Progress is written next to the results by the worker process running
+    # the batch, so any worker can answer.
+    output_path = batch_output_path(http_request, batch_id)
+    # The lock is checked first: a batch writes its last status before it
+    # gives the lock up, so a batch found unlocked has its final status read.
+    running = await run_in_threadpool(BatchLock(output_path).held)
+    stats = await run_in_threadpool(read_batch_status, output_path)
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    if not stats.finished and not running:
+        # The process running the batch stopped before it was done.
+        stats.error = "Batch was interrupted, submit it again to resume"
+        stats.finished = True
+    return {"batch_id": batch_id, **asdict(stats)}
+
+
+@app.get("/query_batch/{batch_id}/results")
+async def get_query_batch_results_endpoint(
+    http_request: Request, batch_id: str = Path(pattern=BATCH_ID_PATTERN)
+) -> FileResponse:
+    output_path = batch_output_path(http_request, batch_id)
+    if not os.path.exists(output_path):
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return FileResponse(output_path, media_type="application/x-ndjson")
+
+
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_answer(rag_engine: RagEngine, request: SubmitQueryRequest):
+    new_query = QueryModel(query_text=request.query_text)
+    try:
+        for event, data in rag_engine.stream_query(
+            request.query_text,
+            bypass_cache=request.bypass_cache,
+            mode=request.retrieval_mode,
+        ):
+            if event == "sources":
+                data = {"query_id": new_query.query_id, "sources": data}
+            elif event == "token":
+                data = {"text": data}
+            elif event == "done":
+                new_query.answer_text = data.response_text
+                new_query.sources = data.sources
+                new_query.cached = data.cached
+                new_query.is_complete = True
+                new_query.put_item()
+                data = new_query.dict()
+            yield server_sent_event(event, data)
+    except Exception as error:
+        # The response has started, so errors can only be reported in it.
+        logger.exception(f"Streaming query {new_query.query_id} failed")
+        yield server_sent_event("error", {"detail": str(error)})
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    Streams a body made with `QueryLimiter.iterate`, and gives its query
+    thread back if the body never starts, such as when the client
+    disconnected before the response began. Starlette then never iterates
+    the body, and so never runs the code that releases the thread.
+    """
+
+    def __init__(self, content, slot: StreamSlot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release_unused()
+
+
+@app.post("/stream_query")
+async def stream_query_endpoint(
+    request: SubmitQueryRequest, http_request: Request
+) -> StreamingResponse:
+    """
+    Streams the answer as server-sent events: `sources`, then a `token`
+    event per chunk of the answer, then `done` with the stored query.
+    """
+
+    query_limiter = http_request.app.state.query_limiter
+    try:
+        await query_limiter.acquire()
+    except Overloaded as error:
+        raise overloaded_error(error)
+    slot = StreamSlot(query_limiter)
+    return SlotStreamingResponse(
+        query_limiter.iterate(
+            stream_answer(http_request.app.state.rag_engine, request), slot
+        ),
+        slot,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+def metrics_endpoint(http_request: Request) -> dict:
+    rag_engine = http_request.app.state.rag_engine
+    metrics = {
+        name: asdict(cache.stats) if cache is not None else None
+        for name, cache in (
+            ("query_embedding_cache", rag_engine.query_cache),
+            ("answer_cache", rag_engine.answer_cache),
+        )
+    }
+    metrics["mmr"] = asdict(rag_engine.mmr_stats) if rag_engine.mmr else None
+    metrics["context"] = asdict(rag_engine.context_builder.stats)
+    metrics["micro_batch"] = (
+        asdict(rag_engine.search_batcher.stats)
+        if rag_engine.search_batcher is not None
+        else None
+    )
+    metrics["query_limiter"] = asdict(http_request.app.state.query_limiter.stats)
+    metrics["query_workers"] = asdict(http_request.app.state.query_workers.stats)
+    metrics["batch_workers"] = asdict(http_request.app.state.batch_workers.stats)
+    return metrics
+
+
 @app.post("/create_table")
 def create_table_endpoint():
     client = load_aws_client("dynamodb")
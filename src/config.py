@@ -1,10 +1,12 @@
 import os
+from typing import Optional
 
 import boto3
+from botocore.config import Config
 from dotenv import load_dotenv
 
 
-def load_aws_client(service_name: str):
+def load_aws_client(service_name: str, config: Optional[Config] = None):
     load_dotenv()
     aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
     aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
@@ -14,6 +16,7 @@ def load_aws_client(service_name: str):
         aws_access_key_id=aws_access_key_id,
         aws_secret_access_key=aws_secret_access_key,
         region_name=aws_region,
+        config=config,
     )
 
 
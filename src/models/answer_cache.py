@@ -0,0 +1,159 @@
+import re
+import threading
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import numpy as np
+
+from models.query_cache import normalize_query
+from models.rag import QueryResponse
+
+ANSWER_CACHE_SIZE = 1024
+SIMILARITY_THRESHOLD = 0.92
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def query_figures(text: str) -> frozenset[str]:
+    # Paraphrases may share almost every token with a different question,
+    # e.g. "Q1 2024 revenue" and "Q2 2024 revenue", so only queries naming
+    # the same numbers are allowed to share an answer.
+    return frozenset(NUMBER_PATTERN.findall(normalize_query(text)))
+
+
+@dataclass
+class AnswerCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class SemanticAnswerCache:
+    """
+    Keeps the answers of recent queries next to their query embeddings in a
+    small in-memory matrix. A new query reuses a stored answer when its
+    embedding has a cosine similarity of at least `threshold` with the
+    stored query, both name the same numbers, both were asked in the same
+    `scope` (such as the retrieval mode), and the answer was generated
+    against the current index version. Storing an answer replaces the
+    answers a lookup of the same query would return. Once `max_entries`
+    answers are held, the least recently used one is replaced.
+
+    Args:
+        threshold (float): Minimum cosine similarity for a hit.
+        max_entries (int): Maximum number of cached answers.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_SIZE,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.stats = AnswerCacheStats()
+        self.index_version: Optional[str] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._responses: list[Optional[QueryResponse]] = [None] * max_entries
+        self._keys: list[Optional[tuple]] = [None] * max_entries
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(response is not None for response in self._responses)
+
+    def _reset(self):
+        self._responses = [None] * self.max_entries
+        self._keys = [None] * self.max_entries
+        self._last_used[:] = 0
+
+    def _check_version(self, index_version: str):
+        if index_version != self.index_version:
+            if len(self):
+                self.stats.invalidations += 1
+            self._reset()
+            self.index_version = index_version
+
+    @staticmethod
+    def _unit(vector: list[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        query_text: str,
+        vector: list[float],
+        index_version: str,
+        scope: str = "",
+    ) -> Optional[QueryResponse]:
+        """
+        Returns the cached answer for a query similar to `query_text`, marked
+        as cached, or None.
+        """
+
+        key = (scope, query_figures(query_text))
+        with self._lock:
+            self._check_version(index_version)
+            if self._vectors is None:
+                self.stats.misses += 1
+                return None
+            similarities = self._vectors @ self._unit(vector)
+            above = np.flatnonzero(similarities >= self.threshold)
+            slot = next(
+                (
+                    slot
+                    for slot in above[np.argsort(-similarities[above])]
+                    if self._responses[slot] is not None and self._keys[slot] == key
+                ),
+                None,
+            )
+            if slot is None:
+                self.stats.misses += 1
+                return None
+            self._clock += 1
+            self._last_used[slot] = self._clock
+            self.stats.hits += 1
+            return replace(self._responses[slot], query_text=query_text, cached=True)
+
+    def store(
+        self,
+        query_text: str,
+        vector: list[float],
+        response: QueryResponse,
+        index_version: str,
+        scope: str = "",
+    ):
+        with self._lock:
+            self._check_version(index_version)
+            unit = self._unit(vector)
+            key = (scope, query_figures(query_text))
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(unit)), np.float32)
+            # An answer generated with bypass_cache replaces every stored
+            # answer a lookup of the same query could still return.
+            similar = [
+                slot
+                for slot in np.flatnonzero(self._vectors @ unit >= self.threshold)
+                if self._responses[slot] is not None and self._keys[slot] == key
+            ]
+            for stale in similar[1:]:
+                self._responses[stale] = None
+                self._keys[stale] = None
+                self._last_used[stale] = 0
+            if similar:
+                slot = int(similar[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                if self._responses[slot] is not None:
+                    self.stats.evictions += 1
+            self._clock += 1
+            self._vectors[slot] = unit
+            self._responses[slot] = response
+            self._keys[slot] = key
+            self._last_used[slot] = self._clock
+
+    def clear(self):
+        with self._lock:
+            self._reset()
@@ -0,0 +1,87 @@
+import hashlib
+import math
+import os
+import struct
+from typing import Iterable
+
+HEADER = struct.Struct("<4sQIQQ")
+MAGIC = b"BLM1"
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over string keys using double hashing of a
+    blake2b digest. `key in bloom` never misses an added key, and is wrong
+    for an absent key with probability close to `error_rate` as long as no
+    more than `capacity` keys were added.
+
+    Args:
+        capacity (int): Expected number of keys.
+        error_rate (float): Target false positive rate at `capacity`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.num_bits = max(
+            8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.count = 0
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, keys: Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    @property
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, self.capacity, self.num_hashes, self.num_bits, self.count
+                )
+            )
+            f.write(struct.pack("<d", self.error_rate))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        with open(path, "rb") as f:
+            magic, capacity, num_hashes, num_bits, count = HEADER.unpack(
+                f.read(HEADER.size)
+            )
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a Bloom filter file")
+            (error_rate,) = struct.unpack("<d", f.read(8))
+            bloom = cls.__new__(cls)
+            bloom.capacity = capacity
+            bloom.error_rate = error_rate
+            bloom.num_hashes = num_hashes
+            bloom.num_bits = num_bits
+            bloom.count = count
+            bloom.bits = bytearray(f.read())
+        return bloom
@@ -0,0 +1,346 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import Counter
+from typing import Iterable, Optional
+
+import numpy as np
+
+BM25_DIR = "bm25"
+META_FILE = "meta.json"
+VOCABULARY_FILE = "vocabulary.json"
+CHUNK_IDS_FILE = "chunk_ids.json"
+ARRAY_FILES = ("offsets", "doc_ids", "term_freqs", "doc_lengths", "idf")
+# Digests of the indexed texts, which indexes saved before updates were
+# incremental lack.
+TEXT_HASHES = "text_hashes"
+# Lowercased words, and numbers with their thousands separators and decimals
+# kept together, so "CET1", "Q2" and "$1,234.5" stay single tokens.
+BM25_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+K1 = 1.2
+B = 0.75
+
+
+def bm25_tokenize(text: str) -> list[str]:
+    return BM25_TOKEN_PATTERN.findall(text.casefold())
+
+
+def text_digest(text: str) -> int:
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def inverse_document_frequency(num_docs: int, lengths: np.ndarray) -> np.ndarray:
+    return np.log(1 + (num_docs - lengths + 0.5) / (lengths + 0.5), dtype=np.float32)
+
+
+def posting_terms(offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the term number of each posting.
+    """
+
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def renumber_terms(vocabulary: dict[str, int], numbers: dict[str, int]) -> np.ndarray:
+    """
+    Returns the number in `numbers` of each term number of `vocabulary`.
+    """
+
+    renumbered = np.zeros(len(vocabulary), dtype=np.int64)
+    for term, number in vocabulary.items():
+        renumbered[number] = numbers[term]
+    return renumbered
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over chunk texts. Postings are stored as flat
+    numpy arrays, one slice per term, so a saved index is memory-mapped
+    rather than read at load time, and a query costs one vectorized pass
+    over the postings of its terms.
+
+    Args:
+        chunk_ids (list[str]): The chunk ID of each indexed document.
+        vocabulary (dict[str, int]): Term to term number.
+        arrays (dict[str, np.ndarray]): The postings arrays: `offsets`,
+            `doc_ids`, `term_freqs`, `doc_lengths` and `idf`, and the
+            `text_hashes` of the documents if known.
+        index_version (str): The vector store version the index was built
+            from.
+    """
+
+    def __init__(
+        self,
+        chunk_ids: list[str],
+        vocabulary: dict[str, int],
+        arrays: dict[str, np.ndarray],
+        index_version: str = "",
+        k1: float = K1,
+        b: float = B,
+    ):
+        self.chunk_ids = chunk_ids
+        self.vocabulary = vocabulary
+        self.offsets = arrays["offsets"]
+        self.doc_ids = arrays["doc_ids"]
+        self.term_freqs = arrays["term_freqs"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.idf = arrays["idf"]
+        self.text_hashes: Optional[np.ndarray] = arrays.get(TEXT_HASHES)
+        self.index_version = index_version
+        self.k1 = k1
+        self.b = b
+        average_length = float(self.doc_lengths.mean()) if len(chunk_ids) else 1.0
+        # Per-document part of the BM25 denominator, precomputed once.
+        self._length_norm = (
+            self.k1 * (1 - self.b + self.b * self.doc_lengths / average_length)
+        ).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    @classmethod
+    def build(
+        cls, documents: Iterable[tuple[str, str]], index_version: str = ""
+    ) -> "BM25Index":
+        """
+        Indexes `(chunk_id, text)` pairs.
+        """
+
+        chunk_ids = []
+        doc_lengths = []
+        text_hashes = []
+        postings: dict[str, list[tuple[int, int]]] = {}
+        for doc_id, (chunk_id, text) in enumerate(documents):
+            tokens = bm25_tokenize(text)
+            chunk_ids.append(chunk_id)
+            doc_lengths.append(len(tokens))
+            text_hashes.append(text_digest(text))
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, count))
+
+        terms = sorted(postings)
+        lengths = np.array([len(postings[term]) for term in terms], dtype=np.int64)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        pairs = [pair for term in terms for pair in postings[term]]
+        arrays = {
+            "offsets": offsets,
+            "doc_ids": np.array([doc for doc, _ in pairs], dtype=np.int32),
+            "term_freqs": np.array([tf for _, tf in pairs], dtype=np.float32),
+            "doc_lengths": np.array(doc_lengths, dtype=np.float32),
+            "idf": inverse_document_frequency(len(chunk_ids), lengths),
+            TEXT_HASHES: np.array(text_hashes, dtype=np.uint64),
+        }
+        vocabulary = {term: number for number, term in enumerate(terms)}
+        return cls(chunk_ids, vocabulary, arrays, index_version=index_version)
+
+    def update(
+        self, documents: Iterable[tuple[str, str]], index_version: str = ""
+    ) -> "BM25Index":
+        """
+        Returns the index of `documents`, the `(chunk_id, text)` pairs the
+        store holds now. The postings of the documents indexed before with
+        the same text are kept, and only the documents added or changed
+        since are tokenized; an index without text hashes is rebuilt.
+        """
+
+        if self.text_hashes is None:
+            return self.build(documents, index_version=index_version)
+        indexed = {chunk_id: doc for doc, chunk_id in enumerate(self.chunk_ids)}
+        text_hashes = self.text_hashes.tolist()
+        kept = np.zeros(len(self), dtype=bool)
+        changed = []
+        for chunk_id, text in documents:
+            doc = indexed.get(chunk_id)
+            if doc is not None and text_hashes[doc] == text_digest(text):
+                kept[doc] = True
+            else:
+                changed.append((chunk_id, text))
+        added = self.build(changed)
+
+        # Postings of the kept documents, renumbered after the documents
+        # removed, then those of the added documents, numbered after them.
+        terms = sorted(self.vocabulary.keys() | added.vocabulary.keys())
+        numbers = {term: number for number, term in enumerate(terms)}
+        kept_postings = kept[self.doc_ids]
+        term_numbers = np.concatenate(
+            [
+                renumber_terms(self.vocabulary, numbers)[
+                    posting_terms(self.offsets)[kept_postings]
+                ],
+                renumber_terms(added.vocabulary, numbers)[posting_terms(added.offsets)],
+            ]
+        )
+        num_kept = int(kept.sum())
+        doc_numbers = np.cumsum(kept) - 1
+        doc_ids = np.concatenate(
+            [doc_numbers[self.doc_ids[kept_postings]], added.doc_ids + num_kept]
+        ).astype(np.int32)
+        term_freqs = np.concatenate([self.term_freqs[kept_postings], added.term_freqs])
+        order = np.lexsort((doc_ids, term_numbers))
+
+        # Terms only the removed documents held are dropped.
+        lengths = np.bincount(term_numbers, minlength=len(terms))
+        present = lengths > 0
+        lengths = lengths[present]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        chunk_ids = [
+            chunk_id for chunk_id, keep in zip(self.chunk_ids, kept) if keep
+        ] + added.chunk_ids
+        arrays = {
+            "offsets": offsets,
+            "doc_ids": doc_ids[order],
+            "term_freqs": term_freqs[order],
+            "doc_lengths": np.concatenate([self.doc_lengths[kept], added.doc_lengths]),
+            "idf": inverse_document_frequency(len(chunk_ids), lengths),
+            TEXT_HASHES: np.concatenate([self.text_hashes[kept], added.text_hashes]),
+        }
+        vocabulary = {
+            term: number
+            for number, term in enumerate(
+                term for term, keep in zip(terms, present) if keep
+            )
+        }
+        return type(self)(
+            chunk_ids, vocabulary, arrays, index_version, k1=self.k1, b=self.b
+        )
+
+    def search(self, query_text: str, k: int) -> list[tuple[str, float]]:
+        """
+        Returns up to `k` `(chunk_id, score)` pairs, best first.
+        """
+
+        terms = [
+            self.vocabulary[term]
+            for term in dict.fromkeys(bm25_tokenize(query_text))
+            if term in self.vocabulary
+        ]
+        if not terms or not len(self):
+            return []
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            doc_ids = self.doc_ids[start:end]
+            term_freqs = self.term_freqs[start:end]
+            scores[doc_ids] += (
+                self.idf[term]
+                * term_freqs
+                * (self.k1 + 1)
+                / (term_freqs + self._length_norm[doc_ids])
+            )
+        # Each document appears once per term, so the fancy-indexed += above
+        # never drops a repeated index.
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunk_ids[doc], float(scores[doc])) for doc in top]
+
+    def save(self, directory: str):
+        """
+        Writes the index to `directory`, replacing any previous index only
+        once the new one is complete.
+        """
+
+        tmp_directory = f"{directory}.tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        arrays = {
+            "offsets": self.offsets,
+            "doc_ids": self.doc_ids,
+            "term_freqs": self.term_freqs,
+            "doc_lengths": self.doc_lengths,
+            "idf": self.idf,
+        }
+        if self.text_hashes is not None:
+            arrays[TEXT_HASHES] = self.text_hashes
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_directory, f"{name}.npy"), array)
+        with open(os.path.join(tmp_directory, VOCABULARY_FILE), "w") as f:
+            json.dump(self.vocabulary, f)
+        with open(os.path.join(tmp_directory, CHUNK_IDS_FILE), "w") as f:
+            json.dump(self.chunk_ids, f)
+        with open(os.path.join(tmp_directory, META_FILE), "w") as f:
+            json.dump(
+                {"index_version": self.index_version, "k1": self.k1, "b": self.b}, f
+            )
+        old_directory = f"{directory}.old"
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old_directory)
+        os.replace(tmp_directory, directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    @staticmethod
+    def saved_version(directory: str) -> Optional[str]:
+        try:
+            with open(os.path.join(directory, META_FILE)) as f:
+                return json.load(f)["index_version"]
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        with open(os.path.join(directory, VOCABULARY_FILE)) as f:
+            vocabulary = json.load(f)
+        with open(os.path.join(directory, CHUNK_IDS_FILE)) as f:
+            chunk_ids = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in ARRAY_FILES
+        }
+        text_hashes_path = os.path.join(directory, f"{TEXT_HASHES}.npy")
+        if os.path.exists(text_hashes_path):
+            arrays[TEXT_HASHES] = np.load(text_hashes_path, mmap_mode="r")
+        return cls(
+            chunk_ids,
+            vocabulary,
+            arrays,
+            index_version=meta["index_version"],
+            k1=meta["k1"],
+            b=meta["b"],
+        )
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[str]], k: int = 60
+) -> list[tuple[str, float]]:
+    """
+    Merges ranked ID lists by summing `1 / (k + rank)` over the lists each
+    ID appears in, best first.
+    """
+
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def update_bm25_index(chroma_db) -> bool:
+    """
+    Brings the BM25 index stored next to the Chroma collection up to date
+    with the collection's documents, unless it was already built from the
+    current index version. Only the chunks written since the last update
+    are tokenized. Returns whether it was updated.
+    """
+
+    directory = os.path.join(chroma_db.chroma_path, BM25_DIR)
+    index_version = chroma_db.index_version()
+    saved_version = BM25Index.saved_version(directory)
+    if saved_version == index_version:
+        return False
+    documents = chroma_db.iter_documents()
+    if saved_version is None:
+        index = BM25Index.build(documents, index_version=index_version)
+    else:
+        index = BM25Index.load(directory).update(documents, index_version=index_version)
+    index.save(directory)
+    return True
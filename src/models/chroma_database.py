@@ -1,27 +1,366 @@
+import os
+import uuid
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from langchain.schema.document import Document
 from langchain_aws import BedrockEmbeddings
 from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+from models.bloom_filter import BloomFilter
+from models.embedding_cache import CachedEmbeddings, EmbeddingCache
+from models.embedding_executor import EmbeddingExecutor
+from models.faiss_vector_store import FAISS_INDEX, FaissVectorStore
+from models.numpy_vector_store import NUMPY_STORE_DIR, NumpyVectorStore
+from models.serving_index import SERVING_DIR, MmapVectorStore
+from models.vector_store import (
+    ID_PAGE_SIZE,
+    VectorBackend,
+    VectorPrecision,
+    VectorStore,
+)
+
+UPSERT_BATCH_SIZE = 5000
+BLOOM_FILTER_FILE = "chunk_ids.bloom"
+BLOOM_MIN_CAPACITY = 1_000_000
+INDEX_VERSION_FILE = "index_version"
+
+
+class ChromaVectorStore(VectorStore):
+    """
+    The LangChain `Chroma` collection persisted at `chroma_path`.
+    """
+
+    def __init__(self, chroma_path: str, embedding_function: Embeddings):
+        self.db = Chroma(
+            persist_directory=chroma_path, embedding_function=embedding_function
+        )
+
+    def count(self) -> int:
+        return self.db._collection.count()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.db._collection.upsert(
+            ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+        )
+
+    def delete(self, ids):
+        self.db.delete(ids=ids)
+
+    def get(self, ids):
+        found = self.db.get(ids=ids, include=["documents", "metadatas"])
+        documents = {
+            chunk_id: Document(page_content=text, metadata=metadata)
+            for chunk_id, text, metadata in zip(
+                found["ids"], found["documents"], found["metadatas"]
+            )
+        }
+        return [documents[chunk_id] for chunk_id in ids if chunk_id in documents]
 
+    def get_embeddings(self, ids):
+        page = self.db._collection.get(ids=ids, include=["embeddings"])
+        rows = {chunk_id: row for row, chunk_id in enumerate(page["ids"])}
+        embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+        return embeddings[[rows[chunk_id] for chunk_id in ids]]
+
+    def existing_ids(self, ids: Iterable[str]) -> set[str]:
+        ids = list(ids)
+        found = set()
+        for start in range(0, len(ids), ID_PAGE_SIZE):
+            page = ids[start : start + ID_PAGE_SIZE]
+            found.update(self.db.get(ids=page, include=[])["ids"])
+        return found
+
+    def iter_ids(self, page_size: int = ID_PAGE_SIZE) -> Iterator[list[str]]:
+        offset = 0
+        while True:
+            chunk_ids = self.db.get(include=[], limit=page_size, offset=offset)["ids"]
+            if not chunk_ids:
+                return
+            yield chunk_ids
+            offset += len(chunk_ids)
+
+    def iter_documents(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[str, str]]:
+        offset = 0
+        while True:
+            page = self.db.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["documents"])
+            offset += len(page["ids"])
+
+    def iter_records(self, page_size: int = ID_PAGE_SIZE):
+        offset = 0
+        while True:
+            page = self.db._collection.get(
+                include=["embeddings", "documents", "metadatas"],
+                limit=page_size,
+                offset=offset,
+            )
+            if not page["ids"]:
+                return
+            yield (
+                page["ids"],
+                np.asarray(page["embeddings"], dtype=np.float32),
+                page["documents"],
+                page["metadatas"],
+            )
+            offset += len(page["ids"])
+
+    def search(self, embedding, k, where=None):
+        return self.db.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter=where
+        )
+
+    def search_batch(self, embeddings, k, where=None):
+        # One collection query searches every embedding; LangChain's wrapper
+        # only returns the results of the first.
+        found = self.db._collection.query(
+            query_embeddings=np.asarray(embeddings, dtype=np.float32).tolist(),
+            n_results=k,
+            where=where or None,
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [
+                (Document(page_content=text, metadata=metadata or {}), distance)
+                for text, metadata, distance in zip(texts, metadatas, distances)
+            ]
+            for texts, metadatas, distances in zip(
+                found["documents"], found["metadatas"], found["distances"]
+            )
+        ]
+
+
+class ChromaDatabase(VectorStore):
+    """
+    The chunk store used for ingestion and retrieval: embeds chunks, keeps
+    the index version and the optional Bloom filter of chunk IDs, and
+    stores and searches vectors with the chosen backend. Chroma is the
+    default; the NumPy backend searches exactly and the FAISS backend with
+    an approximate index, both persisted under `chroma_path`. A collection
+    must be queried with the backend it was populated with, or with the
+    read-only mmap backend once a serving index has been written from it.
+
+    Args:
+        chroma_path (str): Directory of the persisted store.
+        bedrock_client: The `bedrock-runtime` client used for embeddings.
+        model_id (str): The Bedrock embedding model.
+        embedding_workers (int): Concurrent embedding requests.
+        embedding_cache_path (str): Optional on-disk embedding cache.
+        use_bloom_filter (bool): Whether to skip lookups of new chunk IDs
+            with a Bloom filter.
+        embeddings (Embeddings): Optional embedding model used instead of
+            Bedrock.
+        vector_backend (VectorBackend): Where vectors are stored and searched.
+        faiss_index (str): FAISS index factory string for the FAISS backend.
+        vector_precision (VectorPrecision): How the NumPy and FAISS backends
+            hold vectors in memory. float16 and int8 halve or quarter their
+            size; results are re-ranked with the full-precision vectors kept
+            on disk. Stores are always persisted in float32, so the precision
+            can differ between ingestion and serving. The mmap backend
+            serves float32 vectors from the page cache, shared by all
+            processes on the host.
+    """
 
-class ChromaDatabase:
     def __init__(
         self,
         chroma_path: str,
         bedrock_client,
         model_id: str = "amazon.titan-embed-text-v1",
+        embedding_workers: int = 8,
+        embedding_cache_path: Optional[str] = None,
+        use_bloom_filter: bool = False,
+        embeddings: Optional[Embeddings] = None,
+        vector_backend: VectorBackend = VectorBackend.CHROMA,
+        faiss_index: str = FAISS_INDEX,
+        vector_precision: VectorPrecision = VectorPrecision.FLOAT32,
     ):
         self.chroma_path = chroma_path
         self.model_id = model_id
-        self.embeddings = BedrockEmbeddings(client=bedrock_client, model_id=model_id)
-        self.db = Chroma(
-            persist_directory=chroma_path, embedding_function=self.embeddings
+        self.embeddings = embeddings or BedrockEmbeddings(
+            client=bedrock_client, model_id=model_id
+        )
+        self.embedding_executor = EmbeddingExecutor(
+            self.embeddings, max_workers=embedding_workers
         )
+        self.embedding_cache = (
+            EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+        )
+        embedding_function = self.embeddings
+        if self.embedding_cache is not None:
+            embedding_function = CachedEmbeddings(
+                self.embeddings, self.embedding_cache, model_id
+            )
+        self.embedding_function = embedding_function
+        self.vector_backend = VectorBackend(vector_backend)
+        store_path = os.path.join(chroma_path, NUMPY_STORE_DIR)
+        vector_precision = VectorPrecision(vector_precision)
+        if self.vector_backend == VectorBackend.NUMPY:
+            self.store: VectorStore = NumpyVectorStore(
+                store_path, precision=vector_precision
+            )
+        elif self.vector_backend == VectorBackend.FAISS:
+            self.store = FaissVectorStore(
+                store_path, index_factory=faiss_index, precision=vector_precision
+            )
+        elif vector_precision != VectorPrecision.FLOAT32:
+            raise ValueError(
+                f"The {self.vector_backend.value} backend only stores float32 vectors"
+            )
+        elif self.vector_backend == VectorBackend.MMAP:
+            self.store = MmapVectorStore(os.path.join(chroma_path, SERVING_DIR))
+        else:
+            self.store = ChromaVectorStore(chroma_path, embedding_function)
+        self.bloom_path = os.path.join(chroma_path, BLOOM_FILTER_FILE)
+        self.bloom = self._load_bloom() if use_bloom_filter else None
+        self.index_version_path = os.path.join(chroma_path, INDEX_VERSION_FILE)
+        self._modified = False
+        if (
+            self.vector_backend == VectorBackend.MMAP
+            and self.store.index_version != self.index_version()
+        ):
+            logger.warning(
+                "The serving index is older than the collection, "
+                "run populate-database with --serving-index"
+            )
+
+    def _load_bloom(self) -> BloomFilter:
+        if os.path.exists(self.bloom_path):
+            bloom = BloomFilter.load(self.bloom_path)
+            if not bloom.is_full:
+                return bloom
+        return self._build_bloom()
+
+    def _build_bloom(self) -> BloomFilter:
+        bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, 2 * self.count()))
+        for chunk_ids in self.iter_ids():
+            bloom.update(chunk_ids)
+        bloom.save(self.bloom_path)
+        return bloom
 
     def get_existing_ids(self):
-        existing_items = self.db.get(include=[])
-        return set(existing_items["ids"])
+        return {chunk_id for chunk_ids in self.iter_ids() for chunk_id in chunk_ids}
+
+    def count(self) -> int:
+        return self.store.count()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.store.upsert(ids, embeddings, documents, metadatas)
+        self._modified = True
+        if self.bloom is not None:
+            self.bloom.update(ids)
+
+    def get(self, ids):
+        return self.store.get(ids)
+
+    def get_embeddings(self, ids):
+        return self.store.get_embeddings(ids)
+
+    def iter_ids(self, page_size: int = ID_PAGE_SIZE) -> Iterator[list[str]]:
+        return self.store.iter_ids(page_size)
+
+    def iter_documents(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[str, str]]:
+        return self.store.iter_documents(page_size)
+
+    def iter_records(self, page_size: int = ID_PAGE_SIZE):
+        return self.store.iter_records(page_size)
+
+    def search(self, embedding, k, where=None):
+        return self.store.search(embedding, k, where)
+
+    def search_batch(self, embeddings, k, where=None):
+        return self.store.search_batch(embeddings, k, where)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embedding_function.embed_query(text)
+
+    def existing_ids(self, chunk_ids: Iterable[str]) -> set[str]:
+        """
+        Returns which of `chunk_ids` are stored, asking the store only about
+        candidate IDs. With a Bloom filter, IDs it rules out are not looked
+        up at all.
+        """
+
+        candidates = list(dict.fromkeys(chunk_ids))
+        if self.bloom is not None:
+            candidates = [chunk_id for chunk_id in candidates if chunk_id in self.bloom]
+        return self.store.existing_ids(candidates)
+
+    def index_version(self) -> str:
+        """
+        Returns a token that changes whenever chunks are written to or
+        deleted from the collection, by this or any other process.
+        """
+
+        try:
+            with open(self.index_version_path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _bump_index_version(self):
+        os.makedirs(self.chroma_path, exist_ok=True)
+        tmp_path = f"{self.index_version_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, self.index_version_path)
+
+    def flush(self):
+        self.store.persist()
+        if self._modified:
+            self._bump_index_version()
+            self._modified = False
+        if self.bloom is None:
+            return
+        if self.bloom.is_full:
+            self.bloom = self._build_bloom()
+        else:
+            self.bloom.save(self.bloom_path)
 
     def add_documents(self, chunks, chunk_ids):
-        self.db.add_documents(chunks, ids=chunk_ids)
+        embeddings = self.embed_documents(chunks)
+        for start in range(0, len(chunks), UPSERT_BATCH_SIZE):
+            end = start + UPSERT_BATCH_SIZE
+            self.upsert_embeddings(
+                chunks[start:end], chunk_ids[start:end], embeddings[start:end]
+            )
+
+    def delete(self, chunk_ids):
+        if chunk_ids:
+            self.store.delete(chunk_ids)
+            self._modified = True
+
+    def embed_documents(self, chunks, on_progress=None):
+        texts = [chunk.page_content for chunk in chunks]
+        if self.embedding_cache is None:
+            return self.embedding_executor.embed(texts, on_progress=on_progress)
+        return self.embedding_cache.get_or_embed(
+            self.model_id,
+            texts,
+            lambda missing: self.embedding_executor.embed(
+                missing, on_progress=on_progress
+            ),
+        )
+
+    def upsert_embeddings(self, chunks, chunk_ids, embeddings):
+        self.upsert(
+            chunk_ids,
+            embeddings,
+            [chunk.page_content for chunk in chunks],
+            [chunk.metadata for chunk in chunks],
+        )
 
     def get_chroma_db(self):
-        return self.db
+        """
+        Returns the LangChain `Chroma` collection, or None with other
+        backends.
+        """
+
+        return getattr(self.store, "db", None)
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Callable
+
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = "data/embedding_cache.sqlite3"
+MAX_ENTRIES = 2_000_000
+SQLITE_MAX_VARIABLES = 900
+# The kinds of input embedded. Models such as Cohere embed a query and a
+# document of the same text differently.
+DOCUMENT = "document"
+QUERY = "query"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def cache_model_key(model_id: str, input_type: str) -> str:
+    """
+    Returns the `model_id` column the vectors of `input_type` are stored
+    under. Documents keep the bare model ID, so caches written before
+    queries were told apart stay valid.
+    """
+
+    return model_id if input_type == DOCUMENT else f"{model_id}#{input_type}"
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by `(model_id, input type, sha256(text))`,
+    stored in SQLite as float32 blobs. Once it holds more than `max_entries` vectors
+    the least recently used ones are evicted.
+
+    Args:
+        path (str): The SQLite database file.
+        max_entries (int): Maximum number of cached vectors.
+    """
+
+    def __init__(
+        self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = MAX_ENTRIES
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model_id TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model_id, text_hash))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+        self._size = self._count()
+
+    def _count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get_many(self, model_id: str, hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+                batch = hashes[start : start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT text_hash, vector FROM embeddings"
+                    f" WHERE model_id = ? AND text_hash IN ({placeholders})",
+                    [model_id, *batch],
+                ).fetchall()
+                found.update((key, array("f", blob).tolist()) for key, blob in rows)
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ?"
+                    " WHERE model_id = ? AND text_hash = ?",
+                    [(now, model_id, key) for key in found],
+                )
+                self._connection.commit()
+        return found
+
+    def put_many(self, model_id: str, vectors: dict[str, list[float]]):
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [
+                    (model_id, key, array("f", vector).tobytes(), now)
+                    for key, vector in vectors.items()
+                ],
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        self._size = self._count()
+        excess = self._size - self.max_entries
+        if excess <= 0:
+            return
+        self._connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN"
+            " (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._size -= excess
+        self.stats.evictions += excess
+
+    def get_or_embed(
+        self,
+        model_id: str,
+        texts: list[str],
+        embed: Callable[[list[str]], list[list[float]]],
+        input_type: str = DOCUMENT,
+    ) -> list[list[float]]:
+        """
+        Returns embeddings for `texts`, calling `embed` only for the distinct
+        texts that are not cached yet and caching its results. Vectors of
+        `input_type` are cached apart from those of other input types.
+        """
+
+        model_id = cache_model_key(model_id, input_type)
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.get_many(model_id, list(set(hashes)))
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        misses = sum(key not in vectors for key in hashes)
+        with self._lock:
+            self.stats.hits += len(texts) - misses
+            self.stats.misses += misses
+
+        if missing:
+            embedded = dict(zip(missing, embed(list(missing.values()))))
+            self.put_many(model_id, embedded)
+            vectors.update(embedded)
+        return [vectors[key] for key in hashes]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so that documents and queries are looked up in
+    an `EmbeddingCache` before the model is called.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_id: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = model_id
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.cache.get_or_embed(
+            self.model_id, texts, self.embeddings.embed_documents
+        )
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.cache.get_or_embed(
+            self.model_id,
+            [text],
+            lambda texts: [self.embeddings.embed_query(texts[0])],
+            input_type=QUERY,
+        )[0]
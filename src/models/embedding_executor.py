@@ -0,0 +1,191 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from botocore.exceptions import ClientError
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """
+    Checks an error and the errors it was raised from for a Bedrock
+    throttling code. `BedrockEmbeddings` re-raises client errors as
+    `ValueError`, so the message is checked as well.
+    """
+
+    while error is not None:
+        if isinstance(error, ClientError):
+            if error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                return True
+        if any(code in str(error) for code in THROTTLING_ERROR_CODES):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that halves on throttling and grows back by one slot
+    per window of successful calls (additive increase, multiplicative
+    decrease).
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+@dataclass
+class EmbeddingStats:
+    texts: int = 0
+    batches: int = 0
+    retries: int = 0
+    throttles: int = 0
+
+
+class EmbeddingExecutor:
+    """
+    Embeds texts in small batches on a bounded thread pool, retrying failed
+    batches with exponential backoff and jitter and lowering concurrency
+    while the endpoint is throttling. The thread pool is started by the
+    first `embed`, so a store opened only to be searched starts no threads.
+
+    Args:
+        embeddings (Embeddings): The embedding model to call.
+        max_workers (int): Maximum number of concurrent embedding batches.
+        batch_size (int): Number of texts embedded per task.
+        max_retries (int): Retries per batch before the error is raised.
+        base_delay (float): Initial backoff delay in seconds.
+        max_delay (float): Maximum backoff delay in seconds.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_workers: int = 8,
+        batch_size: int = 8,
+        max_retries: int = 6,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.embeddings = embeddings
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = AdaptiveLimiter(max_workers)
+        self.stats = EmbeddingStats()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="embedding"
+                )
+            return self._executor
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+            except Exception as error:
+                throttled = is_throttling_error(error)
+                self.limiter.release(throttled=throttled)
+                if attempt == self.max_retries:
+                    raise
+                with self._stats_lock:
+                    self.stats.retries += 1
+                    self.stats.throttles += int(throttled)
+                delay = self._backoff(attempt)
+                logger.warning(
+                    f"Embedding batch failed ({'throttled' if throttled else error}), "
+                    f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s"
+                )
+                time.sleep(delay)
+            else:
+                self.limiter.release()
+                return vectors
+
+    def embed(
+        self,
+        texts: list[str],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+    ) -> list[list[float]]:
+        """
+        Embeds `texts`, returning vectors in the same order.
+
+        Args:
+            texts (list[str]): The texts to embed.
+            on_progress (Callable[[int, int], None]): Optional callback called
+                with the number of embedded texts and the total after each batch.
+        """
+
+        vectors: list[Optional[list[float]]] = [None] * len(texts)
+        executor = self._pool()
+        futures = {
+            executor.submit(
+                self._embed_batch, texts[start : start + self.batch_size]
+            ): start
+            for start in range(0, len(texts), self.batch_size)
+        }
+        done = 0
+        try:
+            for future in as_completed(futures):
+                start = futures[future]
+                batch = future.result()
+                vectors[start : start + len(batch)] = batch
+                done += len(batch)
+                if on_progress is not None:
+                    on_progress(done, len(texts))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        with self._stats_lock:
+            self.stats.texts += len(texts)
+            self.stats.batches += len(futures)
+        return vectors
+
+    def shutdown(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+from loguru import logger
+
+from models.numpy_vector_store import RESCORE_FACTOR, NumpyVectorStore
+from models.vector_store import VectorPrecision
+
+FAISS_INDEX = "HNSW32"
+FAISS_INDEX_FILE = "faiss.index"
+FAISS_EF_SEARCH = 64
+FAISS_NPROBE = 16
+# Below this many vectors, exact search is as fast as any index and IVF
+# indexes cannot be trained.
+FAISS_MIN_VECTORS = 10_000
+
+
+class FaissVectorStore(NumpyVectorStore):
+    """
+    `NumpyVectorStore` with unfiltered searches answered by a FAISS index,
+    such as `HNSW32` or `IVF1024,PQ64`. Rows are stored as in the NumPy
+    store; the index is built from them on first use, extended when rows
+    are appended, rebuilt after deletes or overwrites, and saved next to
+    them by `persist`. The `rescore_factor * k` candidates the index returns
+    are re-ranked by their exact distances, which recovers most of the
+    recall lost by compressed indexes such as PQ. Filtered searches and
+    stores smaller than `FAISS_MIN_VECTORS` use exact search.
+
+    Requires the optional `faiss-cpu` package.
+
+    Args:
+        path (str): Directory of the persisted store.
+        index_factory (str): FAISS index factory string.
+        ef_search (int): HNSW candidate list size at query time.
+        nprobe (int): IVF lists searched per query.
+        precision (VectorPrecision): How the rows themselves are held.
+        rescore_factor (int): Candidates re-scored per result.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        index_factory: str = FAISS_INDEX,
+        ef_search: int = FAISS_EF_SEARCH,
+        nprobe: int = FAISS_NPROBE,
+        precision: VectorPrecision = VectorPrecision.FLOAT32,
+        rescore_factor: int = RESCORE_FACTOR,
+    ):
+        try:
+            import faiss
+        except ImportError as error:
+            raise ImportError(
+                "The faiss vector backend requires faiss-cpu: pip install faiss-cpu"
+            ) from error
+
+        self._faiss = faiss
+        self.index_factory = index_factory
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self._index = None
+        self._indexed_rows = 0
+        self._index_saved = False
+        super().__init__(path, precision=precision, rescore_factor=rescore_factor)
+        self.index_path = os.path.join(path, FAISS_INDEX_FILE)
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        index = self._faiss.read_index(self.index_path)
+        # An index saved before the rows were last rewritten is stale.
+        if index.ntotal == self.count():
+            self._configure(index)
+            self._index, self._indexed_rows = index, index.ntotal
+            self._index_saved = True
+
+    @property
+    def nbytes(self) -> int:
+        # Serializing is the only size measure all index types provide.
+        index_bytes = (
+            0
+            if self._index is None
+            else self._faiss.serialize_index(self._index).nbytes
+        )
+        return super().nbytes + index_bytes
+
+    def _configure(self, index):
+        ivf = self._faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = self.nprobe
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = self.ef_search
+
+    def _rows_changed(self, first_row: int):
+        super()._rows_changed(first_row)
+        if first_row < self._indexed_rows:
+            self._index, self._indexed_rows = None, 0
+
+    def _rewrite(self):
+        # Rewriting replaces the store directory, saved index included.
+        super()._rewrite()
+        self._index_saved = False
+
+    def ann_index(self):
+        """
+        Returns the FAISS index over all rows, building or extending it as
+        needed, or None while the store is too small for one.
+        """
+
+        with self._lock:
+            if self.count() < FAISS_MIN_VECTORS:
+                return None
+            if self._index is None:
+                index = self._faiss.index_factory(
+                    self._vectors.shape[1], self.index_factory, self._faiss.METRIC_L2
+                )
+                if not index.is_trained:
+                    index.train(self.full_vectors(np.arange(self.count())))
+                self._configure(index)
+                self._index, self._indexed_rows = index, 0
+            if self._indexed_rows < self.count():
+                self._index.add(
+                    self.full_vectors(np.arange(self._indexed_rows, self.count()))
+                )
+                self._indexed_rows = self.count()
+                self._index_saved = False
+            return self._index
+
+    def search_batch(self, embeddings, k, where=None):
+        queries = np.asarray(embeddings, dtype=np.float32)
+        # The lock is held from the index search until its rows are mapped
+        # to documents, as rows deleted or overwritten in between would map
+        # to other chunks, and an index rebuilt in between to other rows.
+        with self._lock:
+            index = None if where else self.ann_index()
+            if index is None:
+                return super().search_batch(queries, k, where)
+            _distances, candidates = index.search(queries, k * self.rescore_factor)
+            results = []
+            for query, rows in zip(queries, candidates):
+                # FAISS pads with -1 when fewer candidates are found.
+                rows = rows[(rows >= 0) & (rows < self.count())]
+                results.append(
+                    [
+                        (self._document(row), distance)
+                        for row, distance in self.rescore(query, rows, k)
+                    ]
+                )
+            return results
+
+    def persist(self):
+        super().persist()
+        index = self.ann_index()
+        if index is None or self._index_saved:
+            return
+        tmp_path = f"{self.index_path}.tmp"
+        self._faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        self._index_saved = True
+        logger.debug(f"Saved FAISS index of {index.ntotal} vectors")
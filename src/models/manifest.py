@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Optional
+
+MANIFEST_FILE = "manifest.json"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+@dataclass
+class FileRecord:
+    sha256: str
+    size: int
+    mtime: float
+    chunk_ids: list[str] = field(default_factory=list)
+
+
+@dataclass
+class ManifestPlan:
+    new: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    records: dict[str, FileRecord] = field(default_factory=dict)
+
+    @property
+    def to_ingest(self) -> list[str]:
+        return sorted(self.new + self.changed)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_under(path: str, root: str) -> bool:
+    path, root = os.path.abspath(path), os.path.abspath(root)
+    return path == root or os.path.commonpath([path, root]) == root
+
+
+class FileManifest:
+    """
+    Records the content hash, size, mtime and produced chunk IDs of every
+    ingested source file, persisted as JSON inside the Chroma
+    `persist_directory` so that `--clear` resets both together.
+    """
+
+    def __init__(self, path: str, files: Optional[dict[str, FileRecord]] = None):
+        self.path = path
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, directory: str) -> "FileManifest":
+        path = os.path.join(directory, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            data = json.load(f)
+        return cls(
+            path, {source: FileRecord(**record) for source, record in data.items()}
+        )
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({source: asdict(r) for source, r in self.files.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def plan(
+        self, file_paths: Iterable[str], root: Optional[str] = None
+    ) -> ManifestPlan:
+        """
+        Compares `file_paths` against the manifest. Files whose size and
+        mtime match their record are trusted without hashing; the rest are
+        hashed, so a touched but identical file is still unchanged.
+
+        Recorded files missing from `file_paths` are removed only if they
+        lie under `root`, the directory `file_paths` were listed from, so
+        ingesting another directory into the same store keeps the files
+        ingested from elsewhere. Without a `root` nothing is removed.
+        """
+
+        plan = ManifestPlan()
+        seen = set()
+        for path in file_paths:
+            seen.add(path)
+            stat = os.stat(path)
+            record = self.files.get(path)
+            if (
+                record is not None
+                and record.size == stat.st_size
+                and record.mtime == stat.st_mtime
+            ):
+                plan.unchanged.append(path)
+                continue
+
+            sha256 = file_sha256(path)
+            if record is not None and record.sha256 == sha256:
+                record.mtime = stat.st_mtime
+                plan.unchanged.append(path)
+                continue
+
+            plan.records[path] = FileRecord(
+                sha256=sha256, size=stat.st_size, mtime=stat.st_mtime
+            )
+            if record is None:
+                plan.new.append(path)
+            else:
+                plan.changed.append(path)
+
+        if root is not None:
+            plan.removed = [
+                path for path in self.files if path not in seen and is_under(path, root)
+            ]
+        return plan
+
+    def stale_chunk_ids(self, plan: ManifestPlan) -> list[str]:
+        """
+        Returns the chunk IDs of changed and removed files that no other
+        recorded file still references.
+        """
+
+        stale_paths = set(plan.changed + plan.removed)
+        if not stale_paths:
+            return []
+        kept_ids = {
+            chunk_id
+            for path, record in self.files.items()
+            if path not in stale_paths
+            for chunk_id in record.chunk_ids
+        }
+        return list(
+            dict.fromkeys(
+                chunk_id
+                for path in plan.changed + plan.removed
+                for chunk_id in self.files[path].chunk_ids
+                if chunk_id not in kept_ids
+            )
+        )
+
+    def forget(self, paths: Iterable[str]):
+        for path in paths:
+            self.files.pop(path, None)
+
+    def record(self, path: str, record: FileRecord, chunk_ids: list[str]):
+        record.chunk_ids = chunk_ids
+        self.files[path] = record
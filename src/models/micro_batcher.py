@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Generic, Optional, TypeVar
+
+from loguru import logger
+
+MICRO_BATCH_WINDOW = 0.005
+MICRO_BATCH_SIZE = 32
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class MicroBatchStats:
+    batches: int = 0
+    items: int = 0
+    failed_batches: int = 0
+    # Number of batches of each size.
+    batch_sizes: dict = field(default_factory=dict)
+    queued_seconds: float = 0.0
+    max_queued_seconds: float = 0.0
+    process_seconds: float = 0.0
+    max_process_seconds: float = 0.0
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects the items submitted by concurrent callers within `window`
+    seconds of the first one, up to `max_batch_size` of them, and passes
+    them to `process` in one call on a thread of its own. Each caller waits
+    for, and gets back, the result at its own position. Items that arrive
+    while a batch is processed join the next one, so batches grow with the
+    load and a lone caller waits one window at most.
+
+    Args:
+        process (Callable[[list[T]], list[R]]): Returns one result per item,
+            in order. A result that is an exception is raised to its caller
+            instead, and an exception raised by `process` to every caller
+            of the batch.
+        window (float): Seconds a batch stays open after its first item.
+        max_batch_size (int): Items from which a batch is processed at once.
+        name (str): Name of the batching thread.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[list[T]], list[R]],
+        window: float = MICRO_BATCH_WINDOW,
+        max_batch_size: int = MICRO_BATCH_SIZE,
+        name: str = "micro-batch",
+    ):
+        self.process = process
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.stats = MicroBatchStats()
+        self._lock = threading.Lock()
+        self._items: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: T) -> R:
+        """
+        Adds `item` to the open batch and returns its result once the batch
+        is processed.
+        """
+
+        future: Future = Future()
+        self._items.put((item, future, time.perf_counter()))
+        return future.result()
+
+    def _collect(self) -> Optional[list]:
+        first = self._items.get()
+        if first is None:
+            return None
+        batch = [first]
+        closes = first[2] + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = closes - time.perf_counter()
+            try:
+                entry = (
+                    self._items.get(timeout=remaining)
+                    if remaining > 0
+                    else self._items.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if entry is None:
+                # Stop once this batch is processed.
+                self._items.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            try:
+                results = self.process([item for item, _future, _queued in batch])
+            except Exception as error:
+                logger.exception(f"Micro-batch of {len(batch)} items failed")
+                results, failed = [error] * len(batch), True
+            else:
+                failed = False
+            process_seconds = time.perf_counter() - started
+            for (_item, future, _queued), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            queued = [started - queued for _item, _future, queued in batch]
+            with self._lock:
+                stats = self.stats
+                stats.batches += 1
+                stats.items += len(batch)
+                stats.failed_batches += int(failed)
+                stats.batch_sizes[len(batch)] = stats.batch_sizes.get(len(batch), 0) + 1
+                stats.queued_seconds += sum(queued)
+                stats.max_queued_seconds = max(stats.max_queued_seconds, *queued)
+                stats.process_seconds += process_seconds
+                stats.max_process_seconds = max(
+                    stats.max_process_seconds, process_seconds
+                )
+
+    def close(self):
+        """
+        Stops the batching thread once the items already submitted are
+        processed.
+        """
+
+        self._items.put(None)
+        self._thread.join()
@@ -0,0 +1,61 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# Weight of relevance against novelty: 1 ranks by relevance alone.
+MMR_LAMBDA = 0.5
+# Candidates searched for MMR to choose from: this many, or twice k if more.
+MMR_CANDIDATES = 20
+MMR_FETCH_FACTOR = 2
+
+
+@dataclass
+class MMRStats:
+    selections: int = 0
+    candidates: int = 0
+    fetch_seconds: float = 0.0
+    select_seconds: float = 0.0
+    max_select_seconds: float = 0.0
+
+
+def maximal_marginal_relevance(
+    query: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_mult: float = MMR_LAMBDA,
+    relevance: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Returns the positions of `k` of `embeddings`, in selection order, each
+    maximizing `lambda_mult * relevance - (1 - lambda_mult) * redundancy`,
+    where redundancy is the highest cosine similarity to a chunk already
+    selected. Relevance defaults to the cosine similarity to `query`.
+
+    The similarities between candidates are computed up front as one matrix
+    product, so each selection step is a few operations on vectors of
+    candidate length.
+    """
+
+    k = min(k, len(embeddings))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    similarities = embeddings @ embeddings.T
+    norms = np.sqrt(np.diagonal(similarities))
+    norms = np.where(norms == 0, 1, norms).astype(np.float32)
+    similarities /= np.outer(norms, norms)
+    if relevance is None:
+        relevance = (embeddings @ query) / (norms * (np.linalg.norm(query) or 1))
+    relevance = lambda_mult * np.asarray(relevance, dtype=np.float32)
+    selected = np.empty(k, dtype=np.int64)
+    redundancy = np.full(len(embeddings), -np.inf, dtype=np.float32)
+    scores = relevance.copy()
+    for i in range(k):
+        row = selected[i] = np.argmax(scores)
+        if i == k - 1:
+            break
+        np.maximum(redundancy, similarities[row], out=redundancy)
+        np.multiply(redundancy, lambda_mult - 1, out=scores)
+        scores += relevance
+        scores[selected[: i + 1]] = -np.inf
+    return selected
@@ -0,0 +1,539 @@
+import json
+import os
+import shutil
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+from langchain.schema.document import Document
+
+from models.vector_store import ID_PAGE_SIZE, VectorPrecision, VectorStore
+
+NUMPY_STORE_DIR = "numpy_store"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.jsonl"
+MIN_CAPACITY = 1024
+# Candidates re-scored in full precision per result, for quantized vectors.
+RESCORE_FACTOR = 4
+# Quantized rows are widened to float32 this many at a time, so each block
+# stays in cache for its matrix-vector product.
+SCAN_BLOCK_ROWS = 512
+DTYPES = {
+    VectorPrecision.FLOAT32: np.float32,
+    VectorPrecision.FLOAT16: np.float16,
+    VectorPrecision.INT8: np.int8,
+}
+
+
+def top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the positions of the `k` smallest distances, smallest first.
+    """
+
+    k = min(k, len(distances))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(distances, k - 1)[:k]
+    return top[np.argsort(distances[top])]
+
+
+def quantize(
+    vectors: np.ndarray, precision: VectorPrecision
+) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Returns `vectors` stored with `precision`, and for int8 the per-vector
+    scale that maps them back: each vector is divided by its largest
+    absolute component over 127 and rounded.
+    """
+
+    if precision != VectorPrecision.INT8:
+        return vectors.astype(DTYPES[precision]), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.rint(vectors / scales[:, None]).astype(np.int8), scales
+
+
+def metadata_column(metadatas: Iterable[dict], key: str) -> tuple[dict, np.ndarray]:
+    """
+    Codes the `key` values of `metadatas` as integers: returns the code of
+    each value and the code of each row, -1 where the key is missing.
+    """
+
+    codes: dict = {}
+    column = np.array(
+        [
+            codes.setdefault(metadata[key], len(codes)) if key in metadata else -1
+            for metadata in metadatas
+        ],
+        dtype=np.int32,
+    )
+    return codes, column
+
+
+def where_mask(
+    where: dict, count: int, column: Callable[[str], tuple[dict, np.ndarray]]
+) -> np.ndarray:
+    """
+    Evaluates a Chroma `where` filter over `count` rows, given a function
+    that returns the coded metadata column of a key.
+    """
+
+    mask = np.ones(count, dtype=bool)
+    for key, condition in where.items():
+        if key == "$and":
+            for part in condition:
+                mask &= where_mask(part, count, column)
+            continue
+        if key == "$or":
+            matched = np.zeros(count, dtype=bool)
+            for part in condition:
+                matched |= where_mask(part, count, column)
+            mask &= matched
+            continue
+        codes, values = column(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, value in condition.items():
+            if operator in ("$eq", "$ne"):
+                matched = values == codes.get(value, -2)
+            elif operator in ("$in", "$nin"):
+                matched = np.isin(values, [codes.get(item, -2) for item in value])
+            else:
+                raise ValueError(f"Unsupported where operator: {operator}")
+            mask &= ~matched if operator in ("$ne", "$nin") else matched
+    return mask
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Exact search over all vectors held in one matrix, with their squared
+    norms kept alongside so a query costs a single matrix-vector product.
+    Metadata filters are evaluated on integer-coded metadata columns, built
+    on the first filtered search after a write.
+
+    With float16 or int8 `precision`, the matrix is quantized to a half or
+    a quarter of the float32 size and the `rescore_factor * k` nearest rows
+    it finds are re-ranked by their exact distances. The full-precision
+    vectors stay in the persisted vectors file, memory-mapped, so only the
+    pages of those candidates are read; rows not persisted yet are kept in
+    memory until `persist`.
+
+    Rows are kept contiguous: new IDs are appended and a deleted row is
+    filled with the last one. On disk, vectors are a flat float32 file and
+    texts and metadata a JSON Lines file in row order. `persist` appends
+    the rows added since the last call and only rewrites the files after
+    deletes or overwrites.
+
+    Args:
+        path (str): Directory of the persisted store.
+        precision (VectorPrecision): How the searched vectors are held.
+        rescore_factor (int): Candidates re-scored per result with quantized
+            vectors.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        precision: VectorPrecision = VectorPrecision.FLOAT32,
+        rescore_factor: int = RESCORE_FACTOR,
+    ):
+        self.path = path
+        self.precision = VectorPrecision(precision)
+        self.quantized = self.precision != VectorPrecision.FLOAT32
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+        self._ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._documents: list[str] = []
+        self._metadatas: list[dict] = []
+        self._vectors: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._sq_norms: Optional[np.ndarray] = None
+        # Full-precision vectors of quantized stores: the persisted file, and
+        # the rows that differ from it.
+        self._saved_vectors: Optional[np.ndarray] = None
+        self._unsaved: dict[int, np.ndarray] = {}
+        self._columns: dict[str, tuple[dict, np.ndarray]] = {}
+        # Leading rows whose contents match the files on disk.
+        self._saved_rows = 0
+        self._clean_rows = 0
+        self._records_bytes = 0
+        self._load()
+
+    def count(self) -> int:
+        return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the searched vectors of all rows, with their norms
+        and scales.
+        """
+
+        if self._vectors is None:
+            return 0
+        row_bytes = self._vectors.itemsize * self._vectors.shape[1] + 4
+        if self.precision == VectorPrecision.INT8:
+            row_bytes += 4
+        return self.count() * row_bytes
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        count, dimensions = meta["count"], meta["dimensions"]
+        self._reserve(count, dimensions)
+        self._saved_rows = count
+        saved_vectors = self._map_saved_vectors(dimensions)
+        for start in range(0, count, SCAN_BLOCK_ROWS):
+            end = min(start + SCAN_BLOCK_ROWS, count)
+            self._store_rows(np.arange(start, end), np.array(saved_vectors[start:end]))
+            self._unsaved.clear()
+        if self.quantized:
+            self._saved_vectors = saved_vectors
+        # Only the bytes recorded in meta.json are read, so a write that was
+        # interrupted before meta.json was updated is ignored.
+        with open(os.path.join(self.path, RECORDS_FILE), "rb") as f:
+            lines = f.read(meta["records_bytes"]).splitlines()
+        for row, line in enumerate(lines):
+            record = json.loads(line)
+            self._ids.append(record["id"])
+            self._rows[record["id"]] = row
+            self._documents.append(record["document"])
+            self._metadatas.append(record["metadata"])
+        self._clean_rows = count
+        self._records_bytes = meta["records_bytes"]
+
+    def _map_saved_vectors(self, dimensions: int) -> Optional[np.ndarray]:
+        if not self._saved_rows:
+            return None
+        return np.memmap(
+            os.path.join(self.path, VECTORS_FILE),
+            dtype=np.float32,
+            mode="r",
+            shape=(self._saved_rows, dimensions),
+        )
+
+    def _reserve(self, count: int, dimensions: int):
+        if self._vectors is not None and self._vectors.shape[1] != dimensions:
+            raise ValueError(
+                f"Expected {self._vectors.shape[1]}-dimensional embeddings, "
+                f"got {dimensions}"
+            )
+        capacity = 0 if self._vectors is None else len(self._vectors)
+        if self._vectors is not None and count <= capacity:
+            return
+        # Capacity doubles so appending n rows copies O(n) data overall.
+        capacity = max(MIN_CAPACITY, count, 2 * capacity)
+        vectors = np.zeros((capacity, dimensions), dtype=DTYPES[self.precision])
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        scales = np.ones(capacity, dtype=np.float32)
+        if self._vectors is not None:
+            vectors[: self.count()] = self._vectors[: self.count()]
+            sq_norms[: self.count()] = self._sq_norms[: self.count()]
+            scales[: self.count()] = self._scales[: self.count()]
+        self._vectors, self._sq_norms, self._scales = vectors, sq_norms, scales
+
+    def _store_rows(self, rows: np.ndarray, vectors: np.ndarray):
+        self._sq_norms[rows] = np.einsum("ij,ij->i", vectors, vectors)
+        if not self.quantized:
+            self._vectors[rows] = vectors
+            return
+        self._vectors[rows], scales = quantize(vectors, self.precision)
+        if scales is not None:
+            self._scales[rows] = scales
+        self._unsaved.update(zip(rows.tolist(), vectors))
+
+    def full_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the float32 vectors of `rows`.
+        """
+
+        if not self.quantized:
+            return self._vectors[rows]
+        vectors = np.empty((len(rows), self._vectors.shape[1]), dtype=np.float32)
+        unsaved = np.array([row in self._unsaved for row in rows.tolist()], bool)
+        if not unsaved.all():
+            vectors[~unsaved] = self._saved_vectors[rows[~unsaved]]
+        for i in np.flatnonzero(unsaved):
+            vectors[i] = self._unsaved[int(rows[i])]
+        return vectors
+
+    def _rows_changed(self, first_row: int):
+        """
+        Called when rows from `first_row` on were overwritten or removed.
+        """
+
+        self._clean_rows = min(self._clean_rows, first_row)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        if not ids:
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            self._reserve(self.count() + len(ids), embeddings.shape[1])
+            rows = []
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                row = self._rows.get(chunk_id)
+                if row is None:
+                    row = self._rows[chunk_id] = self.count()
+                    self._ids.append(chunk_id)
+                    self._documents.append(document)
+                    self._metadatas.append(dict(metadata))
+                else:
+                    self._documents[row] = document
+                    self._metadatas[row] = dict(metadata)
+                    self._rows_changed(row)
+                rows.append(row)
+            # With repeated IDs, the last embedding given wins, as in Chroma.
+            self._store_rows(np.array(rows), embeddings)
+            self._columns.clear()
+
+    def delete(self, ids):
+        with self._lock:
+            rows = sorted(
+                (
+                    self._rows[chunk_id]
+                    for chunk_id in set(ids)
+                    if chunk_id in self._rows
+                ),
+                reverse=True,
+            )
+            # Deleting from the highest row down means the last row is never
+            # one that is still waiting to be deleted.
+            for row in rows:
+                last = self.count() - 1
+                del self._rows[self._ids[row]]
+                if row != last:
+                    self._ids[row] = self._ids[last]
+                    self._rows[self._ids[row]] = row
+                    self._documents[row] = self._documents[last]
+                    self._metadatas[row] = self._metadatas[last]
+                    self._vectors[row] = self._vectors[last]
+                    self._sq_norms[row] = self._sq_norms[last]
+                    self._scales[row] = self._scales[last]
+                    if self.quantized:
+                        self._unsaved[row] = self.full_vectors(np.array([last]))[0]
+                self._unsaved.pop(last, None)
+                self._ids.pop()
+                self._documents.pop()
+                self._metadatas.pop()
+                self._rows_changed(row)
+            if rows:
+                self._columns.clear()
+
+    def _document(self, row: int) -> Document:
+        return Document(
+            page_content=self._documents[row], metadata=dict(self._metadatas[row])
+        )
+
+    def get(self, ids):
+        with self._lock:
+            return [
+                self._document(self._rows[chunk_id])
+                for chunk_id in ids
+                if chunk_id in self._rows
+            ]
+
+    def get_embeddings(self, ids):
+        with self._lock:
+            rows = np.array([self._rows[chunk_id] for chunk_id in ids], dtype=np.int64)
+            return self.full_vectors(rows)
+
+    def existing_ids(self, ids: Iterable[str]) -> set[str]:
+        with self._lock:
+            return {chunk_id for chunk_id in ids if chunk_id in self._rows}
+
+    def iter_ids(self, page_size: int = ID_PAGE_SIZE) -> Iterator[list[str]]:
+        for start in range(0, self.count(), page_size):
+            with self._lock:
+                page = self._ids[start : start + page_size]
+            if page:
+                yield page
+
+    def iter_documents(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[str, str]]:
+        for start in range(0, self.count(), page_size):
+            with self._lock:
+                page = list(
+                    zip(
+                        self._ids[start : start + page_size],
+                        self._documents[start : start + page_size],
+                    )
+                )
+            yield from page
+
+    def iter_records(self, page_size: int = ID_PAGE_SIZE):
+        for start in range(0, self.count(), page_size):
+            with self._lock:
+                end = min(start + page_size, self.count())
+                page = (
+                    self._ids[start:end],
+                    self.full_vectors(np.arange(start, end)),
+                    self._documents[start:end],
+                    [dict(metadata) for metadata in self._metadatas[start:end]],
+                )
+            yield page
+
+    def _column(self, key: str) -> tuple[dict, np.ndarray]:
+        if key not in self._columns:
+            self._columns[key] = metadata_column(self._metadatas, key)
+        return self._columns[key]
+
+    def _dot_products(self, queries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        vectors = self._vectors[rows]
+        if not self.quantized:
+            return queries @ vectors.T
+        dots = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        for start in range(0, len(vectors), SCAN_BLOCK_ROWS):
+            block = vectors[start : start + SCAN_BLOCK_ROWS]
+            dots[:, start : start + SCAN_BLOCK_ROWS] = (
+                queries @ block.astype(np.float32).T
+            )
+        if self.precision == VectorPrecision.INT8:
+            dots *= self._scales[rows]
+        return dots
+
+    def rescore(
+        self, query: np.ndarray, rows: np.ndarray, k: int
+    ) -> list[tuple[int, float]]:
+        """
+        Returns the `k` of `rows` nearest to `query` by exact distance, as
+        `(row, distance)` pairs, nearest first.
+        """
+
+        distances = (
+            self._sq_norms[rows] - 2 * (self.full_vectors(rows) @ query) + query @ query
+        )
+        top = top_k(distances, k)
+        return [(int(rows[i]), float(distances[i])) for i in top]
+
+    def _scan(
+        self, queries: np.ndarray, k: int, rows: Optional[np.ndarray]
+    ) -> list[list[tuple[int, float]]]:
+        all_rows = rows is None
+        if all_rows:
+            rows = slice(0, self.count())
+        # Each query's own squared norm is the same for every row, so it is
+        # only added to the distances returned.
+        distances = self._sq_norms[rows] - 2 * self._dot_products(queries, rows)
+        found = []
+        for query, query_distances in zip(queries, distances):
+            if self.quantized:
+                top = top_k(query_distances, k * self.rescore_factor)
+                found.append(self.rescore(query, top if all_rows else rows[top], k))
+                continue
+            top = top_k(query_distances, k)
+            found.append(
+                [
+                    (int(row), float(query_distances[i] + query @ query))
+                    for row, i in zip(top if all_rows else rows[top], top)
+                ]
+            )
+        return found
+
+    def search(self, embedding, k, where=None):
+        return self.search_batch(
+            np.asarray(embedding, dtype=np.float32)[None, :], k, where
+        )[0]
+
+    def search_batch(self, embeddings, k, where=None):
+        queries = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            if not self.count():
+                return [[] for _query in queries]
+            rows = (
+                np.flatnonzero(where_mask(where, self.count(), self._column))
+                if where
+                else None
+            )
+            return [
+                [(self._document(row), distance) for row, distance in found]
+                for found in self._scan(queries, k, rows)
+            ]
+
+    def persist(self):
+        with self._lock:
+            if self._vectors is None:
+                return
+            if self._clean_rows < self._saved_rows:
+                self._rewrite()
+            elif self._saved_rows < self.count():
+                self._append()
+
+    def _write_meta(self, directory: str):
+        tmp_path = os.path.join(directory, f"{META_FILE}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "count": self.count(),
+                    "dimensions": self._vectors.shape[1],
+                    "records_bytes": self._records_bytes,
+                },
+                f,
+            )
+        os.replace(tmp_path, os.path.join(directory, META_FILE))
+        self._saved_rows = self._clean_rows = self.count()
+
+    def _write_vectors(self, f, start: int):
+        for block_start in range(start, self.count(), SCAN_BLOCK_ROWS):
+            block_end = min(block_start + SCAN_BLOCK_ROWS, self.count())
+            f.write(self.full_vectors(np.arange(block_start, block_end)).tobytes())
+
+    def _saved(self):
+        # Every row now matches the vectors file.
+        if self.quantized:
+            self._saved_vectors = self._map_saved_vectors(self._vectors.shape[1])
+        self._unsaved.clear()
+
+    def _record_lines(self, start: int) -> bytes:
+        return b"".join(
+            json.dumps(
+                {
+                    "id": self._ids[row],
+                    "document": self._documents[row],
+                    "metadata": self._metadatas[row],
+                }
+            ).encode()
+            + b"\n"
+            for row in range(start, self.count())
+        )
+
+    def _append(self):
+        os.makedirs(self.path, exist_ok=True)
+        dimensions = self._vectors.shape[1]
+        records = self._record_lines(self._saved_rows)
+        # Anything past the recorded sizes is left over from an interrupted
+        # write and is truncated before appending.
+        with open(os.path.join(self.path, VECTORS_FILE), "ab") as f:
+            f.truncate(self._saved_rows * dimensions * 4)
+            self._write_vectors(f, self._saved_rows)
+        with open(os.path.join(self.path, RECORDS_FILE), "ab") as f:
+            f.truncate(self._records_bytes)
+            f.write(records)
+        self._records_bytes += len(records)
+        self._write_meta(self.path)
+        self._saved()
+
+    def _rewrite(self):
+        tmp_directory = f"{self.path}.tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        with open(os.path.join(tmp_directory, VECTORS_FILE), "wb") as f:
+            self._write_vectors(f, 0)
+        records = self._record_lines(0)
+        with open(os.path.join(tmp_directory, RECORDS_FILE), "wb") as f:
+            f.write(records)
+        self._records_bytes = len(records)
+        self._write_meta(tmp_directory)
+        old_directory = f"{self.path}.old"
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old_directory)
+        os.replace(tmp_directory, self.path)
+        shutil.rmtree(old_directory, ignore_errors=True)
+        self._saved()
@@ -0,0 +1,159 @@
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from loguru import logger
+
+from models.embedding_cache import text_hash
+
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_TTL = 3600.0
+REDIS_KEY_PREFIX = "query-embedding:"
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+@dataclass
+class QueryCacheStats:
+    hits: int = 0
+    shared_hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+
+
+class RedisQueryCacheBackend:
+    """
+    Stores query embeddings in Redis as float32 blobs with a TTL, so every
+    API worker pointed at the same Redis shares one cache. Needs the
+    optional `redis` package.
+
+    Args:
+        url (str): Redis URL, such as `redis://localhost:6379/0`.
+        prefix (str): Prefix of every key written.
+    """
+
+    def __init__(self, url: str, prefix: str = REDIS_KEY_PREFIX):
+        try:
+            import redis
+        except ImportError as error:
+            raise ImportError(
+                "A shared query cache needs the redis package: pip install redis"
+            ) from error
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[list[float]]:
+        blob = self.client.get(self.prefix + key)
+        return None if blob is None else array("f", blob).tolist()
+
+    def set(self, key: str, vector: list[float], ttl: float):
+        self.client.set(
+            self.prefix + key, array("f", vector).tobytes(), ex=max(1, int(ttl))
+        )
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings whose entries expire after
+    `ttl` seconds, keyed by the embedding `model_id` and the normalized
+    query text. With a `shared` backend, local misses are looked up there
+    before the model is called, and new vectors are written to both. Errors
+    of the shared backend are logged and treated as misses.
+
+    Args:
+        max_entries (int): Maximum number of vectors kept in process.
+        ttl (float): Seconds a vector stays valid.
+        shared (RedisQueryCacheBackend): Optional cache shared by workers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = QUERY_CACHE_SIZE,
+        ttl: float = QUERY_CACHE_TTL,
+        shared: Optional[RedisQueryCacheBackend] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.stats = QueryCacheStats()
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get_local(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, vector = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.stats.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return vector
+
+    def _put_local(self, key: str, vector: list[float]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def _get_shared(self, key: str) -> Optional[list[float]]:
+        try:
+            return self.shared.get(key)
+        except Exception as error:
+            logger.warning(f"Shared query cache lookup failed: {error}")
+            return None
+
+    def _put_shared(self, key: str, vector: list[float]):
+        try:
+            self.shared.set(key, vector, self.ttl)
+        except Exception as error:
+            logger.warning(f"Shared query cache write failed: {error}")
+
+    def get_or_embed(
+        self, model_id: str, text: str, embed: Callable[[str], list[float]]
+    ) -> list[float]:
+        """
+        Returns the embedding of `text`, calling `embed` with it only when
+        no cache holds a live vector for its normalized form. The original
+        text is embedded, so case-sensitive terms such as tickers keep their
+        meaning; normalizing only decides which queries share a vector.
+        """
+
+        key = f"{model_id}:{text_hash(normalize_query(text))}"
+        vector = self._get_local(key)
+        if vector is not None:
+            return vector
+
+        if self.shared is not None:
+            vector = self._get_shared(key)
+            if vector is not None:
+                with self._lock:
+                    self.stats.shared_hits += 1
+                self._put_local(key, vector)
+                return vector
+
+        with self._lock:
+            self.stats.misses += 1
+        vector = embed(text)
+        self._put_local(key, vector)
+        if self.shared is not None:
+            self._put_shared(key, vector)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
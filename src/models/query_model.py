@@ -1,4 +1,7 @@
+import ast
 import os
+import random
+import threading
 import time
 import uuid
 from typing import List, Optional
@@ -13,6 +16,13 @@ from config import load_aws_client
 load_dotenv()
 
 TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME")  # Ensure you have this in your .env
+# Most items a BatchWriteItem request takes.
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_RETRIES = 8
+BATCH_WRITE_BASE_DELAY = 0.05
+
+_client = None
+_client_lock = threading.Lock()
 
 
 class QueryModel(BaseModel):
@@ -22,10 +32,18 @@ class QueryModel(BaseModel):
     answer_text: Optional[str] = None
     sources: List[str] = Field(default_factory=list)
     is_complete: bool = False
+    cached: bool = False
+    error: Optional[str] = None
 
     @classmethod
     def get_client(cls: "QueryModel") -> boto3.client:
-        return load_aws_client("dynamodb")
+        # Clients are thread-safe but creating them is neither cheap nor
+        # thread-safe, so every request shares one.
+        global _client
+        with _client_lock:
+            if _client is None:
+                _client = load_aws_client("dynamodb")
+            return _client
 
     @classmethod
     def describe_table(cls: "QueryModel"):
@@ -67,10 +85,61 @@ class QueryModel(BaseModel):
             print("ClientError", e.response["Error"]["Message"])
             raise e
 
+    @classmethod
+    def batch_put_items(cls: "QueryModel", queries: List["QueryModel"]):
+        """
+        Writes `queries` with BatchWriteItem, 25 to a request, retrying the
+        items DynamoDB leaves unprocessed with exponential backoff.
+        """
+
+        client = cls.get_client()
+        for start in range(0, len(queries), BATCH_WRITE_SIZE):
+            requests = {
+                TABLE_NAME: [
+                    {"PutRequest": {"Item": query.as_ddb_item()}}
+                    for query in queries[start : start + BATCH_WRITE_SIZE]
+                ]
+            }
+            for attempt in range(BATCH_WRITE_RETRIES + 1):
+                try:
+                    response = client.batch_write_item(RequestItems=requests)
+                except ClientError as e:
+                    print("ClientError", e.response["Error"]["Message"])
+                    raise e
+                requests = response.get("UnprocessedItems")
+                if not requests:
+                    break
+                if attempt == BATCH_WRITE_RETRIES:
+                    raise RuntimeError(
+                        f"{len(requests[TABLE_NAME])} items were left unprocessed"
+                    )
+                time.sleep(BATCH_WRITE_BASE_DELAY * 2**attempt * random.uniform(1, 2))
+
     def as_ddb_item(self):
-        item = {k: {"S": str(v)} for k, v in self.dict().items() if v is not None}
+        item = {
+            k: (
+                {"L": [{"S": str(value)} for value in v]}
+                if isinstance(v, list)
+                else {"S": str(v)}
+            )
+            for k, v in self.dict().items()
+            if v is not None
+        }
         return item
 
+    @classmethod
+    def from_ddb_item(cls: "QueryModel", item: dict) -> "QueryModel":
+        fields = {}
+        for k, v in item.items():
+            if "L" in v:
+                fields[k] = [value["S"] for value in v["L"]]
+            elif k == "sources":
+                # Items written before lists were stored as lists.
+                fields[k] = ast.literal_eval(v["S"])
+            else:
+                fields[k] = v["S"]
+        return cls(**fields)
+
     @classmethod
     def get_item(cls: "QueryModel", query_id: str) -> "QueryModel":
         try:
@@ -82,7 +151,6 @@ class QueryModel(BaseModel):
             return None
 
         if "Item" in response:
-            item = response["Item"]
-            return cls(**{k: v["S"] for k, v in item.items()})
+            return cls.from_ddb_item(response["Item"])
         else:
             return None
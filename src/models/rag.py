@@ -7,3 +7,6 @@ class QueryResponse:
     query_text: str
     response_text: str
     sources: List[str]
+    cached: bool = False
+    context_tokens: int = 0
+    context_tokens_saved: int = 0
@@ -0,0 +1,597 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Iterator, Optional, Union
+
+import numpy as np
+from botocore.config import Config
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema.document import Document
+from langchain_aws import ChatBedrock
+from loguru import logger
+
+from config import PROMPT_TEMPLATE, load_aws_client
+from models.answer_cache import (
+    ANSWER_CACHE_SIZE,
+    SIMILARITY_THRESHOLD,
+    SemanticAnswerCache,
+)
+from models.bm25_index import BM25_DIR, BM25Index, reciprocal_rank_fusion
+from models.chroma_database import ChromaDatabase
+from models.micro_batcher import MICRO_BATCH_SIZE, MICRO_BATCH_WINDOW, MicroBatcher
+from models.mmr import (
+    MMR_CANDIDATES,
+    MMR_FETCH_FACTOR,
+    MMR_LAMBDA,
+    MMRStats,
+    maximal_marginal_relevance,
+)
+from models.query_cache import (
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    QueryEmbeddingCache,
+    RedisQueryCacheBackend,
+)
+from models.rag import QueryResponse
+from models.source_aliases import SOURCE_ALIASES_FILE, SourceAliases
+from models.vector_store import VectorBackend, VectorPrecision
+from utils.context_builder import CONTEXT_TOKEN_BUDGET, BuiltContext, ContextBuilder
+from utils.document_loader import is_content_chunk_id
+from utils.metadata import QueryFilters, parse_query_filters
+
+CHROMA_PATH = "data/chroma"
+CHAT_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+TOP_K = 3
+MAX_POOL_CONNECTIONS = 50
+WARM_UP_QUERY = "Total revenue in Q1 2024?"
+HYBRID_CANDIDATES = 20
+
+
+class RetrievalMode(str, Enum):
+    VECTOR = "vector"
+    HYBRID = "hybrid"
+
+
+@dataclass
+class PreparedQuery:
+    query_text: str
+    embedding: list[float]
+    index_version: str
+    scope: str
+    sources: list[str]
+    prompt: str
+    context: BuiltContext
+
+
+class RagEngine:
+    """
+    Long-lived retrieval and generation stack. The Bedrock client, with its
+    pool of keep-alive connections, the open vector store, the prompt
+    template and the chat model are created once and shared by every query,
+    so a query only pays for embedding, search and generation. All of them
+    are thread-safe, so one engine serves concurrent requests.
+
+    Args:
+        chroma_path (str): The persisted Chroma directory.
+        model_id (str): The Bedrock chat model.
+        embedding_model_id (str): The Bedrock embedding model used at ingest.
+        embedding_cache_path (str): Optional on-disk embedding cache, off
+            by default so serving does not write to disk per query.
+        k (int): Number of chunks retrieved per query.
+        max_pool_connections (int): Size of the Bedrock connection pool.
+        bedrock_client: Optional `bedrock-runtime` client to reuse.
+        query_cache_size (int): Query embeddings cached in process; 0
+            disables the query embedding cache.
+        query_cache_ttl (float): Seconds a cached query embedding is used.
+        query_cache_url (str): Optional Redis URL of a query embedding cache
+            shared by all workers.
+        answer_cache_size (int): Answers kept by the semantic answer cache;
+            0 disables it.
+        answer_cache_threshold (float): Cosine similarity from which a new
+            query reuses the answer to a previous one.
+        retrieval_mode (RetrievalMode): Default retrieval mode. Hybrid
+            retrieval fuses vector and BM25 rankings with reciprocal rank
+            fusion, using the BM25 index built by `populate-database`.
+        metadata_filters (bool): Whether banks, document types, fiscal years
+            and quarters named in a query restrict the search to matching
+            chunks.
+        vector_backend (VectorBackend): The backend the store was populated
+            with.
+        vector_precision (VectorPrecision): How the NumPy and FAISS backends
+            hold vectors in memory.
+        mmr (bool): Whether to choose the `k` chunks among more candidates
+            with maximal marginal relevance, so overlapping neighbours of
+            one chunk do not fill the context.
+        mmr_lambda (float): MMR weight of relevance against novelty.
+        mmr_candidates (int): Minimum number of candidates MMR chooses from.
+        context_token_budget (int): Maximum length of the context sent to
+            the chat model, in tokens. Overlapping chunks of a page are
+            merged and repeated text removed before it is applied.
+        micro_batch (bool): Whether the vector searches of concurrent
+            queries are collected into batches and run as one matrix
+            product per batch.
+        micro_batch_window (float): Seconds a batch of searches stays open
+            after its first query.
+        micro_batch_size (int): Searches from which a batch runs at once.
+    """
+
+    def __init__(
+        self,
+        chroma_path: str = CHROMA_PATH,
+        model_id: str = CHAT_MODEL_ID,
+        embedding_model_id: str = EMBEDDING_MODEL_ID,
+        embedding_cache_path: Optional[str] = None,
+        k: int = TOP_K,
+        max_pool_connections: int = MAX_POOL_CONNECTIONS,
+        bedrock_client=None,
+        query_cache_size: int = QUERY_CACHE_SIZE,
+        query_cache_ttl: float = QUERY_CACHE_TTL,
+        query_cache_url: Optional[str] = None,
+        answer_cache_size: int = ANSWER_CACHE_SIZE,
+        answer_cache_threshold: float = SIMILARITY_THRESHOLD,
+        retrieval_mode: RetrievalMode = RetrievalMode.VECTOR,
+        metadata_filters: bool = True,
+        vector_backend: VectorBackend = VectorBackend.CHROMA,
+        vector_precision: VectorPrecision = VectorPrecision.FLOAT32,
+        mmr: bool = False,
+        mmr_lambda: float = MMR_LAMBDA,
+        mmr_candidates: int = MMR_CANDIDATES,
+        context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+        micro_batch: bool = False,
+        micro_batch_window: float = MICRO_BATCH_WINDOW,
+        micro_batch_size: int = MICRO_BATCH_SIZE,
+    ):
+        started = time.perf_counter()
+        self.k = k
+        self.mmr = mmr
+        self.mmr_lambda = mmr_lambda
+        self.mmr_candidates = mmr_candidates
+        self.mmr_stats = MMRStats()
+        self._mmr_lock = threading.Lock()
+        self.retrieval_mode = retrieval_mode
+        self.metadata_filters = metadata_filters
+        self.embedding_model_id = embedding_model_id
+        self.bedrock_client = bedrock_client or load_aws_client(
+            "bedrock-runtime",
+            config=Config(
+                max_pool_connections=max_pool_connections, tcp_keepalive=True
+            ),
+        )
+        self.chroma_db = ChromaDatabase(
+            chroma_path=chroma_path,
+            bedrock_client=self.bedrock_client,
+            model_id=embedding_model_id,
+            embedding_cache_path=embedding_cache_path,
+            vector_backend=vector_backend,
+            vector_precision=vector_precision,
+        )
+        self.query_cache = None
+        if query_cache_size > 0:
+            self.query_cache = QueryEmbeddingCache(
+                max_entries=query_cache_size,
+                ttl=query_cache_ttl,
+                shared=(
+                    RedisQueryCacheBackend(query_cache_url) if query_cache_url else None
+                ),
+            )
+        self.answer_cache = None
+        if answer_cache_size > 0:
+            self.answer_cache = SemanticAnswerCache(
+                threshold=answer_cache_threshold, max_entries=answer_cache_size
+            )
+        self.bm25_path = os.path.join(chroma_path, BM25_DIR)
+        self.chroma_path = chroma_path
+        self.source_aliases: Optional[SourceAliases] = None
+        self._aliases_lock = threading.Lock()
+        self.bm25: Optional[BM25Index] = None
+        self._bm25_checked_version: Optional[str] = None
+        self._bm25_lock = threading.Lock()
+        self.context_builder = ContextBuilder(token_budget=context_token_budget)
+        self.search_batcher = None
+        if micro_batch:
+            self.search_batcher = MicroBatcher(
+                self._search_batch,
+                window=micro_batch_window,
+                max_batch_size=micro_batch_size,
+                name="search-batch",
+            )
+        self.prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+        self.model = ChatBedrock(client=self.bedrock_client, model_id=model_id)
+        logger.info(f"RAG engine ready in {time.perf_counter() - started:.2f}s")
+
+    def warm_up(self):
+        """
+        Runs one retrieval so the vector index is loaded and a connection to
+        Bedrock is open before the first request. Failures are logged, not
+        raised, so a cold dependency does not stop the server from starting.
+        """
+
+        started = time.perf_counter()
+        try:
+            self.retrieve(WARM_UP_QUERY)
+        except Exception as error:
+            logger.warning(f"RAG engine warm-up failed: {error}")
+            return
+        logger.info(f"RAG engine warmed up in {time.perf_counter() - started:.2f}s")
+
+    def embed_query(self, query_text: str) -> list[float]:
+        if self.query_cache is None:
+            return self.chroma_db.embed_query(query_text)
+        return self.query_cache.get_or_embed(
+            self.embedding_model_id, query_text, self.chroma_db.embed_query
+        )
+
+    def lexical_index(self, index_version: str) -> Optional[BM25Index]:
+        """
+        Returns the BM25 index, reloading it when the vector store version
+        has changed since it was last checked.
+        """
+
+        with self._bm25_lock:
+            if index_version == self._bm25_checked_version:
+                return self.bm25
+            self._bm25_checked_version = index_version
+            saved_version = BM25Index.saved_version(self.bm25_path)
+            if saved_version is None:
+                self.bm25 = None
+            elif self.bm25 is None or self.bm25.index_version != saved_version:
+                self.bm25 = BM25Index.load(self.bm25_path)
+            if saved_version != index_version:
+                logger.warning(
+                    "The BM25 index does not match the vector store, "
+                    "run populate-database to rebuild it"
+                )
+            return self.bm25
+
+    def _aliases(self) -> Optional[SourceAliases]:
+        # Opened once ingestion has written the table, which a store
+        # populated before aliases existed does not have.
+        with self._aliases_lock:
+            if self.source_aliases is None and os.path.exists(
+                os.path.join(self.chroma_path, SOURCE_ALIASES_FILE)
+            ):
+                self.source_aliases = SourceAliases(self.chroma_path)
+            return self.source_aliases
+
+    def cite(
+        self, results: list[tuple[Document, float]]
+    ) -> tuple[list[tuple[Document, float]], list[str]]:
+        """
+        Returns `results` and the sources to cite for them: the ID of each
+        chunk, except for content-hash IDs, which say nothing about where a
+        chunk comes from. A content-hash chunk shared by several files is
+        stored once, under the first one ingested, which may since have been
+        removed, so it is cited by the `source:page` of every file the alias
+        table still finds it in, and its source is set to one of them.
+        """
+
+        chunk_ids = [doc.metadata.get("id") for doc, _score in results]
+        content_ids = [
+            chunk_id for chunk_id in chunk_ids if is_content_chunk_id(chunk_id)
+        ]
+        aliases = self._aliases() if content_ids else None
+        if aliases is None:
+            return results, chunk_ids
+        chunk_sources = aliases.sources_for(content_ids)
+        cited = []
+        sources: dict[str, None] = {}
+        for doc, score in results:
+            live = chunk_sources.get(doc.metadata.get("id"))
+            if not live:
+                sources[doc.metadata.get("id", None)] = None
+                cited.append((doc, score))
+                continue
+            sources.update(dict.fromkeys(live))
+            stored = f"{doc.metadata.get('source')}:{doc.metadata.get('page')}"
+            if stored not in live:
+                source, _colon, page = live[0].rpartition(":")
+                metadata = {**doc.metadata, "source": source}
+                metadata["page"] = int(page) if page.isdigit() else page
+                doc = Document(page_content=doc.page_content, metadata=metadata)
+            cited.append((doc, score))
+        return cited, list(sources)
+
+    def _search_batch(
+        self, searches: list[tuple[list[float], int, Optional[dict]]]
+    ) -> list[Union[list[tuple[Document, float]], Exception]]:
+        """
+        Runs the `(embedding, k, where)` searches of a micro-batch, those
+        with the same `k` and filter as one batched search.
+        """
+
+        groups: dict[str, list[int]] = {}
+        for position, (_embedding, k, where) in enumerate(searches):
+            key = f"{k}|{json.dumps(where, sort_keys=True)}"
+            groups.setdefault(key, []).append(position)
+        results: list = [None] * len(searches)
+        for positions in groups.values():
+            _embedding, k, where = searches[positions[0]]
+            embeddings = np.asarray(
+                [searches[position][0] for position in positions], dtype=np.float32
+            )
+            try:
+                found = self.chroma_db.search_batch(embeddings, k, where=where)
+            except Exception as error:
+                found = [error] * len(positions)
+            for position, position_results in zip(positions, found):
+                results[position] = position_results
+        return results
+
+    def _search(
+        self, embedding: list[float], k: int, where: Optional[dict] = None
+    ) -> list[tuple[Document, float]]:
+        if self.search_batcher is None:
+            return self.chroma_db.search(embedding, k, where=where)
+        return self.search_batcher.submit((embedding, k, where))
+
+    def _vector_search(
+        self, embedding: list[float], k: int, filters: Optional[QueryFilters]
+    ) -> list[tuple[Document, float]]:
+        where = filters.to_where() if filters else None
+        if where is None:
+            return self._search(embedding, k)
+        results = self._search(embedding, k, where=where)
+        if len(results) >= k:
+            return results
+        # Fewer than k chunks match when the query names something the
+        # corpus does not hold, or chunks lack a field, for instance because
+        # the store predates metadata extraction: the closest other chunks
+        # follow the matching ones.
+        found = {doc.metadata["id"] for doc, _score in results}
+        others = [
+            (doc, score)
+            for doc, score in self._search(embedding, k + len(results))
+            if doc.metadata["id"] not in found
+        ]
+        return results + others[: k - len(results)]
+
+    def _diversify(
+        self,
+        embedding: list[float],
+        results: list[tuple[Document, float]],
+        relevance: Optional[np.ndarray] = None,
+    ) -> list[tuple[Document, float]]:
+        """
+        Keeps `k` of `results` chosen with maximal marginal relevance, from
+        their stored embeddings.
+        """
+
+        if len(results) <= self.k:
+            return results
+        started = time.perf_counter()
+        embeddings = self.chroma_db.get_embeddings(
+            [doc.metadata["id"] for doc, _score in results]
+        )
+        fetched = time.perf_counter()
+        selected = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32),
+            embeddings,
+            self.k,
+            lambda_mult=self.mmr_lambda,
+            relevance=relevance,
+        )
+        select_seconds = time.perf_counter() - fetched
+        with self._mmr_lock:
+            stats = self.mmr_stats
+            stats.selections += 1
+            stats.candidates += len(results)
+            stats.fetch_seconds += fetched - started
+            stats.select_seconds += select_seconds
+            stats.max_select_seconds = max(stats.max_select_seconds, select_seconds)
+        logger.debug(
+            f"MMR chose {len(selected)} of {len(results)} candidates in "
+            f"{1000 * select_seconds:.2f}ms, after fetching their embeddings "
+            f"in {1000 * (fetched - started):.2f}ms"
+        )
+        return [results[i] for i in selected]
+
+    def _hybrid_search(
+        self,
+        query_text: str,
+        embedding: list[float],
+        index_version: str,
+        filters: Optional[QueryFilters],
+        k: int,
+    ) -> list[tuple[Document, float]]:
+        candidates = max(HYBRID_CANDIDATES, k)
+        vector_results = self._vector_search(embedding, candidates, filters)
+        bm25 = self.lexical_index(index_version)
+        if bm25 is None:
+            return vector_results[:k]
+
+        documents = {doc.metadata["id"]: doc for doc, _score in vector_results}
+        lexical_ids = [
+            chunk_id for chunk_id, _score in bm25.search(query_text, candidates)
+        ]
+        missing = [chunk_id for chunk_id in lexical_ids if chunk_id not in documents]
+        if missing:
+            documents.update(
+                (doc.metadata["id"], doc) for doc in self.chroma_db.get(missing)
+            )
+        lexical_ids = [
+            chunk_id
+            for chunk_id in lexical_ids
+            if chunk_id in documents
+            and (not filters or filters.matches(documents[chunk_id].metadata))
+        ]
+        fused = reciprocal_rank_fusion(
+            [[doc.metadata["id"] for doc, _score in vector_results], lexical_ids]
+        )
+        return [(documents[chunk_id], score) for chunk_id, score in fused[:k]]
+
+    def retrieve(
+        self,
+        query_text: str,
+        embedding: Optional[list[float]] = None,
+        mode: Optional[RetrievalMode] = None,
+        index_version: Optional[str] = None,
+        filters: Optional[QueryFilters] = None,
+    ) -> list[tuple[Document, float]]:
+        """
+        Returns the `k` best chunks for `query_text` with their scores: the
+        vector distance, or the fused rank score in hybrid mode. With
+        `filters`, only chunks matching them are searched, unless none do.
+        With MMR, they are chosen from a larger set of candidates.
+        """
+
+        if embedding is None:
+            embedding = self.embed_query(query_text)
+        k = self.k
+        if self.mmr:
+            k = max(self.mmr_candidates, MMR_FETCH_FACTOR * self.k)
+        if (mode or self.retrieval_mode) == RetrievalMode.HYBRID:
+            if index_version is None:
+                index_version = self.chroma_db.index_version()
+            results = self._hybrid_search(
+                query_text, embedding, index_version, filters, k
+            )
+            if not self.mmr:
+                return results
+            # Relevance is the fused rank rather than the vector similarity,
+            # so chunks found by keywords alone are not dropped.
+            relevance = np.linspace(1, 0, len(results), endpoint=False)
+            return self._diversify(embedding, results, relevance=relevance)
+        results = self._vector_search(embedding, k, filters)
+        return self._diversify(embedding, results) if self.mmr else results
+
+    def build_prompt(
+        self, query_text: str, results: list[tuple[Document, float]]
+    ) -> tuple[str, BuiltContext]:
+        context = self.context_builder.build([doc for doc, _score in results])
+        logger.debug(
+            f"Context of {context.tokens} tokens from {context.chunks} chunks in "
+            f"{context.sections} sections, {context.tokens_saved} tokens saved"
+        )
+        prompt = self.prompt_template.format(context=context.text, question=query_text)
+        return prompt, context
+
+    def prepare(
+        self,
+        query_text: str,
+        bypass_cache: bool = False,
+        mode: Optional[RetrievalMode] = None,
+        embedding: Optional[list[float]] = None,
+    ) -> tuple[Optional[QueryResponse], Optional[PreparedQuery]]:
+        """
+        Returns the cached answer to `query_text`, or else the prompt to
+        answer it with, embedding it unless its `embedding` is given.
+        """
+
+        mode = RetrievalMode(mode or self.retrieval_mode)
+        filters = parse_query_filters(query_text) if self.metadata_filters else None
+        # Paraphrases about different banks or periods can embed closely, so
+        # answers are only shared between queries with the same filters.
+        scope = f"{mode.value}|{filters or ''}"
+        if embedding is None:
+            embedding = self.embed_query(query_text)
+        index_version = self.chroma_db.index_version()
+        if self.answer_cache is not None and not bypass_cache:
+            cached = self.answer_cache.lookup(
+                query_text, embedding, index_version, scope=scope
+            )
+            if cached is not None:
+                return cached, None
+
+        results = self.retrieve(
+            query_text,
+            embedding=embedding,
+            mode=mode,
+            index_version=index_version,
+            filters=filters,
+        )
+        results, sources = self.cite(results)
+        prompt, context = self.build_prompt(query_text, results)
+        return None, PreparedQuery(
+            query_text=query_text,
+            embedding=embedding,
+            index_version=index_version,
+            scope=scope,
+            sources=sources,
+            prompt=prompt,
+            context=context,
+        )
+
+    def _complete(self, prepared: PreparedQuery, response_text: str) -> QueryResponse:
+        query_response = QueryResponse(
+            query_text=prepared.query_text,
+            response_text=response_text,
+            sources=prepared.sources,
+            context_tokens=prepared.context.tokens,
+            context_tokens_saved=prepared.context.tokens_saved,
+        )
+        if self.answer_cache is not None:
+            self.answer_cache.store(
+                prepared.query_text,
+                prepared.embedding,
+                query_response,
+                prepared.index_version,
+                scope=prepared.scope,
+            )
+        return query_response
+
+    def query(
+        self,
+        query_text: str,
+        bypass_cache: bool = False,
+        mode: Optional[RetrievalMode] = None,
+    ) -> QueryResponse:
+        """
+        Answers `query_text` from the context retrieved with `mode`, or the
+        engine's default mode. A previous answer to a near-identical query
+        retrieved the same way from the same index is reused unless
+        `bypass_cache` is set, in which case the fresh answer replaces it.
+        """
+
+        cached, prepared = self.prepare(query_text, bypass_cache, mode)
+        if cached is not None:
+            return cached
+        return self.answer(prepared)
+
+    def answer(self, prepared: PreparedQuery) -> QueryResponse:
+        """
+        Generates the answer to a query returned by `prepare`.
+        """
+
+        response = self.model.invoke(prepared.prompt)
+        return self._complete(prepared, response.content)
+
+    def stream_query(
+        self,
+        query_text: str,
+        bypass_cache: bool = False,
+        mode: Optional[RetrievalMode] = None,
+    ) -> Iterator[tuple[str, Any]]:
+        """
+        Answers `query_text` as `query` does, as a series of events: the
+        `sources` as soon as they are retrieved, each `token` of the answer
+        as the chat model streams it, and the whole `QueryResponse` once it
+        is `done`. A cached answer is sent as a single token.
+        """
+
+        cached, prepared = self.prepare(query_text, bypass_cache, mode)
+        if cached is not None:
+            yield "sources", cached.sources
+            yield "token", cached.response_text
+            yield "done", cached
+            return
+
+        yield "sources", prepared.sources
+        parts = []
+        for chunk in self.model.stream(prepared.prompt):
+            if chunk.content:
+                parts.append(chunk.content)
+                yield "token", chunk.content
+        yield "done", self._complete(prepared, "".join(parts))
+
+    def close(self):
+        if self.source_aliases is not None:
+            self.source_aliases.close()
+        if self.search_batcher is not None:
+            self.search_batcher.close()
+        self.chroma_db.embedding_executor.shutdown()
+        if self.chroma_db.embedding_cache is not None:
+            self.chroma_db.embedding_cache.close()
@@ -0,0 +1,344 @@
+import json
+import os
+import shutil
+import threading
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from langchain.schema.document import Document
+
+from models.numpy_vector_store import metadata_column, top_k, where_mask
+from models.vector_store import ID_PAGE_SIZE, VectorStore
+
+SERVING_DIR = "serving"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.npy"
+SQ_NORMS_FILE = "sq_norms.npy"
+RECORDS_FILE = "records.bin"
+RECORD_OFFSETS_FILE = "record_offsets.npy"
+IDS_FILE = "ids.bin"
+ID_OFFSETS_FILE = "id_offsets.npy"
+ID_ROWS_FILE = "id_rows.npy"
+# Metadata keys with more distinct values than this, such as chunk IDs, are
+# not stored as columns; filters on them parse the records instead.
+COLUMN_MAX_VALUES = 1 << 16
+
+
+def _load_array(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays cannot be memory-mapped.
+        return np.load(path)
+
+
+def _map_bytes(path: str) -> np.ndarray:
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class ServingFiles:
+    """
+    One version of a serving index, opened without reading it: every array
+    is memory-mapped, so the OS page cache holds a single copy for all
+    processes that open it.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.index_version = meta["index_version"]
+        self.vectors = _load_array(os.path.join(directory, VECTORS_FILE))
+        self.sq_norms = _load_array(os.path.join(directory, SQ_NORMS_FILE))
+        self.records = _map_bytes(os.path.join(directory, RECORDS_FILE))
+        self.record_offsets = _load_array(os.path.join(directory, RECORD_OFFSETS_FILE))
+        self.ids = _map_bytes(os.path.join(directory, IDS_FILE))
+        self.id_offsets = _load_array(os.path.join(directory, ID_OFFSETS_FILE))
+        self.id_rows = _load_array(os.path.join(directory, ID_ROWS_FILE))
+        self.columns = {
+            key: (
+                {value: code for code, value in enumerate(column["values"])},
+                _load_array(os.path.join(directory, column["file"])),
+            )
+            for key, column in meta["columns"].items()
+        }
+        self._lock = threading.Lock()
+
+    def record(self, row: int) -> dict:
+        start, end = self.record_offsets[row], self.record_offsets[row + 1]
+        return json.loads(self.records[start:end].tobytes())
+
+    def document(self, row: int) -> Document:
+        record = self.record(row)
+        return Document(page_content=record["document"], metadata=record["metadata"])
+
+    def _id(self, position: int) -> str:
+        start, end = self.id_offsets[position], self.id_offsets[position + 1]
+        return self.ids[start:end].tobytes().decode()
+
+    def find_row(self, chunk_id: str) -> Optional[int]:
+        # IDs are stored sorted, so a lookup is a binary search that reads a
+        # few IDs rather than a table built at startup.
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < chunk_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._id(low) == chunk_id:
+            return int(self.id_rows[low])
+        return None
+
+    def column(self, key: str) -> tuple[dict, np.ndarray]:
+        if key not in self.columns:
+            with self._lock:
+                if key not in self.columns:
+                    self.columns[key] = metadata_column(
+                        (self.record(row)["metadata"] for row in range(self.count)),
+                        key,
+                    )
+        return self.columns[key]
+
+
+class MmapVectorStore(VectorStore):
+    """
+    Read-only store serving a directory written by `write_serving_index`:
+    vectors and their squared norms in flat `.npy` files, and the records
+    (ID, text and metadata) as JSON in one file indexed by byte offsets.
+    Opening it maps the files and parses nothing else, so startup takes
+    milliseconds whatever the index size, and API workers on one host
+    share a single copy of the index in the page cache.
+
+    A rewritten index is picked up by the next search, since the directory
+    is replaced as a whole and its files are reopened.
+
+    Args:
+        directory (str): The serving index directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, META_FILE)
+        if not os.path.exists(self.meta_path):
+            raise FileNotFoundError(
+                f"No serving index in {directory}, "
+                "run populate-database with --serving-index"
+            )
+        self._lock = threading.Lock()
+        self._files = ServingFiles(directory)
+        self._meta_mtime = os.stat(self.meta_path).st_mtime_ns
+
+    @property
+    def index_version(self) -> str:
+        return self._current().index_version
+
+    def _current(self) -> ServingFiles:
+        try:
+            mtime = os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            # The directory is being swapped; keep the open version.
+            return self._files
+        if mtime != self._meta_mtime:
+            with self._lock:
+                if mtime != self._meta_mtime:
+                    self._files = ServingFiles(self.directory)
+                    self._meta_mtime = mtime
+        return self._files
+
+    def count(self) -> int:
+        return self._current().count
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        raise RuntimeError("The serving index is read-only")
+
+    def delete(self, ids):
+        raise RuntimeError("The serving index is read-only")
+
+    def get(self, ids):
+        files = self._current()
+        rows = (files.find_row(chunk_id) for chunk_id in ids)
+        return [files.document(row) for row in rows if row is not None]
+
+    def get_embeddings(self, ids):
+        files = self._current()
+        rows = [files.find_row(chunk_id) for chunk_id in ids]
+        if None in rows:
+            raise KeyError(ids[rows.index(None)])
+        return np.array(files.vectors[rows])
+
+    def existing_ids(self, ids: Iterable[str]) -> set[str]:
+        files = self._current()
+        return {chunk_id for chunk_id in ids if files.find_row(chunk_id) is not None}
+
+    def iter_ids(self, page_size: int = ID_PAGE_SIZE) -> Iterator[list[str]]:
+        files = self._current()
+        for start in range(0, files.count, page_size):
+            end = min(start + page_size, files.count)
+            yield [files.record(row)["id"] for row in range(start, end)]
+
+    def iter_documents(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[str, str]]:
+        files = self._current()
+        for row in range(files.count):
+            record = files.record(row)
+            yield record["id"], record["document"]
+
+    def iter_records(self, page_size: int = ID_PAGE_SIZE):
+        files = self._current()
+        for start in range(0, files.count, page_size):
+            end = min(start + page_size, files.count)
+            records = [files.record(row) for row in range(start, end)]
+            yield (
+                [record["id"] for record in records],
+                np.array(files.vectors[start:end]),
+                [record["document"] for record in records],
+                [record["metadata"] for record in records],
+            )
+
+    def search(self, embedding, k, where=None):
+        return self.search_batch(
+            np.asarray(embedding, dtype=np.float32)[None, :], k, where
+        )[0]
+
+    def search_batch(self, embeddings, k, where=None):
+        files = self._current()
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if not files.count:
+            return [[] for _query in queries]
+        if where:
+            rows = np.flatnonzero(where_mask(where, files.count, files.column))
+            vectors, sq_norms = files.vectors[rows], files.sq_norms[rows]
+        else:
+            rows = None
+            vectors, sq_norms = files.vectors, files.sq_norms
+        distances = sq_norms - 2 * (queries @ vectors.T)
+        distances += np.einsum("ij,ij->i", queries, queries)[:, None]
+        results = []
+        for query_distances in distances:
+            top = top_k(query_distances, k)
+            found = top if rows is None else rows[top]
+            results.append(
+                [
+                    (files.document(int(row)), float(query_distances[i]))
+                    for row, i in zip(found, top)
+                ]
+            )
+        return results
+
+
+def saved_serving_version(directory: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, META_FILE)) as f:
+            return json.load(f)["index_version"]
+    except FileNotFoundError:
+        return None
+
+
+def write_serving_index(store: VectorStore, directory: str, index_version: str = ""):
+    """
+    Writes the contents of `store` to `directory` in the serving format,
+    replacing any previous index only once the new one is complete.
+    """
+
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    count = store.count()
+    vectors = None
+    sq_norms = np.zeros(count, dtype=np.float32)
+    record_offsets = np.zeros(count + 1, dtype=np.int64)
+    chunk_ids = []
+    columns: dict[str, tuple[dict, np.ndarray]] = {}
+    dropped = set()
+    row = 0
+    with open(os.path.join(tmp_directory, RECORDS_FILE), "wb") as records:
+        for ids, embeddings, documents, metadatas in store.iter_records():
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(
+                    os.path.join(tmp_directory, VECTORS_FILE),
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(count, embeddings.shape[1]),
+                )
+            end = row + len(ids)
+            if end > count:
+                raise RuntimeError("The store changed while it was being exported")
+            vectors[row:end] = embeddings
+            sq_norms[row:end] = np.einsum("ij,ij->i", embeddings, embeddings)
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                record = json.dumps(
+                    {"id": chunk_id, "document": document, "metadata": metadata}
+                ).encode()
+                records.write(record)
+                record_offsets[row + 1] = record_offsets[row] + len(record)
+                for key, value in metadata.items():
+                    if key in dropped:
+                        continue
+                    if key not in columns:
+                        columns[key] = ({}, np.full(count, -1, dtype=np.int32))
+                    codes, column = columns[key]
+                    column[row] = codes.setdefault(value, len(codes))
+                    if len(codes) > COLUMN_MAX_VALUES:
+                        dropped.add(key)
+                        del columns[key]
+                chunk_ids.append(chunk_id)
+                row += 1
+    if row != count:
+        raise RuntimeError("The store changed while it was being exported")
+    if vectors is None:
+        np.save(os.path.join(tmp_directory, VECTORS_FILE), np.zeros((0, 0), np.float32))
+    else:
+        vectors.flush()
+        del vectors
+
+    np.save(os.path.join(tmp_directory, SQ_NORMS_FILE), sq_norms)
+    np.save(os.path.join(tmp_directory, RECORD_OFFSETS_FILE), record_offsets)
+    id_rows = np.array(sorted(range(count), key=chunk_ids.__getitem__), dtype=np.int64)
+    encoded_ids = [chunk_ids[row].encode() for row in id_rows]
+    id_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum([len(chunk_id) for chunk_id in encoded_ids], out=id_offsets[1:])
+    with open(os.path.join(tmp_directory, IDS_FILE), "wb") as f:
+        f.write(b"".join(encoded_ids))
+    np.save(os.path.join(tmp_directory, ID_OFFSETS_FILE), id_offsets)
+    np.save(os.path.join(tmp_directory, ID_ROWS_FILE), id_rows)
+
+    column_meta = {}
+    for number, (key, (codes, column)) in enumerate(columns.items()):
+        file_name = f"column_{number}.npy"
+        np.save(os.path.join(tmp_directory, file_name), column)
+        column_meta[key] = {"file": file_name, "values": list(codes)}
+    with open(os.path.join(tmp_directory, META_FILE), "w") as f:
+        json.dump(
+            {
+                "count": count,
+                "index_version": index_version,
+                "columns": column_meta,
+            },
+            f,
+        )
+
+    old_directory = f"{directory}.old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def update_serving_index(chroma_db) -> bool:
+    """
+    Rewrites the serving index stored next to the vector store, unless it
+    was already written from the current index version. Returns whether it
+    was rewritten.
+    """
+
+    directory = os.path.join(chroma_db.chroma_path, SERVING_DIR)
+    index_version = chroma_db.index_version()
+    if saved_serving_version(directory) == index_version:
+        return False
+    write_serving_index(chroma_db, directory, index_version=index_version)
+    return True
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import threading
+from typing import Iterable
+
+from langchain.schema.document import Document
+
+SOURCE_ALIASES_FILE = "source_aliases.sqlite3"
+SQLITE_MAX_VARIABLES = 900
+
+
+class SourceAliases:
+    """
+    Maps each stored chunk ID to every `source:page` it was found in, so a
+    chunk shared by several files (such as the same report downloaded twice)
+    is stored once and still cites all of them. Kept inside the Chroma
+    `persist_directory`.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, SOURCE_ALIASES_FILE)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_sources ("
+            " chunk_id TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " page INTEGER,"
+            " PRIMARY KEY (chunk_id, source, page))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_sources_source"
+            " ON chunk_sources (source)"
+        )
+        self._connection.commit()
+
+    def add(self, chunks: Iterable[Document]):
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO chunk_sources VALUES (?, ?, ?)",
+                [
+                    (
+                        chunk.metadata["id"],
+                        chunk.metadata.get("source"),
+                        chunk.metadata.get("page"),
+                    )
+                    for chunk in chunks
+                ],
+            )
+            self._connection.commit()
+
+    def remove_sources(self, sources: Iterable[str]):
+        with self._lock:
+            self._connection.executemany(
+                "DELETE FROM chunk_sources WHERE source = ?",
+                [(source,) for source in sources],
+            )
+            self._connection.commit()
+
+    def sources_for(self, chunk_ids: list[str]) -> dict[str, list[str]]:
+        aliases = {chunk_id: [] for chunk_id in chunk_ids}
+        with self._lock:
+            for start in range(0, len(chunk_ids), SQLITE_MAX_VARIABLES):
+                batch = chunk_ids[start : start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT chunk_id, source, page FROM chunk_sources"
+                    f" WHERE chunk_id IN ({placeholders})"
+                    " ORDER BY source, page",
+                    batch,
+                ).fetchall()
+                for chunk_id, source, page in rows:
+                    aliases[chunk_id].append(f"{source}:{page}")
+        return aliases
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,102 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from langchain.schema.document import Document
+
+ID_PAGE_SIZE = 1000
+
+
+class VectorBackend(str, Enum):
+    CHROMA = "chroma"
+    NUMPY = "numpy"
+    FAISS = "faiss"
+    MMAP = "mmap"
+
+
+class VectorPrecision(str, Enum):
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+    INT8 = "int8"
+
+
+class VectorStore(ABC):
+    """
+    Storage and nearest-neighbour search of chunk embeddings, with their
+    text and metadata. Distances are squared L2, the Chroma default, so
+    every backend ranks and scores alike. `where` filters use the Chroma
+    syntax: `{"field": value}`, `{"field": {"$in": [...]}}` and `$and` /
+    `$or` lists of those.
+    """
+
+    @abstractmethod
+    def count(self) -> int: ...
+
+    @abstractmethod
+    def upsert(
+        self,
+        ids: list[str],
+        embeddings: list[list[float]],
+        documents: list[str],
+        metadatas: list[dict],
+    ): ...
+
+    @abstractmethod
+    def delete(self, ids: list[str]): ...
+
+    @abstractmethod
+    def get(self, ids: list[str]) -> list[Document]:
+        """
+        Returns the stored documents of `ids`, skipping unknown IDs.
+        """
+
+    @abstractmethod
+    def get_embeddings(self, ids: list[str]) -> np.ndarray:
+        """
+        Returns the float32 embeddings of `ids`, which must be stored, in
+        the same order.
+        """
+
+    @abstractmethod
+    def existing_ids(self, ids: Iterable[str]) -> set[str]: ...
+
+    @abstractmethod
+    def iter_ids(self, page_size: int = ID_PAGE_SIZE) -> Iterator[list[str]]: ...
+
+    @abstractmethod
+    def iter_documents(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[str, str]]: ...
+
+    @abstractmethod
+    def iter_records(
+        self, page_size: int = ID_PAGE_SIZE
+    ) -> Iterator[tuple[list[str], np.ndarray, list[str], list[dict]]]:
+        """
+        Yields pages of IDs, float32 embeddings, documents and metadatas.
+        """
+
+    @abstractmethod
+    def search(
+        self, embedding: list[float], k: int, where: Optional[dict] = None
+    ) -> list[tuple[Document, float]]:
+        """
+        Returns up to `k` `(document, distance)` pairs, nearest first.
+        """
+
+    def search_batch(
+        self, embeddings: np.ndarray, k: int, where: Optional[dict] = None
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        Returns the `search` results of each row of `embeddings`. Backends
+        that can search several queries as one matrix product override it.
+        """
+
+        return [self.search(embedding, k, where) for embedding in embeddings]
+
+    def persist(self):
+        """
+        Writes pending changes to disk, for backends that do not write
+        through.
+        """
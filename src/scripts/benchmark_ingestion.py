@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict
+from typing import Optional
+
+import typer
+
+from models.bm25_index import update_bm25_index
+from models.chroma_database import ChromaDatabase
+from models.manifest import FileManifest
+from models.source_aliases import SourceAliases
+from models.vector_store import VectorBackend
+from utils.benchmark import (
+    DeterministicEmbeddings,
+    directory_size_mb,
+    generate_corpus,
+    peak_rss_mb,
+)
+from utils.boilerplate import BoilerplateStripper
+from utils.document_loader import PAGES_PER_TASK, ChunkIdMode, SplitMethod
+from utils.ingestion import BATCH_SIZE, QUEUE_SIZE, ingest_documents
+from utils.metadata import MetadataExtractor
+
+# The benchmark must not reach out to the network, Chroma telemetry included.
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+# The throughput unit reported for each pipeline stage.
+STAGE_UNITS = {
+    "source": ["pages"],
+    "annotate": ["pages"],
+    "strip_boilerplate": ["pages"],
+    "split": ["pages", "chunks"],
+    "generate_ids": ["chunks"],
+    "dedupe": ["chunks"],
+    "embed": ["embeddings"],
+    "upsert": ["embeddings"],
+}
+
+app = typer.Typer()
+
+
+def _rate(count: int, seconds: float) -> float:
+    return count / seconds if seconds > 0 else 0.0
+
+
+@app.command()
+def run(
+    benchmark_path: str = "data/benchmark",
+    files: int = 12,
+    pages_per_file: int = 40,
+    seed: int = 0,
+    latency: float = 0.05,
+    dimensions: int = 1536,
+    workers: int = 1,
+    pages_per_task: int = PAGES_PER_TASK,
+    batch_size: int = BATCH_SIZE,
+    queue_size: int = QUEUE_SIZE,
+    embedding_workers: int = 8,
+    chunk_ids: ChunkIdMode = ChunkIdMode.POSITION,
+    bloom_filter: bool = False,
+    splitter: SplitMethod = SplitMethod.RECURSIVE,
+    strip_boilerplate: bool = False,
+    bm25: bool = True,
+    extract_metadata: bool = True,
+    vector_backend: VectorBackend = VectorBackend.CHROMA,
+    results_path: Optional[str] = None,
+    baseline_path: Optional[str] = None,
+    max_regression: float = 0.2,
+):
+    """
+    Ingests a synthetic corpus with an offline embedder that sleeps
+    `latency` seconds per text, then reports throughput per stage, peak RSS
+    and index size. With `baseline_path`, exits with an error when
+    pages/s, chunks/s or embeddings/s drop by more than `max_regression`.
+    """
+
+    corpus_path = os.path.join(benchmark_path, "corpus")
+    chroma_path = os.path.join(benchmark_path, "chroma")
+    for path in (corpus_path, chroma_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    started = time.perf_counter()
+    file_paths = generate_corpus(corpus_path, files, pages_per_file, seed=seed)
+    print(
+        f"Generated {files} files of {pages_per_file} pages in "
+        f"{time.perf_counter() - started:.2f}s"
+    )
+
+    chroma_db = ChromaDatabase(
+        chroma_path=chroma_path,
+        bedrock_client=None,
+        embeddings=DeterministicEmbeddings(dimensions=dimensions, latency=latency),
+        embedding_workers=embedding_workers,
+        use_bloom_filter=bloom_filter,
+        vector_backend=vector_backend,
+    )
+    started = time.perf_counter()
+    stats = ingest_documents(
+        chroma_db,
+        file_paths,
+        batch_size=batch_size,
+        workers=workers,
+        pages_per_task=pages_per_task,
+        queue_size=queue_size,
+        manifest=FileManifest.load(chroma_path),
+        source_root=corpus_path,
+        chunk_id_mode=chunk_ids,
+        split_method=splitter,
+        aliases=SourceAliases(chroma_path),
+        boilerplate=BoilerplateStripper() if strip_boilerplate else None,
+        metadata_extractor=MetadataExtractor() if extract_metadata else None,
+    )
+    seconds = time.perf_counter() - started
+    bm25_seconds = 0.0
+    if bm25:
+        started = time.perf_counter()
+        update_bm25_index(chroma_db)
+        bm25_seconds = time.perf_counter() - started
+    embeddings = chroma_db.embedding_executor.stats.texts
+    chroma_db.embedding_executor.shutdown()
+
+    counts = {"pages": stats.pages, "chunks": stats.chunks, "embeddings": embeddings}
+    results = {
+        "vector_backend": vector_backend.value,
+        "seconds": seconds,
+        "pages_per_second": _rate(stats.pages, seconds),
+        "chunks_per_second": _rate(stats.chunks, seconds),
+        "embeddings_per_second": _rate(embeddings, seconds),
+        "stages": {
+            name: {
+                "seconds": busy,
+                **{
+                    f"{unit}_per_second": _rate(counts[unit], busy)
+                    for unit in STAGE_UNITS.get(name, [])
+                },
+            }
+            for name, busy in stats.stage_seconds.items()
+        },
+        "bm25_seconds": bm25_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_worker_rss_mb": peak_rss_mb(children=True),
+        "index_size_mb": directory_size_mb(chroma_path),
+        "stats": asdict(stats),
+    }
+
+    print(
+        f"Ingested {stats.pages} pages, {stats.chunks} chunks and {embeddings} "
+        f"embeddings in {seconds:.2f}s: {results['pages_per_second']:.1f} pages/s, "
+        f"{results['chunks_per_second']:.1f} chunks/s, "
+        f"{results['embeddings_per_second']:.1f} embeddings/s"
+    )
+    print(f"{'stage':<18}{'busy s':>9}{'pages/s':>11}{'chunks/s':>11}{'emb/s':>11}")
+    for name, stage in results["stages"].items():
+        rates = "".join(
+            (
+                f"{stage[f'{unit}_per_second']:>11.1f}"
+                if unit in STAGE_UNITS.get(name, [])
+                else f"{'':>11}"
+            )
+            for unit in ("pages", "chunks", "embeddings")
+        )
+        print(f"{name:<18}{stage['seconds']:>9.2f}{rates}")
+    if bm25:
+        print(f"{'bm25 build':<18}{bm25_seconds:>9.2f}")
+    print(
+        f"Peak RSS {results['peak_rss_mb']:.0f} MiB "
+        f"(parse workers {results['peak_worker_rss_mb']:.0f} MiB), "
+        f"index size {results['index_size_mb']:.1f} MiB"
+    )
+
+    if results_path:
+        os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+        with open(results_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = [
+            f"{key} {results[key]:.1f} vs {baseline[key]:.1f}"
+            for key in (
+                "pages_per_second",
+                "chunks_per_second",
+                "embeddings_per_second",
+            )
+            if results[key] < baseline[key] * (1 - max_regression)
+        ]
+        if regressions:
+            print(f"Regressed more than {max_regression:.0%}: {', '.join(regressions)}")
+            raise typer.Exit(code=1)
+        print(f"No regression beyond {max_regression:.0%} of {baseline_path}")
+
+
+if __name__ == "__main__":
+    app()
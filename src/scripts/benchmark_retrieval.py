@@ -0,0 +1,242 @@
+import json
+import os
+import re
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+import typer
+
+from models.chroma_database import UPSERT_BATCH_SIZE, ChromaDatabase
+from models.mmr import MMR_CANDIDATES, MMR_FETCH_FACTOR, maximal_marginal_relevance
+from models.numpy_vector_store import top_k
+from models.vector_store import VectorBackend, VectorPrecision
+from utils.benchmark import (
+    DeterministicEmbeddings,
+    clustered_vectors,
+    directory_size_mb,
+    private_memory_mb,
+    release_free_memory,
+)
+
+# The benchmark must not reach out to the network, Chroma telemetry included.
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+# A backend, optionally followed by a FAISS index factory string and the
+# precision vectors are held in.
+DEFAULT_BACKENDS = [
+    "numpy",
+    "numpy@float16",
+    "numpy@int8",
+    "chroma",
+    "faiss:HNSW32",
+    "faiss:IVF256,PQ64x4fs",
+]
+QUERY_NOISE = 0.5
+
+app = typer.Typer()
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> list[set]:
+    sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    return [set(top_k(sq_norms - 2 * (vectors @ query), k)) for query in queries]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def _measure(
+    chroma_db: ChromaDatabase, queries: np.ndarray, truth: list[set], k: int
+) -> tuple[list[float], float]:
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        results = chroma_db.search(query.tolist(), k)
+        latencies.append(time.perf_counter() - started)
+        found = {int(doc.metadata["id"]) for doc, _distance in results}
+        recalls.append(len(found & expected) / k)
+    return latencies, float(np.mean(recalls))
+
+
+def _measure_mmr(
+    chroma_db: ChromaDatabase, queries: np.ndarray, k: int
+) -> tuple[list[float], list[float]]:
+    # The time MMR adds to a query: fetching the embeddings of the
+    # oversampled candidates, and selecting k of them.
+    candidates = max(MMR_CANDIDATES, MMR_FETCH_FACTOR * k)
+    fetch_latencies = []
+    select_latencies = []
+    for query in queries:
+        results = chroma_db.search(query.tolist(), candidates)
+        started = time.perf_counter()
+        embeddings = chroma_db.get_embeddings(
+            [doc.metadata["id"] for doc, _distance in results]
+        )
+        fetched = time.perf_counter()
+        maximal_marginal_relevance(query, embeddings, k)
+        fetch_latencies.append(fetched - started)
+        select_latencies.append(time.perf_counter() - fetched)
+    return fetch_latencies, select_latencies
+
+
+def benchmark_backend(
+    spec: str,
+    directory: str,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: list[set],
+    k: int,
+) -> dict:
+    spec, _, precision = spec.partition("@")
+    backend, _, faiss_index = spec.partition(":")
+    options = {"faiss_index": faiss_index} if faiss_index else {}
+    precision = VectorPrecision(precision or VectorPrecision.FLOAT32)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    started = time.perf_counter()
+    chroma_db = ChromaDatabase(
+        chroma_path=directory,
+        bedrock_client=None,
+        embeddings=DeterministicEmbeddings(dimensions=vectors.shape[1]),
+        vector_backend=VectorBackend(backend),
+        vector_precision=precision,
+        **options,
+    )
+    # Memory is measured from the open, empty store, so the fixed cost of
+    # starting a backend is not scaled up to a million vectors.
+    release_free_memory()
+    memory_before = private_memory_mb()
+    for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+        end = min(start + UPSERT_BATCH_SIZE, len(vectors))
+        ids = [str(row) for row in range(start, end)]
+        chroma_db.upsert(
+            ids,
+            vectors[start:end],
+            [""] * len(ids),
+            [{"id": chunk_id} for chunk_id in ids],
+        )
+    chroma_db.flush()
+    # Indexes built lazily are built by the first search.
+    chroma_db.search(queries[0].tolist(), k)
+    build_seconds = time.perf_counter() - started
+    release_free_memory()
+    memory_mb = private_memory_mb() - memory_before
+
+    latencies, recall = _measure(chroma_db, queries, truth, k)
+    # The recall of the quantized or indexed candidates alone, before the
+    # exact re-scoring that picks the best k of them.
+    recall_without_rescoring = recall
+    if getattr(chroma_db.store, "rescore_factor", 1) > 1 and (
+        precision != VectorPrecision.FLOAT32 or backend == VectorBackend.FAISS
+    ):
+        chroma_db.store.rescore_factor = 1
+        _latencies, recall_without_rescoring = _measure(chroma_db, queries, truth, k)
+    mmr_fetch_latencies, mmr_select_latencies = _measure_mmr(chroma_db, queries, k)
+    chroma_db.embedding_executor.shutdown()
+
+    return {
+        "backend": spec,
+        "precision": precision.value,
+        "recall": recall,
+        "recall_without_rescoring": recall_without_rescoring,
+        "p50_ms": 1000 * _percentile(latencies, 50),
+        "p99_ms": 1000 * _percentile(latencies, 99),
+        "mmr_fetch_p50_ms": 1000 * _percentile(mmr_fetch_latencies, 50),
+        "mmr_select_p50_ms": 1000 * _percentile(mmr_select_latencies, 50),
+        "mmr_select_p99_ms": 1000 * _percentile(mmr_select_latencies, 99),
+        "build_seconds": build_seconds,
+        "memory_mb_per_million": memory_mb * 1_000_000 / len(vectors),
+        # In-process backends also report the size of their own arrays, which
+        # is not affected by memory the allocator keeps.
+        "index_mb_per_million": (
+            chroma_db.store.nbytes / (1 << 20) * 1_000_000 / len(vectors)
+            if hasattr(chroma_db.store, "nbytes")
+            else None
+        ),
+        "disk_mb_per_million": directory_size_mb(directory) * 1_000_000 / len(vectors),
+    }
+
+
+@app.command()
+def run(
+    benchmark_path: str = "data/benchmark/retrieval",
+    vectors: int = 20_000,
+    dimensions: int = 1536,
+    queries: int = 200,
+    k: int = 10,
+    clusters: int = 64,
+    seed: int = 0,
+    backends: list[str] = typer.Option(DEFAULT_BACKENDS, "--backend"),
+    results_path: Optional[str] = None,
+):
+    """
+    Compares vector backends on synthetic embeddings: recall@k against exact
+    search, p50/p99 query latency, build time, and the private memory and
+    disk space they take per million vectors. Runs with quantized vectors
+    also report the recall lost compared with full precision, and the
+    recall before exact re-scoring. The overhead of MMR is reported as the
+    time to fetch the candidates' embeddings and to select k of them.
+    """
+
+    rng = np.random.default_rng(seed)
+    data = clustered_vectors(rng, vectors, dimensions, clusters)
+    # Queries are perturbed corpus vectors, as questions are close to, but
+    # not the same as, the chunks that answer them.
+    picks = data[rng.integers(vectors, size=queries)]
+    query_vectors = picks + QUERY_NOISE * rng.standard_normal(
+        picks.shape, dtype=np.float32
+    ) / np.sqrt(dimensions)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    truth = exact_neighbours(data, query_vectors, k)
+
+    results = []
+    full_precision_recalls = {}
+    for spec in backends:
+        directory = os.path.join(benchmark_path, re.sub(r"[:,@]", "-", spec))
+        result = benchmark_backend(spec, directory, data, query_vectors, truth, k)
+        results.append(result)
+        if result["precision"] == VectorPrecision.FLOAT32:
+            full_precision_recalls[result["backend"]] = result["recall"]
+        # Quantized runs are compared with the same backend in float32 when
+        # it ran first, and with exact search otherwise.
+        result["recall_loss"] = (
+            full_precision_recalls.get(result["backend"], 1.0) - result["recall"]
+        )
+        print(
+            f"{spec:<24} recall@{k} {result['recall']:.3f} "
+            f"(loss {result['recall_loss']:.3f}, "
+            f"{result['recall_without_rescoring']:.3f} without re-scoring)  "
+            f"p50 {result['p50_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms  "
+            f"MMR fetch {result['mmr_fetch_p50_ms']:.2f}ms, select p50 "
+            f"{result['mmr_select_p50_ms']:.2f}ms p99 "
+            f"{result['mmr_select_p99_ms']:.2f}ms  "
+            f"build {result['build_seconds']:.1f}s  "
+            f"{result['memory_mb_per_million']:.0f} MiB private memory"
+            + (
+                f" ({result['index_mb_per_million']:.0f} MiB index)"
+                if result["index_mb_per_million"] is not None
+                else ""
+            )
+            + f" and {result['disk_mb_per_million']:.0f} MiB disk per million vectors"
+        )
+
+    if results_path:
+        with open(results_path, "w") as f:
+            json.dump(
+                {
+                    "vectors": vectors,
+                    "dimensions": dimensions,
+                    "queries": queries,
+                    "k": k,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    app()
@@ -1,15 +1,46 @@
 import os
 import shutil
+import time
+from typing import Optional
 
 import typer
 from dotenv import load_dotenv
-from langchain.prompts import ChatPromptTemplate
-from langchain_aws import ChatBedrock
 
-from config import PROMPT_TEMPLATE, load_aws_client
+from config import load_aws_client
+from models.bm25_index import update_bm25_index
 from models.chroma_database import ChromaDatabase
+from models.embedding_cache import EMBEDDING_CACHE_PATH
+from models.manifest import FileManifest
 from models.rag import QueryResponse
-from utils.document_loader import generate_chunk_ids, load_documents, split_documents
+from models.rag_engine import (
+    CHAT_MODEL_ID,
+    CHROMA_PATH,
+    MAX_POOL_CONNECTIONS,
+    RagEngine,
+    RetrievalMode,
+)
+from models.serving_index import update_serving_index
+from models.source_aliases import SourceAliases
+from models.vector_store import VectorBackend, VectorPrecision
+from utils.boilerplate import BoilerplateStripper
+from utils.context_builder import CONTEXT_TOKEN_BUDGET
+from utils.document_loader import (
+    PAGES_PER_TASK,
+    ChunkIdMode,
+    SplitMethod,
+    list_pdf_files,
+)
+from utils.ingestion import BATCH_SIZE, QUEUE_SIZE, ingest_documents
+from utils.metadata import MetadataExtractor
+from utils.query_batch import (
+    BATCH_CONCURRENCY,
+    RETRIEVAL_BATCH_SIZE,
+    BatchLock,
+    QueryBatchStats,
+    answer_questions,
+    pending_questions,
+    read_questions,
+)
 
 load_dotenv()
 
@@ -27,55 +58,207 @@ def populate_database(
     source_path: str,
     model_id: str = "amazon.titan-embed-text-v1",
     clear: bool = False,
+    workers: int = 1,
+    pages_per_task: int = PAGES_PER_TASK,
+    batch_size: int = BATCH_SIZE,
+    queue_size: int = QUEUE_SIZE,
+    embedding_workers: int = 8,
+    embedding_cache: str = EMBEDDING_CACHE_PATH,
+    chunk_ids: ChunkIdMode = ChunkIdMode.POSITION,
+    bloom_filter: bool = False,
+    splitter: SplitMethod = SplitMethod.RECURSIVE,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    strip_boilerplate: bool = False,
+    bm25: bool = True,
+    extract_metadata: bool = True,
+    vector_backend: VectorBackend = VectorBackend.CHROMA,
+    serving_index: bool = False,
 ):
     if clear:
         if os.path.exists(chroma_path):
             shutil.rmtree(chroma_path)
     aws_client = load_aws_client("bedrock-runtime")
     chroma_db = ChromaDatabase(
-        chroma_path=chroma_path, model_id=model_id, bedrock_client=aws_client
+        chroma_path=chroma_path,
+        model_id=model_id,
+        bedrock_client=aws_client,
+        embedding_workers=embedding_workers,
+        embedding_cache_path=embedding_cache,
+        use_bloom_filter=bloom_filter,
+        vector_backend=vector_backend,
     )
 
-    documents = load_documents(source_path=source_path)
-    chunks = split_documents(
-        documents,
-        chunk_size=600,
-        chunk_overlap=120,
-        length_function=len,
-        is_separator_regex=False,
+    stats = ingest_documents(
+        chroma_db,
+        list_pdf_files(source_path),
+        batch_size=batch_size,
+        workers=workers,
+        pages_per_task=pages_per_task,
+        queue_size=queue_size,
+        manifest=FileManifest.load(chroma_path),
+        source_root=source_path,
+        chunk_id_mode=chunk_ids,
+        split_method=splitter,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        aliases=SourceAliases(chroma_path),
+        boilerplate=BoilerplateStripper() if strip_boilerplate else None,
+        metadata_extractor=MetadataExtractor() if extract_metadata else None,
     )
-    chunks_with_ids = generate_chunk_ids(chunks)
-    existing_ids = chroma_db.get_existing_ids()
-    new_chunks = [
-        chunk for chunk in chunks_with_ids if chunk.metadata["id"] not in existing_ids
-    ]
-    if new_chunks:
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        chroma_db.add_documents(new_chunks, new_chunk_ids)
+    print(
+        f"Ingested {stats.pages} pages into {stats.chunks} chunks, "
+        f"{stats.new_chunks} new in {stats.batches} batches"
+    )
+    if stats.split_seconds:
+        print(
+            f"Split {stats.pages} pages in {stats.split_seconds:.2f}s "
+            f"({stats.pages / stats.split_seconds:.0f} pages/s, "
+            f"{stats.chunks / stats.split_seconds:.0f} chunks/s)"
+        )
+    if strip_boilerplate:
+        print(
+            f"Stripped {stats.boilerplate_chars} boilerplate characters, "
+            f"{stats.boilerplate_chunks} fewer chunks"
+        )
+    print(
+        f"Skipped {stats.skipped_files} unchanged files, removed "
+        f"{stats.removed_files} files and {stats.deleted_chunks} stale chunks"
+    )
+    embedding_stats = chroma_db.embedding_executor.stats
+    print(
+        f"Embedded {embedding_stats.texts} texts in {embedding_stats.batches} "
+        f"batches, {embedding_stats.retries} retries "
+        f"({embedding_stats.throttles} throttled)"
+    )
+    if chroma_db.embedding_cache is not None:
+        cache_stats = chroma_db.embedding_cache.stats
+        print(
+            f"Embedding cache: {cache_stats.hits} hits, {cache_stats.misses} misses, "
+            f"{cache_stats.evictions} evictions"
+        )
+    if bm25:
+        started = time.perf_counter()
+        if update_bm25_index(chroma_db):
+            print(f"Updated the BM25 index in {time.perf_counter() - started:.2f}s")
+    if serving_index:
+        started = time.perf_counter()
+        if update_serving_index(chroma_db):
+            print(f"Wrote the serving index in {time.perf_counter() - started:.2f}s")
 
 
 @app.command()
 def query_rag(
     query_text: str,
-    chroma_path: str = "data/chroma",
-    model_id: str = "anthropic.claude-3-haiku-20240307-v1:0",
+    chroma_path: str = CHROMA_PATH,
+    model_id: str = CHAT_MODEL_ID,
+    embedding_cache: Optional[str] = None,
+    retrieval_mode: RetrievalMode = RetrievalMode.VECTOR,
+    metadata_filters: bool = True,
+    vector_backend: VectorBackend = VectorBackend.CHROMA,
+    vector_precision: VectorPrecision = VectorPrecision.FLOAT32,
+    mmr: bool = False,
+    context_token_budget: int = CONTEXT_TOKEN_BUDGET,
 ) -> QueryResponse:
-    aws_client = load_aws_client("bedrock-runtime")
-    chroma_db = ChromaDatabase(chroma_path=chroma_path, bedrock_client=aws_client)
-    db = chroma_db.get_chroma_db()
-    results = db.similarity_search_with_score(query_text, k=3)
-    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
-    model = ChatBedrock(client=aws_client, model_id=model_id)
-    response = model.invoke(prompt)
-    response_text = response.content
+    engine = RagEngine(
+        chroma_path=chroma_path,
+        model_id=model_id,
+        embedding_cache_path=embedding_cache,
+        retrieval_mode=retrieval_mode,
+        metadata_filters=metadata_filters,
+        vector_backend=vector_backend,
+        vector_precision=vector_precision,
+        mmr=mmr,
+        context_token_budget=context_token_budget,
+    )
+    try:
+        query_response = engine.query(query_text)
+    finally:
+        engine.close()
+    print(
+        f"Response: {query_response.response_text}\nSources: {query_response.sources}"
+    )
+    print(
+        f"Context: {query_response.context_tokens} tokens, "
+        f"{query_response.context_tokens_saved} fewer than the chunks as retrieved"
+    )
+    if mmr:
+        print(
+            f"MMR selection took {1000 * engine.mmr_stats.select_seconds:.2f}ms, "
+            f"fetching candidate embeddings {1000 * engine.mmr_stats.fetch_seconds:.2f}ms"
+        )
+    return query_response
+
 
-    sources = [doc.metadata.get("id", None) for doc, _score in results]
-    print(f"Response: {response_text}\nSources: {sources}")
-    return QueryResponse(
-        query_text=query_text, response_text=response_text, sources=sources
+@app.command()
+def query_batch(
+    input_path: str,
+    output_path: str,
+    chroma_path: str = CHROMA_PATH,
+    model_id: str = CHAT_MODEL_ID,
+    embedding_cache: Optional[str] = None,
+    retrieval_mode: RetrievalMode = RetrievalMode.VECTOR,
+    metadata_filters: bool = True,
+    vector_backend: VectorBackend = VectorBackend.CHROMA,
+    vector_precision: VectorPrecision = VectorPrecision.FLOAT32,
+    mmr: bool = False,
+    context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+    concurrency: int = BATCH_CONCURRENCY,
+    batch_size: int = RETRIEVAL_BATCH_SIZE,
+    store: bool = True,
+    bypass_cache: bool = False,
+) -> QueryBatchStats:
+    with open(input_path) as f:
+        questions = read_questions(f)
+    # Held until the batch is done, so no other run writes to the output.
+    with BatchLock(output_path):
+        stats = QueryBatchStats()
+        pending = pending_questions(questions, output_path, stats)
+        print(
+            f"Read {stats.questions} questions: {stats.duplicates} duplicates, "
+            f"{stats.resumed} already answered in {output_path}, {len(pending)} to answer"
+        )
+        engine = RagEngine(
+            chroma_path=chroma_path,
+            model_id=model_id,
+            embedding_cache_path=embedding_cache,
+            max_pool_connections=max(MAX_POOL_CONNECTIONS, concurrency + batch_size),
+            retrieval_mode=retrieval_mode,
+            metadata_filters=metadata_filters,
+            vector_backend=vector_backend,
+            vector_precision=vector_precision,
+            mmr=mmr,
+            context_token_budget=context_token_budget,
+            micro_batch=True,
+            micro_batch_size=batch_size,
+        )
+        try:
+            answer_questions(
+                engine,
+                pending,
+                output_path,
+                concurrency=concurrency,
+                batch_size=batch_size,
+                store=store,
+                bypass_cache=bypass_cache,
+                stats=stats,
+            )
+        finally:
+            engine.close()
+    print(
+        f"Answered {stats.answered} questions ({stats.cached} from the answer "
+        f"cache), {stats.failed} failed, in {stats.seconds:.1f}s: "
+        f"{stats.questions_per_minute:.1f} questions/min"
+    )
+    batcher_stats = engine.search_batcher.stats
+    print(
+        f"Retrieved in {stats.retrieval_batches} batches in "
+        f"{stats.retrieval_seconds:.1f}s, {batcher_stats.items} searches in "
+        f"{batcher_stats.batches} batched searches"
     )
+    if store:
+        print(f"Stored {stats.stored} queries in DynamoDB")
+    return stats
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import functools
+import os
+import sys
+
+import pytest
+
+# Modules are imported from src, as the scripts and the API do.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_community.chat_models.fake import FakeListChatModel  # noqa: E402
+
+import models.rag_engine  # noqa: E402
+from models.chroma_database import ChromaDatabase  # noqa: E402
+from models.manifest import FileManifest  # noqa: E402
+from models.source_aliases import SourceAliases  # noqa: E402
+from utils.benchmark import DeterministicEmbeddings, generate_corpus  # noqa: E402
+from utils.document_loader import list_pdf_files  # noqa: E402
+from utils.ingestion import ingest_documents  # noqa: E402
+
+# Small vectors keep the offline stores fast; the tests compare rankings,
+# not retrieval quality.
+DIMENSIONS = 64
+
+
+def open_database(chroma_path: str, **kwargs) -> ChromaDatabase:
+    return ChromaDatabase(
+        chroma_path,
+        bedrock_client=object(),
+        embeddings=DeterministicEmbeddings(dimensions=DIMENSIONS),
+        **kwargs,
+    )
+
+
+def ingest(chroma_path: str, source_path: str, **kwargs):
+    """
+    Ingests the PDFs of `source_path` as `populate-database` does, with a
+    manifest and alias table, and returns the ingestion stats.
+    """
+
+    chroma_db = open_database(
+        chroma_path, vector_backend=kwargs.pop("vector_backend", "numpy")
+    )
+    try:
+        return ingest_documents(
+            chroma_db,
+            list_pdf_files(source_path),
+            manifest=FileManifest.load(chroma_path),
+            source_root=source_path,
+            aliases=SourceAliases(chroma_path),
+            **kwargs,
+        )
+    finally:
+        chroma_db.embedding_executor.shutdown()
+
+
+@pytest.fixture
+def corpus(tmp_path) -> str:
+    directory = str(tmp_path / "corpus")
+    generate_corpus(directory, num_files=3, pages_per_file=3)
+    return directory
+
+
+@pytest.fixture
+def make_engine(monkeypatch):
+    """
+    Returns a factory of `RagEngine`s with offline embeddings and a fake
+    chat model, closed at the end of the test.
+    """
+
+    monkeypatch.setattr(
+        models.rag_engine,
+        "ChatBedrock",
+        lambda client, model_id: FakeListChatModel(responses=["answer"]),
+    )
+    monkeypatch.setattr(
+        models.rag_engine,
+        "ChromaDatabase",
+        functools.partial(
+            ChromaDatabase, embeddings=DeterministicEmbeddings(dimensions=DIMENSIONS)
+        ),
+    )
+    engines = []
+
+    def make(chroma_path: str, **kwargs) -> models.rag_engine.RagEngine:
+        kwargs.setdefault("vector_backend", "numpy")
+        engine = models.rag_engine.RagEngine(
+            chroma_path=chroma_path,
+            bedrock_client=object(),
+            **kwargs,
+        )
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.close()
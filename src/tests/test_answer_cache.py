@@ -0,0 +1,73 @@
+from conftest import ingest
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from models.answer_cache import SemanticAnswerCache
+from models.rag import QueryResponse
+
+QUERY = "What was the net income in Q3 2024?"
+PARAPHRASE = "what was net income in Q3 2024"
+
+
+def response(text: str) -> QueryResponse:
+    return QueryResponse(query_text=QUERY, response_text=text, sources=["a.pdf:0"])
+
+
+def test_similar_queries_with_the_same_figures_share_an_answer():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.store(QUERY, [1.0, 0.0], response("answer"), "v1")
+
+    hit = cache.lookup(PARAPHRASE, [0.99, 0.1], "v1")
+    assert (hit.response_text, hit.query_text, hit.cached) == (
+        "answer",
+        PARAPHRASE,
+        True,
+    )
+    # Another quarter, another scope, a dissimilar query or a new index.
+    assert cache.lookup("What was the net income in Q2 2024?", [1.0, 0.0], "v1") is None
+    assert cache.lookup(QUERY, [1.0, 0.0], "v1", scope="hybrid") is None
+    assert cache.lookup(QUERY, [0.0, 1.0], "v1") is None
+    assert cache.lookup(QUERY, [1.0, 0.0], "v2") is None
+    assert len(cache) == 0
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.invalidations) == (
+        1,
+        4,
+        1,
+    )
+
+
+def test_the_least_recently_used_answer_is_evicted():
+    cache = SemanticAnswerCache(threshold=0.9, max_entries=2)
+    cache.store("revenue in 2023", [1.0, 0.0, 0.0], response("a"), "v1")
+    cache.store("revenue in 2024", [0.0, 1.0, 0.0], response("b"), "v1")
+    assert cache.lookup("revenue in 2023", [1.0, 0.0, 0.0], "v1")
+    cache.store("revenue in 2025", [0.0, 0.0, 1.0], response("c"), "v1")
+
+    assert cache.lookup("revenue in 2024", [0.0, 1.0, 0.0], "v1") is None
+    assert cache.lookup("revenue in 2023", [1.0, 0.0, 0.0], "v1").response_text == "a"
+    assert cache.stats.evictions == 1
+
+
+def test_a_stored_answer_replaces_the_answers_of_similar_queries():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.store(QUERY, [1.0, 0.0], response("old"), "v1")
+    cache.store(PARAPHRASE, [0.99, 0.1], response("older"), "v1")
+    cache.store(QUERY, [1.0, 0.0], response("new"), "v1")
+
+    assert len(cache) == 1
+    assert cache.lookup(QUERY, [1.0, 0.0], "v1").response_text == "new"
+    assert cache.lookup(PARAPHRASE, [0.99, 0.1], "v1").response_text == "new"
+    assert cache.stats.evictions == 0
+
+
+def test_bypassing_the_cache_replaces_the_cached_answer(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    engine = make_engine(chroma_path)
+    engine.model = FakeListChatModel(responses=["old", "new"])
+
+    assert engine.query(QUERY).response_text == "old"
+    assert engine.query(QUERY).cached
+    fresh = engine.query(QUERY, bypass_cache=True)
+    assert (fresh.response_text, fresh.cached) == ("new", False)
+    again = engine.query(QUERY)
+    assert (again.response_text, again.cached) == ("new", True)
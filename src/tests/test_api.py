@@ -0,0 +1,258 @@
+import json
+import threading
+import time
+
+import pytest
+from conftest import ingest
+from fastapi.testclient import TestClient
+
+import api.main
+from models.query_model import QueryModel
+
+
+class FakeDynamoDB:
+    """
+    Keeps the items of the DynamoDB client calls QueryModel makes in memory.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.batch_writes = 0
+
+    def put_item(self, TableName, Item):
+        self.items[Item["query_id"]["S"]] = Item
+
+    def get_item(self, TableName, Key):
+        item = self.items.get(Key["query_id"]["S"])
+        return {} if item is None else {"Item": item}
+
+    def batch_write_item(self, RequestItems):
+        self.batch_writes += 1
+        for requests in RequestItems.values():
+            for request in requests:
+                self.put_item(None, request["PutRequest"]["Item"])
+        return {"UnprocessedItems": {}}
+
+
+@pytest.fixture
+def dynamodb(monkeypatch) -> FakeDynamoDB:
+    client = FakeDynamoDB()
+    monkeypatch.setattr(QueryModel, "get_client", classmethod(lambda cls: client))
+    return client
+
+
+@pytest.fixture
+def client(tmp_path, corpus, make_engine, dynamodb, monkeypatch):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    monkeypatch.setattr(api.main, "RagEngine", make_engine)
+    monkeypatch.setenv("CHROMA_PATH", chroma_path)
+    monkeypatch.setenv("VECTOR_BACKEND", "numpy")
+    monkeypatch.setenv("BATCH_OUTPUT_DIR", str(tmp_path / "batches"))
+    monkeypatch.setenv("QUERY_WORKERS", "1")
+    with TestClient(api.main.app) as client:
+        yield client
+
+
+def is_done(item: dict) -> bool:
+    return bool(item.get("is_complete") or item.get("finished"))
+
+
+def wait_for(poll, until=is_done, timeout: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        item = poll()
+        if until(item):
+            return item
+        time.sleep(0.02)
+    raise AssertionError("Timed out")
+
+
+def batch_body(questions: list[str]) -> str:
+    return "\n".join(json.dumps({"query_text": question}) for question in questions)
+
+
+def test_batches_do_not_hold_up_background_queries(client, monkeypatch):
+    engine = client.app.state.rag_engine
+    answer = engine.answer
+    release = threading.Event()
+
+    def held_batch_answer(prepared):
+        if prepared.query_text.startswith("Batch"):
+            release.wait(10)
+        return answer(prepared)
+
+    monkeypatch.setattr(engine, "answer", held_batch_answer)
+    questions = [f"Batch question {n} on net income" for n in range(3)]
+    response = client.post("/submit_queries?batch_id=q3", content=batch_body(questions))
+    assert response.status_code == 200
+    assert response.json()["questions"] == 3
+    # A second submission of a running batch is refused.
+    assert client.post("/submit_queries?batch_id=q3", content="").status_code == 409
+
+    query = client.post(
+        "/submit_query",
+        json={"query_text": "What was the net income?", "background": True},
+    ).json()
+    assert not query["is_complete"]
+    done = wait_for(lambda: client.get(f"/query/{query['query_id']}").json())
+    assert done["answer_text"] == "answer"
+
+    release.set()
+    status = wait_for(lambda: client.get("/query_batch/q3").json())
+    assert (status["answered"], status["failed"], status["error"]) == (3, 0, None)
+    results = client.get("/query_batch/q3/results").text.splitlines()
+    assert sorted(json.loads(line)["query_text"] for line in results) == questions
+    # The workers count a job once it has returned, after its results are
+    # written.
+    metrics = wait_for(
+        lambda: client.get("/metrics").json(),
+        until=lambda metrics: metrics["batch_workers"]["pending"]
+        == metrics["query_workers"]["pending"]
+        == 0,
+    )
+    assert metrics["batch_workers"]["completed"] == 1
+    assert metrics["query_workers"]["completed"] == 1
+
+
+def test_background_queries_take_a_query_slot(client, monkeypatch):
+    engine = client.app.state.rag_engine
+    answer = engine.answer
+
+    def fail_on_revenue(prepared):
+        if "revenue" in prepared.query_text:
+            raise RuntimeError("throttled")
+        return answer(prepared)
+
+    monkeypatch.setattr(engine, "answer", fail_on_revenue)
+    ids = [
+        client.post(
+            "/submit_query", json={"query_text": text, "background": True}
+        ).json()["query_id"]
+        for text in ("What was the net income?", "How much did revenue grow?")
+    ]
+    answered, failed = [
+        wait_for(lambda: client.get(f"/query/{query_id}").json()) for query_id in ids
+    ]
+    assert (answered["answer_text"], answered["error"]) == ("answer", None)
+    assert (failed["answer_text"], failed["error"]) == (None, "throttled")
+
+    metrics = wait_for(
+        lambda: client.get("/metrics").json(),
+        until=lambda metrics: metrics["query_workers"]["pending"] == 0,
+    )
+    assert metrics["query_workers"]["completed"] == 1
+    assert metrics["query_workers"]["failed"] == 1
+    limiter = metrics["query_limiter"]
+    assert (limiter["admitted"], limiter["completed"], limiter["failed"]) == (2, 1, 1)
+    assert limiter["running"] == 0
+
+
+@pytest.fixture
+def one_query_at_a_time(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENT_QUERIES", "1")
+    monkeypatch.setenv("MAX_QUEUED_QUERIES", "0")
+
+
+def test_queries_beyond_the_limits_are_told_when_to_retry(
+    one_query_at_a_time, client, monkeypatch
+):
+    engine = client.app.state.rag_engine
+    answer = engine.answer
+    started, release = threading.Event(), threading.Event()
+
+    def held_answer(prepared):
+        started.set()
+        release.wait(10)
+        return answer(prepared)
+
+    monkeypatch.setattr(engine, "answer", held_answer)
+    body = {"query_text": "What was the net income?"}
+    responses = []
+    running = threading.Thread(
+        target=lambda: responses.append(client.post("/submit_query", json=body))
+    )
+    running.start()
+    try:
+        assert started.wait(10)
+        rejected = client.post("/submit_query", json=body)
+    finally:
+        release.set()
+        running.join()
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "1"
+    assert responses[0].status_code == 200
+    limiter = client.get("/metrics").json()["query_limiter"]
+    assert (limiter["admitted"], limiter["rejected"]) == (1, 1)
+
+
+def server_sent_events(text: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data[6:])))
+    return events
+
+
+def test_answers_stream_as_server_sent_events(client, dynamodb):
+    response = client.post(
+        "/stream_query", json={"query_text": "What was the net income?"}
+    )
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = server_sent_events(response.text)
+    names = [event for event, _data in events]
+    assert names[0] == "sources" and names[-1] == "done"
+    assert set(names[1:-1]) == {"token"}
+    sources, done = events[0][1], events[-1][1]
+    # The fake chat model streams the answer a character at a time.
+    assert "".join(data["text"] for _event, data in events[1:-1]) == "answer"
+    assert sources["sources"] == done["sources"]
+    assert done["query_id"] == sources["query_id"]
+    assert done["is_complete"]
+    assert done["query_id"] in dynamodb.items
+    limiter = client.get("/metrics").json()["query_limiter"]
+    assert (limiter["completed"], limiter["running"]) == (1, 0)
+
+
+def test_a_stream_the_client_left_before_it_started_gives_its_slot_back(client):
+    limiter = client.app.state.query_limiter
+    body = json.dumps({"query_text": "What was the net income?"}).encode()
+
+    async def request_and_disconnect():
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            raise OSError("Client disconnected")
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.4"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/stream_query",
+            "raw_path": b"/stream_query",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("testclient", 50000),
+            "server": ("testserver", 80),
+        }
+        try:
+            await api.main.app(scope, receive, send)
+        except Exception:
+            pass
+
+    for _request in range(limiter.max_concurrency + 1):
+        client.portal.call(request_and_disconnect)
+    assert (limiter.stats.admitted, limiter.stats.running) == (
+        limiter.max_concurrency + 1,
+        0,
+    )
+    response = client.post(
+        "/stream_query", json={"query_text": "What was the net income?"}
+    )
+    assert server_sent_events(response.text)[-1][0] == "done"
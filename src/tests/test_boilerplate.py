@@ -0,0 +1,118 @@
+from langchain.schema.document import Document
+
+from utils.boilerplate import BoilerplateStripper, line_keys, normalize_line
+
+
+def segment_pages() -> list[Document]:
+    return [
+        Document(
+            page_content="\n".join(
+                [
+                    "Royal Bank of Canada Third Quarter 2024",
+                    f"Segment {page} results",
+                    "Net income 1,234 1,200 12%",
+                    "Total revenue 5,021 4,988 7%",
+                    f"Page {page} of 6",
+                ]
+            ),
+            metadata={"page": page},
+        )
+        for page in range(1, 7)
+    ]
+
+
+def test_page_numbers_are_masked():
+    assert normalize_line("Page 3 of 40") == normalize_line("Page  12 of 40")
+    assert normalize_line("- 7 -", 40) == normalize_line("- 8 -", 40)
+
+
+def test_bare_numbers_are_only_page_numbers_in_headers_and_footers():
+    assert normalize_line("2024") == "2024"
+    assert normalize_line("2024", 40) == "2024"
+    assert line_keys("7\nNet income\n2024\nTotal 12", 40) == ["#", None, None, None]
+
+
+def test_figures_are_not_masked():
+    assert normalize_line("Net income 1,234 1,200 12%") != normalize_line(
+        "Net income 1,111 1,000 11%"
+    )
+
+
+def test_strip_removes_headers_and_footers():
+    stripped = BoilerplateStripper().strip(segment_pages())
+
+    for page, document in enumerate(stripped, start=1):
+        assert "Royal Bank of Canada" not in document.page_content
+        assert "Page" not in document.page_content
+        assert f"Segment {page} results" in document.page_content
+
+
+def test_strip_keeps_repeated_table_rows():
+    # Rows repeated verbatim on most pages are boilerplate, but rows whose
+    # figures change from page to page are kept.
+    pages = segment_pages()
+    for page, document in enumerate(pages, start=1):
+        document.page_content = document.page_content.replace(
+            "1,234", f"1,23{page}"
+        ).replace("5,021", f"5,02{page}")
+
+    stripped = BoilerplateStripper().strip(pages)
+
+    for page, document in enumerate(stripped, start=1):
+        assert f"Net income 1,23{page} 1,200 12%" in document.page_content
+        assert f"Total revenue 5,02{page} 4,988 7%" in document.page_content
+
+
+def table_pages(pages: int = 6) -> list[Document]:
+    # A two-column table continued across pages, one cell per line as PDF
+    # extraction often returns it, under a running header and footer.
+    return [
+        Document(
+            page_content="\n".join(
+                [
+                    "Royal Bank of Canada Third Quarter 2024",
+                    f"Segment {page}",
+                    "2024",
+                    "2023",
+                    "Net income",
+                    f"{100 + page}",
+                    f"{90 + page}",
+                    "Total revenue",
+                    "5,021",
+                    "4,988",
+                    "Net income 1,234 1,200 12%",
+                    f"- {page} -",
+                ]
+            ),
+            metadata={"page": page},
+        )
+        for page in range(1, pages + 1)
+    ]
+
+
+def test_strip_keeps_tables_continued_across_pages():
+    stripper = BoilerplateStripper()
+    for _document in range(3):
+        stripped = stripper.strip(table_pages())
+
+    for page, document in enumerate(stripped, start=1):
+        assert document.page_content.splitlines() == [
+            f"Segment {page}",
+            "2024",
+            "2023",
+            "Net income",
+            f"{100 + page}",
+            f"{90 + page}",
+            "Total revenue",
+            "5,021",
+            "4,988",
+            "Net income 1,234 1,200 12%",
+        ]
+
+
+def test_strip_keeps_a_figure_on_the_last_line():
+    pages = [
+        Document(page_content=f"Segment {page}\nNet income\n{100 + page}")
+        for page in range(6)
+    ]
+    assert BoilerplateStripper().strip(pages) == pages
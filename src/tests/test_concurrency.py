@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+import pytest
+
+from api.concurrency import BackgroundWorkers, Overloaded, QueryLimiter
+
+
+def test_query_limiter_answers_429_to_a_full_queue_and_503_to_a_long_wait():
+    async def main() -> QueryLimiter:
+        limiter = QueryLimiter(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        release = threading.Event()
+        running = asyncio.create_task(limiter.run(release.wait, 10))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(limiter.run(lambda: "queued"))
+        await asyncio.sleep(0)
+        assert (limiter.stats.running, limiter.stats.queued) == (1, 1)
+
+        with pytest.raises(Overloaded) as rejected:
+            await limiter.run(lambda: "rejected")
+        assert rejected.value.status_code == 429
+        with pytest.raises(Overloaded) as timed_out:
+            await queued
+        assert timed_out.value.status_code == 503
+
+        release.set()
+        assert await running
+        assert await limiter.run(lambda: "admitted") == "admitted"
+        limiter.shutdown()
+        return limiter
+
+    stats = asyncio.run(main()).stats
+    assert (stats.admitted, stats.completed, stats.failed) == (2, 2, 0)
+    assert (stats.rejected, stats.timed_out) == (1, 1)
+    assert (stats.running, stats.queued) == (0, 0)
+
+
+def test_retry_after_is_the_time_the_waiting_queries_take():
+    limiter = QueryLimiter(max_concurrency=2)
+    assert limiter.retry_after() == 1
+    stats = limiter.stats
+    stats.average_seconds, stats.running, stats.queued = 2.5, 2, 3
+    # Five queries of 2.5 seconds on two threads.
+    assert limiter.retry_after() == 7
+    limiter.shutdown()
+
+
+def test_background_workers_turn_jobs_away_once_every_place_is_taken():
+    workers = BackgroundWorkers(workers=1, max_pending=1)
+    release = threading.Event()
+    done = []
+    for job in range(2):
+        workers.reserve()
+        workers.submit(lambda job=job: (release.wait(10), done.append(job)))
+    with pytest.raises(Overloaded) as error:
+        workers.reserve()
+    assert (error.value.status_code, error.value.retry_after) == (429, 1)
+
+    release.set()
+    workers.shutdown()
+    assert done == [0, 1]
+    assert (workers.stats.completed, workers.stats.pending) == (2, 0)
+    assert workers.stats.rejected == 1
+
+
+def test_background_workers_give_places_back():
+    workers = BackgroundWorkers(workers=1, max_pending=0)
+    workers.reserve()
+    workers.cancel()
+    workers.reserve()
+    workers.submit(lambda: 1 / 0)
+    workers.shutdown()
+    assert (workers.stats.submitted, workers.stats.failed) == (1, 1)
+    # A failed job gives its place back too.
+    workers.reserve()
+    workers.cancel()
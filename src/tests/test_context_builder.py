@@ -0,0 +1,74 @@
+from langchain.schema.document import Document
+
+from utils.context_builder import ContextBuilder
+from utils.document_loader import generate_chunk_ids
+from utils.text_splitter import RegexTokenSplitter, count_tokens
+
+PAGE = "\n".join(
+    f"Line {number}: net interest income rose {number}% on higher volumes."
+    for number in range(40)
+)
+
+
+def page_chunks(source: str = "report.pdf", page: int = 0) -> list[Document]:
+    chunks = RegexTokenSplitter(chunk_size=60, chunk_overlap=20).split_documents(
+        [Document(page_content=PAGE, metadata={"source": source, "page": page})]
+    )
+    return generate_chunk_ids(chunks)
+
+
+def test_overlapping_chunks_of_a_page_merge_back_into_it():
+    chunks = page_chunks()
+    assert len(chunks) > 3
+    # Retrieval ranks chunks by relevance, not by position.
+    ranked = chunks[1::2] + chunks[::2]
+    context = ContextBuilder(token_budget=10_000).build(ranked)
+    assert context.text == PAGE
+    assert context.sections == 1
+    assert context.tokens == count_tokens(PAGE)
+    assert context.tokens_saved > 0
+
+
+def test_chunks_without_positions_merge_in_either_order():
+    head = "Total revenue was $14,633 million, up 11% from last year, reflecting"
+    tail = "up 11% from last year, reflecting higher net interest income."
+    documents = [
+        Document(page_content=text, metadata={"source": "r.pdf", "page": 3, "id": key})
+        for key, text in (("b", tail), ("a", head))
+    ]
+    context = ContextBuilder().build(documents)
+    assert context.sections == 1
+    assert context.text == head + " higher net interest income."
+
+
+def test_repeated_chunks_are_dropped():
+    text = "CET1 ratio of 13.2%, down 10 bps from last quarter."
+    documents = [
+        Document(page_content=text, metadata={"source": source, "page": 0})
+        for source in ("q3.pdf", "q3_copy.pdf")
+    ]
+    context = ContextBuilder().build(documents)
+    assert context.duplicates == 1
+    assert context.text == text
+
+
+def test_sections_fit_the_budget_in_rank_order_and_keep_document_order():
+    documents = [
+        Document(
+            page_content=f"Section {page}: " + "figures " * 30,
+            metadata={"source": "report.pdf", "page": page},
+        )
+        for page in (5, 1, 3)
+    ]
+    builder = ContextBuilder(token_budget=70)
+    context = builder.build(documents)
+    assert context.tokens <= 70
+    assert (context.sections, context.dropped_sections) == (2, 1)
+    assert context.text.index("Section 1") < context.text.index("Section 5")
+    assert "Section 3" not in context.text
+
+    truncated = ContextBuilder(token_budget=10).build(documents)
+    assert truncated.truncated
+    assert truncated.text.startswith("Section 5")
+    assert truncated.tokens == 10
+    assert builder.stats.contexts == 1
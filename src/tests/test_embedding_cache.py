@@ -0,0 +1,87 @@
+from conftest import ingest
+from langchain_core.embeddings import Embeddings
+
+from models.embedding_cache import CachedEmbeddings, EmbeddingCache
+
+
+class InputTypeEmbeddings(Embeddings):
+    """
+    Embeds a query and a document of the same text differently, as models
+    with an input type do, and counts the texts embedded.
+    """
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.embedded.extend(texts)
+        return [[float(len(text)), 0.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        self.embedded.append(text)
+        return [0.0, float(len(text))]
+
+
+def test_texts_are_embedded_once(tmp_path):
+    model = InputTypeEmbeddings()
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    embeddings = CachedEmbeddings(model, cache, "titan")
+
+    first = embeddings.embed_documents(["net income", "revenue", "net income"])
+    assert model.embedded == ["net income", "revenue"]
+    assert embeddings.embed_documents(["revenue", "net income"]) == first[1:]
+    assert model.embedded == ["net income", "revenue"]
+    assert (cache.stats.hits, cache.stats.misses) == (2, 3)
+    cache.close()
+
+    # The vectors are kept on disk for the next run.
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    assert CachedEmbeddings(model, cache, "titan").embed_documents(["revenue"]) == [
+        first[1]
+    ]
+    assert len(model.embedded) == 2
+    # Another model does not reuse them.
+    CachedEmbeddings(model, cache, "cohere").embed_documents(["revenue"])
+    assert len(model.embedded) == 3
+    cache.close()
+
+
+def test_queries_are_cached_apart_from_documents(tmp_path):
+    model = InputTypeEmbeddings()
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    embeddings = CachedEmbeddings(model, cache, "cohere")
+
+    document = embeddings.embed_documents(["net income"])[0]
+    query = embeddings.embed_query("net income")
+    assert (document, query) == ([10.0, 0.0], [0.0, 10.0])
+    assert embeddings.embed_query("net income") == query
+    assert embeddings.embed_documents(["net income"]) == [document]
+    assert model.embedded == ["net income", "net income"]
+    cache.close()
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    model = InputTypeEmbeddings()
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    embeddings = CachedEmbeddings(model, cache, "titan")
+
+    embeddings.embed_documents(["a"])
+    embeddings.embed_documents(["bb"])
+    embeddings.embed_documents(["a"])
+    embeddings.embed_documents(["ccc"])
+    assert (len(cache), cache.stats.evictions) == (2, 1)
+    embeddings.embed_documents(["a", "ccc"])
+    assert model.embedded == ["a", "bb", "ccc"]
+    cache.close()
+
+
+def test_the_engine_does_not_write_an_embedding_cache_by_default(
+    tmp_path, corpus, make_engine, monkeypatch
+):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    monkeypatch.chdir(tmp_path)
+    engine = make_engine(chroma_path)
+    assert engine.chroma_db.embedding_cache is None
+    engine.query("What was the net income?")
+    assert not (tmp_path / "data").exists()
@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+from conftest import ingest
+from langchain_core.embeddings import Embeddings
+
+from models.embedding_executor import (
+    AdaptiveLimiter,
+    EmbeddingExecutor,
+    is_throttling_error,
+)
+
+
+def throttling_error() -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+        "InvokeModel",
+    )
+
+
+class FlakyEmbeddings(Embeddings):
+    """
+    Fails the first call for each text with `error`, then embeds it as its
+    length.
+    """
+
+    def __init__(self, error: Exception):
+        self.error = error
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            if texts[0] not in self.failed:
+                self.failed.add(texts[0])
+                raise self.error
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def embedding_threads() -> list[str]:
+    return [
+        thread.name
+        for thread in threading.enumerate()
+        if thread.name.startswith("embedding")
+    ]
+
+
+def test_throttling_halves_the_limit_and_successes_grow_it_back():
+    limiter = AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 2
+    # About one slot comes back per window of `limit` successful calls.
+    for _call in range(3):
+        limiter.acquire()
+        limiter.release()
+    assert int(limiter.limit) == 3
+    for _call in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 8
+    for _call in range(10):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.limit == 1
+
+
+def test_callers_wait_for_a_slot_under_the_limit():
+    limiter = AdaptiveLimiter(4)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    limiter.acquire()
+    waiting = threading.Thread(target=limiter.acquire)
+    waiting.start()
+    waiting.join(0.05)
+    assert waiting.is_alive()
+    limiter.release()
+    waiting.join(1)
+    assert not waiting.is_alive()
+    assert limiter.in_flight == 1
+
+
+def test_throttling_is_found_in_the_errors_a_client_error_was_raised_from():
+    try:
+        try:
+            raise throttling_error()
+        except ClientError as error:
+            raise ValueError("Error raised by inference endpoint") from error
+    except ValueError as error:
+        assert is_throttling_error(error)
+    assert not is_throttling_error(ValueError("Malformed input request"))
+
+
+def test_failed_batches_are_retried_in_order():
+    texts = [f"text {'x' * n}" for n in range(20)]
+    executor = EmbeddingExecutor(
+        FlakyEmbeddings(throttling_error()), max_workers=4, batch_size=3, base_delay=0
+    )
+    progress = []
+    vectors = executor.embed(
+        texts, on_progress=lambda done, total: progress.append(done)
+    )
+    executor.shutdown()
+    assert vectors == [[float(len(text))] for text in texts]
+    assert progress[-1] == len(texts)
+    assert (executor.stats.texts, executor.stats.batches) == (20, 7)
+    assert executor.stats.retries == executor.stats.throttles == 7
+    assert executor.limiter.limit < 4
+
+
+def test_a_batch_failing_every_retry_raises():
+    executor = EmbeddingExecutor(
+        FlakyEmbeddings(ValueError("Malformed input request")),
+        max_retries=0,
+        base_delay=0,
+    )
+    with pytest.raises(ValueError):
+        executor.embed(["net income"])
+    executor.shutdown()
+    assert executor.stats.throttles == 0
+
+
+def test_a_store_opened_to_search_starts_no_embedding_threads(
+    tmp_path, corpus, make_engine
+):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    assert not embedding_threads()
+    engine = make_engine(chroma_path)
+    engine.query("What was the net income?")
+    assert not embedding_threads()
+    engine.close()
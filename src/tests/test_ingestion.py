@@ -0,0 +1,104 @@
+import pytest
+from conftest import ingest, open_database
+
+from models.chroma_database import ChromaVectorStore
+from models.manifest import FileManifest
+from utils.document_loader import (
+    SplitMethod,
+    generate_chunk_ids,
+    load_documents,
+    split_documents,
+)
+from utils.ingestion import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    TOKEN_CHUNK_OVERLAP,
+    TOKEN_CHUNK_SIZE,
+    batched,
+)
+from utils.text_splitter import count_tokens
+
+
+def serial_chunks(corpus: str, method: SplitMethod):
+    # The load-everything-then-split path the pipeline replaced.
+    if method == SplitMethod.TOKEN:
+        sizes = TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP, count_tokens
+    else:
+        sizes = CHUNK_SIZE, CHUNK_OVERLAP, len
+    chunk_size, chunk_overlap, length_function = sizes
+    return generate_chunk_ids(
+        split_documents(
+            load_documents(corpus),
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+            is_separator_regex=False,
+            method=method,
+        )
+    )
+
+
+def stored_chunks(chroma_path: str, vector_backend: str = "numpy") -> dict[str, str]:
+    chroma_db = open_database(chroma_path, vector_backend=vector_backend)
+    stored = dict(chroma_db.iter_documents())
+    chroma_db.embedding_executor.shutdown()
+    return stored
+
+
+@pytest.mark.parametrize("method", [SplitMethod.RECURSIVE, SplitMethod.TOKEN])
+def test_pipeline_stores_the_chunks_of_the_serial_path(tmp_path, corpus, method):
+    expected = serial_chunks(corpus, method)
+    chroma_path = str(tmp_path / "chroma")
+    # Page ranges and batches that do not line up with files or pages.
+    stats = ingest(
+        chroma_path,
+        corpus,
+        split_method=method,
+        workers=2,
+        pages_per_task=2,
+        batch_size=7,
+    )
+    assert stats.pages == 9
+    assert stats.chunks == stats.new_chunks == len(expected)
+    assert stored_chunks(chroma_path) == {
+        chunk.metadata["id"]: chunk.page_content for chunk in expected
+    }
+
+    manifest = FileManifest.load(chroma_path)
+    for source, record in manifest.files.items():
+        assert record.chunk_ids == [
+            chunk.metadata["id"]
+            for chunk in expected
+            if chunk.metadata["source"] == source
+        ]
+
+
+def test_an_interrupted_ingestion_resumes_without_rewriting_chunks(
+    tmp_path, corpus, monkeypatch
+):
+    # Chroma writes each batch through, so only the batch in flight is lost.
+    chroma_path = str(tmp_path / "chroma")
+    expected = serial_chunks(corpus, SplitMethod.RECURSIVE)
+    upsert = ChromaVectorStore.upsert
+    calls = []
+
+    def fail_on_third_batch(store, *args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError("disk full")
+        return upsert(store, *args)
+
+    monkeypatch.setattr(ChromaVectorStore, "upsert", fail_on_third_batch)
+    with pytest.raises(RuntimeError):
+        ingest(chroma_path, corpus, batch_size=7, vector_backend="chroma")
+    written = len(stored_chunks(chroma_path, "chroma"))
+    assert 0 < written < len(expected)
+
+    monkeypatch.setattr(ChromaVectorStore, "upsert", upsert)
+    stats = ingest(chroma_path, corpus, batch_size=7, vector_backend="chroma")
+    assert stats.new_chunks == len(expected) - written
+    assert len(stored_chunks(chroma_path, "chroma")) == len(expected)
+
+
+def test_batched_keeps_order_and_the_last_partial_batch():
+    assert list(batched(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+from conftest import ingest, open_database
+
+from models.manifest import FileManifest
+
+
+def test_vectors_are_persisted_before_the_manifest(tmp_path, corpus, monkeypatch):
+    chroma_path = str(tmp_path / "chroma")
+    saves = []
+
+    def interrupted_save(manifest):
+        # The first save, of the plan, goes through; the process dies at the
+        # first save of ingested files.
+        saves.append(manifest)
+        if len(saves) > 1:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(FileManifest, "save", interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        ingest(chroma_path, corpus)
+
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert chroma_db.count() > 0
+    chroma_db.embedding_executor.shutdown()
+
+
+def write(path, text: str) -> str:
+    path.write_text(text)
+    return str(path)
+
+
+def test_plan_sorts_files_into_new_changed_unchanged_and_removed(tmp_path):
+    manifest = FileManifest.load(str(tmp_path / "chroma"))
+    kept = write(tmp_path / "kept.pdf", "kept")
+    touched = write(tmp_path / "touched.pdf", "touched")
+    edited = write(tmp_path / "edited.pdf", "edited")
+    removed = write(tmp_path / "removed.pdf", "removed")
+    plan = manifest.plan([kept, touched, edited, removed])
+    assert plan.to_ingest == sorted([edited, kept, removed, touched])
+    for path in plan.to_ingest:
+        manifest.record(path, plan.records[path], [f"{path}:0:0"])
+    manifest.save()
+
+    manifest = FileManifest.load(str(tmp_path / "chroma"))
+    os.utime(touched, (0, 0))
+    write(tmp_path / "edited.pdf", "edited again")
+    added = write(tmp_path / "added.pdf", "added")
+    plan = manifest.plan([added, kept, touched, edited], root=str(tmp_path))
+    assert plan.new == [added]
+    assert plan.changed == [edited]
+    assert plan.unchanged == [kept, touched]
+    assert plan.removed == [removed]
+    assert plan.to_ingest == [added, edited]
+    # A touched file is hashed once, then trusted by its new mtime.
+    assert manifest.files[touched].mtime == 0
+
+
+def test_stale_chunk_ids_keep_chunks_other_files_still_use(tmp_path):
+    manifest = FileManifest.load(str(tmp_path / "chroma"))
+    paths = [write(tmp_path / f"{name}.pdf", name) for name in ("a", "b", "c")]
+    plan = manifest.plan(paths)
+    for path, chunk_ids in zip(paths, (["x", "y"], ["y", "z"], ["w"])):
+        manifest.record(path, plan.records[path], chunk_ids)
+
+    write(tmp_path / "a.pdf", "a changed")
+    plan = manifest.plan(paths[:2], root=str(tmp_path))
+    assert (plan.changed, plan.removed) == ([paths[0]], [paths[2]])
+    assert sorted(manifest.stale_chunk_ids(plan)) == ["w", "x"]
+
+
+def test_unchanged_files_are_not_ingested_again(tmp_path, corpus):
+    chroma_path = str(tmp_path / "chroma")
+    first = ingest(chroma_path, corpus)
+    assert first.new_chunks > 0
+
+    again = ingest(chroma_path, corpus)
+    assert (again.skipped_files, again.pages, again.new_chunks) == (3, 0, 0)
+
+    removed = sorted(os.listdir(corpus))[0]
+    os.remove(os.path.join(corpus, removed))
+    after_removal = ingest(chroma_path, corpus)
+    assert after_removal.removed_files == 1
+    assert after_removal.deleted_chunks > 0
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert chroma_db.count() == first.new_chunks - after_removal.deleted_chunks
+    chroma_db.embedding_executor.shutdown()
+
+
+def test_only_files_under_the_ingested_directory_are_removed(tmp_path):
+    manifest = FileManifest.load(str(tmp_path / "chroma"))
+    (tmp_path / "2023").mkdir()
+    (tmp_path / "2024").mkdir()
+    old = write(tmp_path / "2023" / "q4.pdf", "q4")
+    new = write(tmp_path / "2024" / "q1.pdf", "q1")
+    gone = write(tmp_path / "2024" / "q2.pdf", "q2")
+    plan = manifest.plan([old, new, gone])
+    for path in plan.to_ingest:
+        manifest.record(path, plan.records[path], [f"{path}:0:0"])
+
+    os.remove(gone)
+    assert manifest.plan([new], root=str(tmp_path / "2024")).removed == [gone]
+    assert manifest.plan([new]).removed == []
+    # A sibling directory sharing the prefix is not under the root.
+    assert manifest.plan([], root=str(tmp_path / "202")).removed == []
+
+
+def test_ingesting_another_directory_keeps_the_chunks_of_the_first(tmp_path, corpus):
+    chroma_path = str(tmp_path / "chroma")
+    first = ingest(chroma_path, corpus)
+    other = str(tmp_path / "other")
+    os.makedirs(other)
+    report = sorted(os.listdir(corpus))[0]
+    os.rename(os.path.join(corpus, report), os.path.join(other, report))
+
+    stats = ingest(chroma_path, other)
+    assert (stats.removed_files, stats.deleted_chunks) == (0, 0)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert chroma_db.count() >= first.new_chunks
+    chroma_db.embedding_executor.shutdown()
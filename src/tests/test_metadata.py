@@ -0,0 +1,115 @@
+import numpy as np
+from conftest import ingest
+
+from models.numpy_vector_store import metadata_column, where_mask
+from utils.metadata import (
+    MetadataExtractor,
+    QueryFilters,
+    extract_document_metadata,
+    parse_query_filters,
+)
+
+METADATAS = [
+    {"bank": "RBC", "fiscal_year": 2024, "quarter": 3},
+    {"bank": "RBC", "fiscal_year": 2023, "quarter": 3},
+    {"bank": "RBC", "fiscal_year": 2024, "quarter": 2},
+    {"bank": "TD", "fiscal_year": 2024, "quarter": 3},
+    {"bank": "RBC"},
+]
+
+
+def test_query_filters_name_banks_years_and_quarters():
+    filters = parse_query_filters("RBC net income Q3 2024 vs third quarter of 2023")
+    assert filters.values == {
+        "bank": ["RBC"],
+        "fiscal_year": [2023, 2024],
+        "quarter": [3],
+    }
+    assert filters.to_where() == {
+        "$and": [
+            {"bank": "RBC"},
+            {"fiscal_year": {"$in": [2023, 2024]}},
+            {"quarter": 3},
+        ]
+    }
+    assert [filters.matches(metadata) for metadata in METADATAS] == [
+        True,
+        True,
+        False,
+        False,
+        False,
+    ]
+
+
+def test_queries_naming_nothing_have_no_filters():
+    filters = parse_query_filters("what did the bank say about its outlook")
+    assert not filters
+    assert filters.to_where() is None
+
+
+def test_where_mask_agrees_with_matches():
+    def column(key):
+        return metadata_column(METADATAS, key)
+
+    for filters in (
+        QueryFilters({"bank": ["RBC"]}),
+        QueryFilters({"bank": ["RBC", "TD"], "quarter": [3]}),
+        QueryFilters({"fiscal_year": [2024], "quarter": [2, 3]}),
+        QueryFilters({"bank": ["BMO"]}),
+    ):
+        mask = where_mask(filters.to_where(), len(METADATAS), column)
+        assert mask.tolist() == [filters.matches(metadata) for metadata in METADATAS]
+    mask = where_mask({"bank": {"$ne": "RBC"}}, len(METADATAS), column)
+    assert np.flatnonzero(mask).tolist() == [3]
+
+
+def test_document_metadata_comes_from_the_file_name_first():
+    metadata = extract_document_metadata(
+        "data/rbc_q3_2024_report_to_shareholders.pdf",
+        "TD Bank Group first quarter 2023 earnings release",
+    )
+    assert metadata == {
+        "bank": "RBC",
+        "document_type": "report_to_shareholders",
+        "quarter": 3,
+        "fiscal_year": 2024,
+    }
+
+
+def test_filtered_retrieval_only_returns_matching_chunks(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus, metadata_extractor=MetadataExtractor())
+    engine = make_engine(chroma_path)
+    query = "TD net income and total revenue"
+    results = engine.retrieve(query, filters=parse_query_filters(query))
+    assert results
+    assert {doc.metadata["bank"] for doc, _score in results} == {"TD"}
+
+    # A filter nothing matches falls back to an unfiltered search.
+    query = "CIBC net income"
+    results = engine.retrieve(query, filters=parse_query_filters(query))
+    assert len(results) == engine.k
+
+
+def test_chunks_matching_too_few_for_k_come_before_the_closest_others(
+    tmp_path, corpus, make_engine
+):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus, metadata_extractor=MetadataExtractor())
+    engine = make_engine(chroma_path)
+    chroma_db = engine.chroma_db
+    banks = [
+        doc.metadata["bank"]
+        for chunk_ids in chroma_db.iter_ids()
+        for doc in chroma_db.get(chunk_ids)
+    ]
+    matching = banks.count("TD")
+    assert 0 < matching < len(banks)
+
+    engine.k = matching + 2
+    query = "TD net income and total revenue"
+    results = engine.retrieve(query, filters=parse_query_filters(query))
+    assert len(results) == engine.k
+    banks = [doc.metadata["bank"] for doc, _score in results]
+    assert banks[:matching] == ["TD"] * matching
+    assert "TD" not in banks[matching:]
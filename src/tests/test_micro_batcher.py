@@ -0,0 +1,91 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from conftest import ingest
+
+from models.micro_batcher import MicroBatcher
+
+
+def test_concurrent_items_are_processed_together_and_answered_in_place():
+    batches = []
+
+    def square(items: list[int]) -> list[int]:
+        batches.append(list(items))
+        return [item * item for item in items]
+
+    batcher = MicroBatcher(square, window=0.05, max_batch_size=4)
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(batcher.submit, range(10)))
+    batcher.close()
+    assert results == [item * item for item in range(10)]
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+    assert max(map(len, batches)) == 4
+    assert len(batches) < 10
+    stats = batcher.stats
+    assert (stats.batches, stats.items) == (len(batches), 10)
+    assert sum(size * count for size, count in stats.batch_sizes.items()) == 10
+    assert stats.max_queued_seconds >= 0
+
+
+def test_a_lone_item_waits_one_window_at_most():
+    batcher = MicroBatcher(lambda items: items, window=0.01)
+    assert batcher.submit("only") == "only"
+    batcher.close()
+    assert batcher.stats.batch_sizes == {1: 1}
+    assert batcher.stats.max_queued_seconds < 1
+
+
+def test_errors_are_raised_to_the_callers_they_belong_to():
+    def check(items: list[int]) -> list:
+        if 0 in items:
+            raise RuntimeError("batch failed")
+        return [ValueError(item) if item < 0 else item for item in items]
+
+    batcher = MicroBatcher(check, window=0)
+    assert batcher.submit(1) == 1
+    with pytest.raises(ValueError):
+        batcher.submit(-1)
+    with pytest.raises(RuntimeError):
+        batcher.submit(0)
+    batcher.close()
+    assert (batcher.stats.batches, batcher.stats.failed_batches) == (3, 1)
+
+
+def test_closing_processes_the_items_already_submitted():
+    release = threading.Event()
+
+    def held(items: list[int]) -> list[int]:
+        release.wait(10)
+        return items
+
+    batcher = MicroBatcher(held, window=0, max_batch_size=1)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(batcher.submit, item) for item in range(3)]
+        closing = pool.submit(batcher.close)
+        release.set()
+        assert [future.result() for future in futures] == [0, 1, 2]
+        closing.result()
+    assert batcher.stats.items == 3
+
+
+def test_batched_searches_find_what_single_searches_do(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    engine = make_engine(chroma_path)
+    batched = make_engine(chroma_path, micro_batch=True, micro_batch_window=0.02)
+    queries = [
+        "What was the net income?",
+        "How much did total revenue grow?",
+        "What is the CET1 ratio?",
+        "RBC net income Q3 2024",
+    ] * 2
+
+    def ids(engine, query: str) -> list[str]:
+        return [doc.metadata["id"] for doc, _score in engine.retrieve(query)]
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        found = list(pool.map(lambda query: ids(batched, query), queries))
+    assert found == [ids(engine, query) for query in queries]
+    assert batched.search_batcher.stats.items >= len(queries)
+    assert batched.search_batcher.stats.batches < batched.search_batcher.stats.items
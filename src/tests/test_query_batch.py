@@ -0,0 +1,169 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pytest
+from conftest import ingest
+
+from api.concurrency import QueryLimiter
+from utils.query_batch import (
+    BatchLock,
+    BatchRunning,
+    QueryBatchStats,
+    answer_questions,
+    pending_questions,
+    read_batch_status,
+)
+
+QUESTIONS = [
+    "What was the net income?",
+    "How much did total revenue grow?",
+    "What is the CET1 ratio?",
+]
+
+
+def run_batch(engine, output_path: str) -> QueryBatchStats:
+    stats = QueryBatchStats()
+    questions = pending_questions(QUESTIONS, output_path, stats)
+    return answer_questions(
+        engine, questions, output_path, concurrency=2, store=False, stats=stats
+    )
+
+
+def read_results(output_path: str) -> list[dict]:
+    with open(output_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_pending_questions_skip_repeats_and_answered_questions(tmp_path):
+    output_path = tmp_path / "answers.jsonl"
+    answered = {"query_text": "What was the net income?", "error": None}
+    failed = {"query_text": "What is the CET1 ratio?", "error": "throttled"}
+    # A run stopped while writing leaves a last line without its newline.
+    output_path.write_text(
+        json.dumps(answered) + "\n" + json.dumps(failed) + "\n" + '{"query_te'
+    )
+    stats = QueryBatchStats()
+    pending = pending_questions(
+        QUESTIONS + ["  what was the NET income? "], str(output_path), stats
+    )
+    assert pending == QUESTIONS[1:]
+    assert (stats.questions, stats.duplicates, stats.resumed) == (4, 1, 1)
+    assert output_path.read_text().endswith("}\n")
+
+
+def test_failed_questions_are_retried_without_duplicates(
+    tmp_path, corpus, make_engine, monkeypatch
+):
+    chroma_path = str(tmp_path / "chroma")
+    output_path = str(tmp_path / "answers.jsonl")
+    ingest(chroma_path, corpus)
+    engine = make_engine(chroma_path)
+    answer = engine.answer
+
+    def fail_on_revenue(prepared):
+        if "revenue" in prepared.query_text:
+            raise RuntimeError("throttled")
+        return answer(prepared)
+
+    monkeypatch.setattr(engine, "answer", fail_on_revenue)
+    stats = run_batch(engine, output_path)
+    assert (stats.answered, stats.failed) == (2, 1)
+    assert len(read_results(output_path)) == 2
+
+    monkeypatch.setattr(engine, "answer", answer)
+    stats = run_batch(engine, output_path)
+    assert (stats.resumed, stats.answered, stats.failed) == (2, 1, 0)
+    results = read_results(output_path)
+    assert sorted(result["query_text"] for result in results) == sorted(QUESTIONS)
+    assert all(result["error"] is None for result in results)
+    assert read_batch_status(output_path) == stats
+
+
+def test_a_batch_lock_is_held_once(tmp_path):
+    output_path = str(tmp_path / "batches" / "q3.jsonl")
+    with BatchLock(output_path):
+        assert BatchLock(output_path).held()
+        with pytest.raises(BatchRunning):
+            BatchLock(output_path).acquire()
+    assert not BatchLock(output_path).held()
+    with BatchLock(output_path):
+        pass
+
+
+def test_batch_slots_count_against_the_query_limit():
+    running, most = 0, 0
+    lock = threading.Lock()
+
+    def work(limiter: QueryLimiter):
+        nonlocal running, most
+        with limiter.slot():
+            with lock:
+                running += 1
+                most = max(most, running)
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+
+    async def main():
+        limiter = QueryLimiter(max_concurrency=2)
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            futures = [pool.submit(work, limiter) for _ in range(12)]
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+        # Let the slots given back from the threads be released.
+        await asyncio.sleep(0)
+        limiter.shutdown()
+        return limiter.stats
+
+    stats = asyncio.run(main())
+    assert most == 2
+    assert (stats.completed, stats.running) == (12, 0)
+
+
+def test_every_embedding_search_and_answer_takes_a_slot(
+    tmp_path, corpus, make_engine, monkeypatch
+):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    engine = make_engine(chroma_path)
+    limit = threading.BoundedSemaphore(2)
+    lock = threading.Lock()
+    taken, running, most = 0, 0, 0
+
+    @contextmanager
+    def query_slot():
+        nonlocal taken, running, most
+        with limit:
+            with lock:
+                taken += 1
+                running += 1
+                most = max(most, running)
+            try:
+                yield
+            finally:
+                with lock:
+                    running -= 1
+
+    embed_query = engine.embed_query
+
+    def slow_embed_query(query_text):
+        time.sleep(0.005)
+        return embed_query(query_text)
+
+    monkeypatch.setattr(engine, "embed_query", slow_embed_query)
+    questions = [f"What was the net income of segment {n} in Q3?" for n in range(12)]
+    stats = answer_questions(
+        engine,
+        questions,
+        str(tmp_path / "answers.jsonl"),
+        batch_size=32,
+        store=False,
+        query_slot=query_slot,
+    )
+    assert stats.answered == len(questions)
+    assert most == 2
+    # One slot per embedding and search, and per answer not found cached.
+    assert taken == 3 * len(questions) - stats.cached
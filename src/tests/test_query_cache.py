@@ -0,0 +1,89 @@
+import pytest
+
+import models.query_cache
+from models.query_cache import QueryEmbeddingCache
+
+
+class Embedder:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text: str) -> list[float]:
+        self.texts.append(text)
+        return [float(len(self.texts)), 0.0]
+
+
+class SharedCache:
+    def __init__(self, failing: bool = False):
+        self.vectors = {}
+        self.failing = failing
+
+    def get(self, key):
+        if self.failing:
+            raise ConnectionError("redis is down")
+        return self.vectors.get(key)
+
+    def set(self, key, vector, ttl):
+        if self.failing:
+            raise ConnectionError("redis is down")
+        self.vectors[key] = vector
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(models.query_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_queries_differing_in_case_and_spaces_share_a_vector(clock):
+    cache = QueryEmbeddingCache()
+    embed = Embedder()
+    vector = cache.get_or_embed("titan", "What is RBC's  CET1 ratio?", embed)
+    assert cache.get_or_embed("titan", "what is rbc's cet1 ratio?", embed) == vector
+    assert cache.get_or_embed("cohere", "What is RBC's CET1 ratio?", embed) != vector
+    # The query is embedded as asked, not in its normalized form.
+    assert embed.texts == ["What is RBC's  CET1 ratio?", "What is RBC's CET1 ratio?"]
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+
+def test_vectors_expire_after_the_ttl(clock):
+    cache = QueryEmbeddingCache(ttl=60)
+    embed = Embedder()
+    cache.get_or_embed("titan", "net income", embed)
+    clock[0] = 59
+    cache.get_or_embed("titan", "net income", embed)
+    clock[0] = 60
+    cache.get_or_embed("titan", "net income", embed)
+    assert len(embed.texts) == 2
+    assert cache.stats.expirations == 1
+
+
+def test_the_least_recently_used_vector_is_evicted(clock):
+    cache = QueryEmbeddingCache(max_entries=2)
+    embed = Embedder()
+    for text in ("a", "b", "a", "c", "a", "b"):
+        cache.get_or_embed("titan", text, embed)
+    assert embed.texts == ["a", "b", "c", "b"]
+    assert len(cache) == 2
+    assert cache.stats.evictions == 2
+
+
+def test_workers_share_vectors_through_the_shared_cache(clock):
+    shared = SharedCache()
+    embed = Embedder()
+    first = QueryEmbeddingCache(shared=shared)
+    second = QueryEmbeddingCache(shared=shared)
+    vector = first.get_or_embed("titan", "net income", embed)
+    assert second.get_or_embed("titan", "Net  income", embed) == vector
+    assert len(embed.texts) == 1
+    assert second.stats.shared_hits == 1
+
+
+def test_shared_cache_errors_are_misses(clock):
+    cache = QueryEmbeddingCache(shared=SharedCache(failing=True))
+    embed = Embedder()
+    cache.get_or_embed("titan", "net income", embed)
+    cache.get_or_embed("titan", "net income", embed)
+    assert len(embed.texts) == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
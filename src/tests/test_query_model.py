@@ -0,0 +1,76 @@
+import pytest
+
+import models.query_model
+from models.query_model import BATCH_WRITE_RETRIES, BATCH_WRITE_SIZE, QueryModel
+
+
+class ThrottledDynamoDB:
+    """
+    Leaves all but the first `processed` items of each BatchWriteItem call
+    unprocessed, as DynamoDB does when a table is throttled.
+    """
+
+    def __init__(self, processed: int):
+        self.processed = processed
+        self.calls = []
+        self.items = {}
+
+    def batch_write_item(self, RequestItems):
+        ((table, requests),) = RequestItems.items()
+        self.calls.append(len(requests))
+        for request in requests[: self.processed]:
+            item = request["PutRequest"]["Item"]
+            self.items[item["query_id"]["S"]] = item
+        unprocessed = requests[self.processed :]
+        return {"UnprocessedItems": {table: unprocessed} if unprocessed else {}}
+
+
+@pytest.fixture
+def delays(monkeypatch) -> list[float]:
+    slept = []
+    monkeypatch.setattr(models.query_model.time, "sleep", slept.append)
+    return slept
+
+
+def use_client(monkeypatch, client):
+    monkeypatch.setattr(QueryModel, "get_client", classmethod(lambda cls: client))
+
+
+def test_batch_writes_retry_unprocessed_items(monkeypatch, delays):
+    client = ThrottledDynamoDB(processed=10)
+    use_client(monkeypatch, client)
+    queries = [QueryModel(query_text=f"Question {n}") for n in range(30)]
+    QueryModel.batch_put_items(queries)
+
+    assert client.calls == [BATCH_WRITE_SIZE, 15, 5, 5]
+    assert set(client.items) == {query.query_id for query in queries}
+    # The backoff doubles on each retry of a request.
+    assert len(delays) == 2
+    assert delays[1] > delays[0]
+
+
+def test_batch_writes_give_up_after_the_last_retry(monkeypatch, delays):
+    use_client(monkeypatch, ThrottledDynamoDB(processed=0))
+    with pytest.raises(RuntimeError, match="1 items were left unprocessed"):
+        QueryModel.batch_put_items([QueryModel(query_text="Net income?")])
+    assert len(delays) == BATCH_WRITE_RETRIES
+
+
+def test_items_round_trip_through_dynamodb_attributes():
+    query = QueryModel(
+        query_text="What was the net income?",
+        answer_text="$4,033 million",
+        sources=["rbc.pdf:3:0", "rbc.pdf:4:1"],
+        is_complete=True,
+        cached=True,
+    )
+    item = query.as_ddb_item()
+    assert item["sources"] == {"L": [{"S": "rbc.pdf:3:0"}, {"S": "rbc.pdf:4:1"}]}
+    assert "error" not in item
+    assert QueryModel.from_ddb_item(item) == query
+
+
+def test_items_written_with_string_sources_are_read():
+    item = QueryModel(query_text="Net income?").as_ddb_item()
+    item["sources"] = {"S": "['rbc.pdf:3:0']"}
+    assert QueryModel.from_ddb_item(item).sources == ["rbc.pdf:3:0"]
@@ -0,0 +1,185 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from conftest import ingest, open_database
+
+from models.bm25_index import (
+    BM25_DIR,
+    TEXT_HASHES,
+    BM25Index,
+    reciprocal_rank_fusion,
+    update_bm25_index,
+)
+from models.mmr import maximal_marginal_relevance
+from models.rag_engine import HYBRID_CANDIDATES, RetrievalMode
+from utils.metadata import parse_query_filters
+
+QUERY = "Common Equity Tier 1 ratio and net interest income"
+
+
+def greedy_mmr(query, embeddings, k, lambda_mult):
+    # The textbook selection loop, recomputing every score at each step.
+    unit = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    relevance = unit @ (query / np.linalg.norm(query))
+    selected = []
+    while len(selected) < k:
+        scores = [
+            (
+                lambda_mult * relevance[i]
+                - (1 - lambda_mult) * max((unit[i] @ unit[j] for j in selected))
+                if selected
+                else relevance[i]
+            )
+            for i in range(len(embeddings))
+        ]
+        for i in selected:
+            scores[i] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+
+def test_reciprocal_rank_fusion_favours_ids_ranked_by_both_lists():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a", "d"]])
+    assert [chunk_id for chunk_id, _score in fused] == ["a", "c", "b", "d"]
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 62)
+    assert fused[-1][1] == pytest.approx(1 / 63)
+
+
+@pytest.mark.parametrize("lambda_mult", [0.3, 0.5, 0.8])
+def test_mmr_matches_the_greedy_selection(lambda_mult):
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(40, 16)).astype(np.float32)
+    query = rng.normal(size=16).astype(np.float32)
+    selected = maximal_marginal_relevance(query, embeddings.copy(), 8, lambda_mult)
+    assert selected.tolist() == greedy_mmr(query, embeddings, 8, lambda_mult)
+
+
+def test_mmr_skips_near_duplicates():
+    embeddings = np.array(
+        [[1.0, 0.0, 0.0], [0.99, 0.14, 0.0], [0.7, 0.0, 0.7]], dtype=np.float32
+    )
+    query = np.array([1.0, 0.0, 0.1], dtype=np.float32)
+    by_relevance = maximal_marginal_relevance(query, embeddings.copy(), 2, 1.0)
+    diverse = maximal_marginal_relevance(query, embeddings.copy(), 2, 0.5)
+    assert by_relevance.tolist() == [0, 1]
+    assert diverse.tolist() == [0, 2]
+
+
+def assert_same_index(index: BM25Index, expected: BM25Index):
+    assert sorted(index.chunk_ids) == sorted(expected.chunk_ids)
+    assert index.vocabulary.keys() == expected.vocabulary.keys()
+    for query in (QUERY, "net income Q3 2024", "CET1 1,234.5 revenue"):
+        found = dict(index.search(query, len(expected)))
+        assert found.keys() == dict(expected.search(query, len(expected))).keys()
+        for chunk_id, score in expected.search(query, len(expected)):
+            assert found[chunk_id] == pytest.approx(score)
+
+
+def test_an_updated_bm25_index_matches_one_built_afresh():
+    documents = {
+        "a": "Net income rose to $1,234.5 million in Q3 2024",
+        "b": "The CET1 ratio was 13.2%",
+        "c": "Revenue grew on net interest income",
+        "d": "Common Equity Tier 1 capital",
+    }
+    index = BM25Index.build(documents.items())
+    documents["b"] = "The CET1 ratio fell to 12.8%"
+    del documents["c"]
+    documents["e"] = "Net interest income and revenue in Q3 2024"
+
+    updated = index.update(documents.items())
+    assert_same_index(updated, BM25Index.build(documents.items()))
+    # Terms only a removed chunk held are dropped.
+    assert "grew" not in updated.vocabulary
+
+
+def test_only_changed_chunks_are_tokenized_again(tmp_path, corpus, monkeypatch):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert update_bm25_index(chroma_db)
+    assert not update_bm25_index(chroma_db)
+    chroma_db.embedding_executor.shutdown()
+
+    removed, copied = sorted(os.listdir(corpus))[:2]
+    os.remove(os.path.join(corpus, removed))
+    copy = os.path.join(corpus, f"copy_{copied}")
+    shutil.copy(os.path.join(corpus, copied), copy)
+    stats = ingest(chroma_path, corpus)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    tokenized = []
+    build = BM25Index.build.__func__
+
+    def counting_build(cls, documents, index_version=""):
+        documents = list(documents)
+        tokenized.extend(documents)
+        return build(cls, documents, index_version)
+
+    monkeypatch.setattr(BM25Index, "build", classmethod(counting_build))
+    assert update_bm25_index(chroma_db)
+    monkeypatch.undo()
+    assert len(tokenized) == stats.new_chunks > 0
+    assert all(chunk_id.startswith(f"{copy}:") for chunk_id, _text in tokenized)
+
+    index = BM25Index.load(os.path.join(chroma_path, BM25_DIR))
+    assert index.index_version == chroma_db.index_version()
+    assert_same_index(index, BM25Index.build(chroma_db.iter_documents()))
+    chroma_db.embedding_executor.shutdown()
+
+
+def test_an_index_without_text_hashes_is_rebuilt(tmp_path, corpus):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    update_bm25_index(chroma_db)
+    directory = os.path.join(chroma_path, BM25_DIR)
+    os.remove(os.path.join(directory, f"{TEXT_HASHES}.npy"))
+    index = BM25Index.load(directory)
+    assert index.text_hashes is None
+
+    rebuilt = index.update(chroma_db.iter_documents())
+    assert rebuilt.text_hashes is not None
+    assert_same_index(rebuilt, index)
+    chroma_db.embedding_executor.shutdown()
+
+
+def test_hybrid_retrieval_fuses_the_vector_and_keyword_rankings(
+    tmp_path, corpus, make_engine
+):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert update_bm25_index(chroma_db)
+    chroma_db.embedding_executor.shutdown()
+
+    engine = make_engine(chroma_path, retrieval_mode=RetrievalMode.HYBRID)
+    assert not parse_query_filters(QUERY)
+    vector_ids = [
+        doc.metadata["id"]
+        for doc, _distance in engine.chroma_db.search(
+            engine.embed_query(QUERY), HYBRID_CANDIDATES
+        )
+    ]
+    lexical = engine.lexical_index(engine.chroma_db.index_version())
+    keyword_ids = [
+        chunk_id for chunk_id, _score in lexical.search(QUERY, HYBRID_CANDIDATES)
+    ]
+    expected = reciprocal_rank_fusion([vector_ids, keyword_ids])[: engine.k]
+
+    results = engine.retrieve(QUERY)
+    assert [(doc.metadata["id"], score) for doc, score in results] == expected
+    # Some of the best keyword matches are not vector matches at all.
+    assert set(keyword_ids[:3]) - set(vector_ids)
+
+
+def test_mmr_retrieval_returns_k_distinct_chunks(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus)
+    engine = make_engine(chroma_path, mmr=True)
+    results = engine.retrieve(QUERY)
+    chunk_ids = [doc.metadata["id"] for doc, _score in results]
+    assert len(chunk_ids) == engine.k
+    assert len(set(chunk_ids)) == engine.k
+    assert engine.mmr_stats.selections == 1
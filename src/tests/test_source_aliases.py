@@ -0,0 +1,67 @@
+import os
+import shutil
+
+from conftest import ingest, open_database
+
+from utils.document_loader import ChunkIdMode, content_chunk_id
+
+
+def copy_report(corpus: str) -> tuple[str, str]:
+    original = sorted(os.listdir(corpus))[0]
+    copy = f"copy_{original}"
+    shutil.copy(os.path.join(corpus, original), os.path.join(corpus, copy))
+    return os.path.join(corpus, original), os.path.join(corpus, copy)
+
+
+def test_content_ids_store_shared_chunks_once(tmp_path, corpus):
+    chroma_path = str(tmp_path / "chroma")
+    ingest(chroma_path, corpus, chunk_id_mode=ChunkIdMode.CONTENT)
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    stored = chroma_db.count()
+    assert stored > 0
+    chroma_db.embedding_executor.shutdown()
+
+    copy_report(corpus)
+    stats = ingest(chroma_path, corpus, chunk_id_mode=ChunkIdMode.CONTENT)
+
+    chroma_db = open_database(chroma_path, vector_backend="numpy")
+    assert stats.new_chunks == 0
+    assert chroma_db.count() == stored
+    for chunk_ids in chroma_db.iter_ids():
+        for chunk_id, document in zip(chunk_ids, chroma_db.get(chunk_ids)):
+            assert chunk_id == content_chunk_id(document.page_content)
+    chroma_db.embedding_executor.shutdown()
+
+
+def test_sources_are_cited_from_files_still_present(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    original, copy = copy_report(corpus)
+    ingest(chroma_path, corpus, chunk_id_mode=ChunkIdMode.CONTENT)
+
+    engine = make_engine(chroma_path)
+    results = engine.retrieve("Report to Shareholders net income")
+    _cited, sources = engine.cite(results)
+    assert any(source.startswith(f"{original}:") for source in sources)
+    assert any(source.startswith(f"{copy}:") for source in sources)
+
+    # The chunks stay stored under the removed file, which is no longer
+    # cited.
+    os.remove(original)
+    ingest(chroma_path, corpus, chunk_id_mode=ChunkIdMode.CONTENT)
+    cited, sources = engine.cite(engine.retrieve("Report to Shareholders net income"))
+    assert sources
+    assert not any(source.startswith(f"{original}:") for source in sources)
+    assert all(doc.metadata["source"] != original for doc, _score in cited)
+
+
+def test_position_ids_are_cited_as_before(tmp_path, corpus, make_engine):
+    chroma_path = str(tmp_path / "chroma")
+    copy_report(corpus)
+    ingest(chroma_path, corpus)
+
+    engine = make_engine(chroma_path)
+    results = engine.retrieve("Report to Shareholders net income")
+    cited, sources = engine.cite(results)
+    assert cited == results
+    assert sources == [doc.metadata["id"] for doc, _score in results]
+    assert all(source.count(":") == 2 for source in sources)
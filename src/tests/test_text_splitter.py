@@ -0,0 +1,60 @@
+import pytest
+
+from utils.text_splitter import (
+    TOKEN_PATTERN,
+    RegexTokenSplitter,
+    count_tokens,
+    line_token_counts,
+)
+
+TEXTS = [
+    "Net income of $4,033 million, up 12% from last year.",
+    "Common Equity Tier 1 (CET1) ratio\n\n13.1%\t(Q2: 12.8%)",
+    "Café – l’été: naïve résumé…",
+    "日本語 テキスト、です。",
+    "snake_case and a\x1cfile separator",
+    "",
+]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_token_counts_match_the_token_pattern(text):
+    assert count_tokens(text) == len(TOKEN_PATTERN.findall(text))
+    assert line_token_counts(text) == [
+        len(TOKEN_PATTERN.findall(line)) for line in text.split("\n")
+    ]
+
+
+def test_chunks_stay_within_the_chunk_size():
+    text = "\n".join(
+        f"Line {number}: revenue grew 5.2% in Q{number}." for number in range(60)
+    )
+    text += "\n" + " ".join(["word"] * 400)
+    splitter = RegexTokenSplitter(chunk_size=40, chunk_overlap=10)
+    chunks = splitter.split_text(text)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 40 for chunk in chunks)
+    assert "Line 0:" in chunks[0]
+    assert chunks[-1].endswith("word")
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        " ".join(f"$1,234.5%(Q{number})" for number in range(200)),
+        " ".join(["word"] * 400),
+        " ".join(
+            f"revenue {number}.{number}% (Q{number % 4 + 1})" for number in range(150)
+        ),
+        "x" * 50 + "." * 60,
+    ],
+)
+def test_long_lines_are_cut_into_chunks_within_the_chunk_size(line):
+    splitter = RegexTokenSplitter(chunk_size=40, chunk_overlap=10)
+    chunks = splitter.split_text(line)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 40 for chunk in chunks)
+    # Windows are filled to within one word of the chunk size.
+    assert all(count_tokens(chunk) > 30 for chunk in chunks[:-1])
+    assert chunks[0] == line[: len(chunks[0])]
+    assert line.endswith(chunks[-1])
@@ -0,0 +1,158 @@
+import threading
+
+import numpy as np
+import pytest
+
+import models.faiss_vector_store
+from models.numpy_vector_store import NumpyVectorStore
+from models.serving_index import MmapVectorStore, write_serving_index
+from models.vector_store import VectorPrecision
+
+COUNT = 600
+DIMENSIONS = 32
+K = 5
+BANKS = ["RBC", "TD", "BMO"]
+WHERE = {"$and": [{"bank": "RBC"}, {"quarter": {"$in": [1, 2]}}]}
+
+
+@pytest.fixture(scope="module")
+def records():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(COUNT, DIMENSIONS)).astype(np.float32)
+    ids = [f"chunk-{row}" for row in range(COUNT)]
+    metadatas = [
+        {"id": chunk_id, "bank": BANKS[row % 3], "quarter": row % 4 + 1}
+        for row, chunk_id in enumerate(ids)
+    ]
+    queries = rng.normal(size=(8, DIMENSIONS)).astype(np.float32)
+    return ids, vectors, metadatas, queries
+
+
+def expected_ids(records, query, where=None) -> list[str]:
+    ids, vectors, metadatas, _queries = records
+    rows = np.arange(COUNT)
+    if where is not None:
+        rows = np.array(
+            [
+                row
+                for row in rows
+                if metadatas[row]["bank"] == "RBC" and metadatas[row]["quarter"] <= 2
+            ]
+        )
+    distances = ((vectors[rows] - query) ** 2).sum(axis=1)
+    return [ids[rows[i]] for i in np.argsort(distances)[:K]]
+
+
+def result_ids(results) -> list[str]:
+    return [document.metadata["id"] for document, _distance in results]
+
+
+def fill(store, records):
+    ids, vectors, metadatas, _queries = records
+    store.upsert(ids, vectors, [f"text of {chunk_id}" for chunk_id in ids], metadatas)
+    store.persist()
+    return store
+
+
+def assert_exact(store, records):
+    queries = records[3]
+    batch = store.search_batch(queries, K)
+    filtered = store.search_batch(queries, K, WHERE)
+    for query, found, found_filtered in zip(queries, batch, filtered):
+        assert result_ids(found) == expected_ids(records, query)
+        assert result_ids(store.search(query, K)) == result_ids(found)
+        assert result_ids(found_filtered) == expected_ids(records, query, WHERE)
+        distances = [distance for _document, distance in found]
+        assert distances == sorted(distances)
+        assert distances[0] == pytest.approx(
+            float(((records[1] - query) ** 2).sum(axis=1).min()), rel=1e-4
+        )
+
+
+def test_numpy_search_is_exact(tmp_path, records):
+    store = fill(NumpyVectorStore(str(tmp_path / "numpy")), records)
+    assert_exact(store, records)
+    assert_exact(NumpyVectorStore(str(tmp_path / "numpy")), records)
+
+
+@pytest.mark.parametrize("precision", [VectorPrecision.FLOAT16, VectorPrecision.INT8])
+def test_quantized_search_rescores_to_the_exact_results(tmp_path, records, precision):
+    store = fill(
+        NumpyVectorStore(str(tmp_path / "numpy"), precision=precision), records
+    )
+    assert_exact(store, records)
+
+
+def test_faiss_search_matches_exact_search(tmp_path, records, monkeypatch):
+    pytest.importorskip("faiss")
+    monkeypatch.setattr(models.faiss_vector_store, "FAISS_MIN_VECTORS", 0)
+    path = str(tmp_path / "faiss")
+    store = fill(
+        models.faiss_vector_store.FaissVectorStore(path, index_factory="Flat"), records
+    )
+    assert store.ann_index() is not None
+    assert_exact(store, records)
+    reopened = models.faiss_vector_store.FaissVectorStore(path, index_factory="Flat")
+    assert reopened.ann_index().ntotal == COUNT
+    assert_exact(reopened, records)
+
+
+def test_faiss_results_match_their_rows_while_rows_are_rewritten(
+    tmp_path, records, monkeypatch
+):
+    pytest.importorskip("faiss")
+    monkeypatch.setattr(models.faiss_vector_store, "FAISS_MIN_VECTORS", 0)
+    ids, vectors, metadatas, queries = records
+    store = fill(
+        models.faiss_vector_store.FaissVectorStore(
+            str(tmp_path / "faiss"), index_factory="Flat"
+        ),
+        records,
+    )
+    done = threading.Event()
+    groups = [range(start, start + 50) for start in range(0, COUNT, 50)]
+
+    def rewrite():
+        # Deleting a group of chunks moves the last rows into theirs, and
+        # re-adding them has the index rebuilt.
+        while not done.is_set():
+            for group in groups:
+                moved = [ids[row] for row in group]
+                store.delete(moved)
+                store.upsert(
+                    moved,
+                    vectors[group],
+                    [f"text of {chunk_id}" for chunk_id in moved],
+                    [metadatas[row] for row in group],
+                )
+
+    def nearest(query, missing=range(0)) -> list[str]:
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        distances[missing] = np.inf
+        return [ids[row] for row in np.argsort(distances)[:K]]
+
+    # Each search sees all chunks, or all but the group being moved.
+    expected = [
+        [nearest(query)] + [nearest(query, group) for group in groups]
+        for query in queries
+    ]
+    writer = threading.Thread(target=rewrite)
+    writer.start()
+    try:
+        for _round in range(50):
+            for found, allowed in zip(store.search_batch(queries, K), expected):
+                assert result_ids(found) in allowed
+    finally:
+        done.set()
+        writer.join()
+
+
+def test_serving_index_matches_the_store_it_was_written_from(tmp_path, records):
+    store = fill(NumpyVectorStore(str(tmp_path / "numpy")), records)
+    directory = str(tmp_path / "serving")
+    write_serving_index(store, directory, index_version="v1")
+    serving = MmapVectorStore(directory)
+    assert serving.count() == COUNT
+    assert serving.index_version == "v1"
+    assert_exact(serving, records)
+    assert serving.get(["chunk-7"])[0].page_content == "text of chunk-7"
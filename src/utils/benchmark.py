@@ -0,0 +1,242 @@
+import ctypes
+import gc
+import hashlib
+import os
+import random
+import resource
+import sys
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+BANKS = ["RBC", "TD", "BMO", "Scotiabank", "CIBC", "National Bank"]
+SEGMENTS = [
+    "Personal & Commercial Banking",
+    "Wealth Management",
+    "Capital Markets",
+    "Insurance",
+    "Corporate Support",
+]
+METRICS = [
+    "net income",
+    "total revenue",
+    "non-interest expense",
+    "provision for credit losses",
+    "net interest income",
+    "return on equity",
+    "CET1 ratio",
+]
+WORDS = (
+    "the bank reported higher results driven by volume growth in loans and "
+    "deposits partially offset by lower margins and higher costs related to "
+    "technology investments staff compensation and regulatory requirements "
+    "credit quality remained stable across retail and wholesale portfolios"
+).split()
+LINES_PER_PAGE = 40
+
+
+class DeterministicEmbeddings(Embeddings):
+    """
+    Offline stand-in for `BedrockEmbeddings`. Each text is mapped to a unit
+    vector seeded by its hash, so the same text always gets the same vector,
+    and every call sleeps `latency` seconds per text to mimic one Bedrock
+    request per text.
+
+    Args:
+        dimensions (int): Vector size; Titan text v1 uses 1536.
+        latency (float): Seconds slept per embedded text.
+    """
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _embed(self, text: str) -> list[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        seed = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+        vector = np.random.default_rng(int.from_bytes(seed, "little")).standard_normal(
+            self.dimensions
+        )
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: list[list[str]]):
+    """
+    Writes a minimal PDF with one text line per entry of each page, using
+    only the standard Helvetica font, so no PDF library is needed.
+
+    Args:
+        path (str): The file to write.
+        pages (list[list[str]]): The lines of each page.
+    """
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(
+        f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode("latin-1")
+    )
+    font_id = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        objects.append(
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                f"/Contents {4 + 2 * i} 0 R "
+                f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+            ).encode("latin-1")
+        )
+        text = " ".join(f"({_escape(line)}) '" for line in lines)
+        stream = f"BT /F1 9 Tf 40 760 Td 11 TL {text} ET".encode("latin-1")
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n".encode("latin-1")
+            + stream
+            + b"\nendstream"
+        )
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+    xref_offset = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    data += b"".join(
+        f"{offset:010d} 00000 n \n".encode("latin-1") for offset in offsets
+    )
+    data += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def synthetic_report(
+    rng: random.Random, bank: str, quarter: int, year: int, num_pages: int
+) -> list[list[str]]:
+    title = f"{bank} Report to Shareholders - Q{quarter} {year}"
+    pages = []
+    for page in range(1, num_pages + 1):
+        lines = [title, ""]
+        while len(lines) < LINES_PER_PAGE - 2:
+            if rng.random() < 0.3:
+                segment = rng.choice(SEGMENTS)
+                metric = rng.choice(METRICS)
+                current = rng.uniform(100, 9000)
+                previous = current * rng.uniform(0.8, 1.2)
+                lines.append(
+                    f"{segment} {metric} ${current:,.0f} million "
+                    f"${previous:,.0f} million "
+                    f"{(current / previous - 1) * 100:+.1f}%"
+                )
+            else:
+                lines.append(" ".join(rng.choices(WORDS, k=rng.randint(8, 16))))
+        lines.extend(["", f"Page {page} of {num_pages}"])
+        pages.append(lines)
+    return pages
+
+
+def generate_corpus(
+    directory: str, num_files: int, pages_per_file: int, seed: int = 0
+) -> list[str]:
+    """
+    Writes `num_files` synthetic quarterly reports of `pages_per_file` pages
+    each, with running headers, page footers and tables of figures. The same
+    `seed` always produces the same corpus.
+
+    Returns:
+        paths (list[str]): The written PDF files.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(num_files):
+        bank = BANKS[i % len(BANKS)]
+        year = 2020 + (i // (4 * len(BANKS))) % 5
+        quarter = (i // len(BANKS)) % 4 + 1
+        path = os.path.join(directory, f"{bank.lower().replace(' ', '_')}_{i:04d}.pdf")
+        write_pdf(path, synthetic_report(rng, bank, quarter, year, pages_per_file))
+        paths.append(path)
+    return paths
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """
+    Returns the peak resident set size of this process, or of its finished
+    child processes, in MiB.
+    """
+
+    usage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    )
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale / (1 << 20)
+
+
+def release_free_memory():
+    """
+    Returns memory freed by the process to the OS where glibc allows it, so
+    RSS readings are not inflated by earlier, freed allocations.
+    """
+
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def private_memory_mb() -> float:
+    """
+    Returns the anonymous resident memory of this process in MiB, on Linux,
+    or the peak resident set size elsewhere. Unlike the resident set size,
+    it leaves out file pages such as memory-mapped indexes, which the page
+    cache shares between processes.
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def clustered_vectors(
+    rng: np.random.Generator, count: int, dimensions: int, clusters: int = 64
+) -> np.ndarray:
+    """
+    Returns `count` unit vectors drawn around `clusters` random centres, a
+    closer match to the neighbourhood structure of text embeddings than
+    uniformly random vectors.
+    """
+
+    centres = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+    vectors = centres[rng.integers(clusters, size=count)]
+    vectors += 0.75 * rng.standard_normal((count, dimensions), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def directory_size_mb(directory: str) -> float:
+    total = 0
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total / (1 << 20)
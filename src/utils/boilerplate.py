@@ -0,0 +1,149 @@
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from langchain.schema.document import Document
+
+DIGITS_PATTERN = re.compile(r"\d+")
+# Page numbers in running headers and footers: "Page 3", "Page 3 of 40",
+# "3 / 40", or a bare "- 3 -".
+PAGE_NUMBER_PATTERN = re.compile(r"\bpage\s+\d+(?:\s*(?:of|/)\s*\d+)?\b", re.IGNORECASE)
+BARE_PAGE_NUMBER_PATTERN = re.compile(
+    r"^[\s|\-–]*\d{1,4}(?:\s*(?:of|/)\s*\d+)?[\s|\-–]*$"
+)
+# A figure as it appears in a financial table: "2024", "1,234", "12%",
+# "$1,234.5", "(56)" or "-3.2".
+FIGURE_PATTERN = re.compile(r"^[$€£(+\-–−]*\d[\d,.]*[%)]*$")
+
+
+@dataclass
+class BoilerplateStats:
+    documents: int = 0
+    removed_lines: int = 0
+    removed_chars: int = 0
+
+
+def normalize_line(line: str, page_count: Optional[int] = None) -> str:
+    # Only page numbers are masked, so "Page 3 of 40" matches across pages.
+    # Any other line with figures, such as a table row, only repeats when
+    # its figures do. A bare number is only a page number in a header or
+    # footer position, passed as the `page_count` of the document, and when
+    # it is no larger than that count.
+    line = " ".join(line.split())
+    if (
+        page_count is not None
+        and BARE_PAGE_NUMBER_PATTERN.match(line)
+        and all(int(number) <= page_count for number in DIGITS_PATTERN.findall(line))
+    ):
+        return DIGITS_PATTERN.sub("#", line)
+    return PAGE_NUMBER_PATTERN.sub(
+        lambda match: DIGITS_PATTERN.sub("#", match.group()), line
+    )
+
+
+def is_table_cell(line: str) -> bool:
+    tokens = line.split()
+    return bool(tokens) and all(FIGURE_PATTERN.match(token) for token in tokens)
+
+
+def is_table_row(line: str) -> bool:
+    return any(FIGURE_PATTERN.match(token) for token in line.split())
+
+
+def line_keys(text: str, page_count: int) -> list[Optional[str]]:
+    """
+    Returns the normalized form of each line of a page, or None for lines
+    that are never boilerplate: table cells, labels next to them, and table
+    rows below the header and above the footer. Only the first and last
+    lines of a page can hold a running header or footer.
+    """
+
+    lines = text.splitlines()
+    filled = [index for index, line in enumerate(lines) if line.strip()]
+    edges = {filled[0], filled[-1]} if filled else set()
+    keys = [
+        normalize_line(line, page_count if index in edges else None)
+        for index, line in enumerate(lines)
+    ]
+    cells = {index for index, key in enumerate(keys) if is_table_cell(key)}
+    for position, index in enumerate(filled):
+        neighbours = filled[max(position - 1, 0) : position + 2]
+        if (
+            index in cells
+            or any(neighbour in cells for neighbour in neighbours)
+            or (index not in edges and is_table_row(keys[index]))
+        ):
+            keys[index] = None
+    return [key or None for key in keys]
+
+
+class BoilerplateStripper:
+    """
+    Removes lines repeated across the pages of a document, such as running
+    headers, footers and legal notices. A line is boilerplate when it
+    appears on at least `min_page_fraction` of a document's pages (and on at
+    least `min_pages` pages), or when it was boilerplate in
+    `min_documents` earlier documents, which catches disclaimers that
+    appear once per report but in every report of a bank. Table cells,
+    the labels next to them and table rows are never removed, so a table
+    continued across pages keeps its figures (see `line_keys`).
+
+    Args:
+        min_page_fraction (float): Fraction of pages a line must appear on.
+        min_pages (int): Minimum number of pages a line must appear on.
+        min_documents (int): Documents a line must have been boilerplate in
+            before it is removed from any document.
+    """
+
+    def __init__(
+        self,
+        min_page_fraction: float = 0.5,
+        min_pages: int = 3,
+        min_documents: int = 2,
+    ):
+        self.min_page_fraction = min_page_fraction
+        self.min_pages = min_pages
+        self.min_documents = min_documents
+        self.document_counts = Counter()
+        self.stats = BoilerplateStats()
+
+    def find_boilerplate(self, pages: list[list[Optional[str]]]) -> set[str]:
+        page_counts = Counter()
+        for keys in pages:
+            page_counts.update(keys)
+        page_counts.pop(None, None)
+        threshold = max(self.min_pages, self.min_page_fraction * len(pages))
+        repeated = {line for line, count in page_counts.items() if count >= threshold}
+        self.document_counts.update(repeated)
+        known = {
+            line
+            for line in page_counts
+            if self.document_counts[line] >= self.min_documents
+        }
+        return repeated | known
+
+    def strip(self, pages: list[Document]) -> list[Document]:
+        """
+        Returns the pages of one document with boilerplate lines removed.
+        """
+
+        keys = [line_keys(page.page_content, len(pages)) for page in pages]
+        boilerplate = self.find_boilerplate(keys)
+        self.stats.documents += 1
+        if not boilerplate:
+            return pages
+
+        stripped = []
+        for page, page_keys in zip(pages, keys):
+            kept = []
+            for line, key in zip(page.page_content.splitlines(), page_keys):
+                if key in boilerplate:
+                    self.stats.removed_lines += 1
+                    self.stats.removed_chars += len(line)
+                else:
+                    kept.append(line)
+            stripped.append(
+                Document(page_content="\n".join(kept), metadata=page.metadata)
+            )
+        return stripped
@@ -0,0 +1,236 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from langchain.schema.document import Document
+
+from utils.document_loader import normalize_text
+from utils.text_splitter import TOKEN_PATTERN, count_tokens
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+CONTEXT_TOKEN_BUDGET = 3000
+# Chunks that are not known to be neighbours are only merged when one
+# repeats at least this much of the other, so a shared short phrase does
+# not join unrelated passages.
+MIN_OVERLAP_CHARS = 20
+
+
+def chunk_position(document: Document) -> tuple[str, int, Optional[int]]:
+    """
+    Returns the source and page of a chunk, and its index on the page, known
+    only for position-based chunk IDs (`source:page:index`).
+    """
+
+    source = str(document.metadata.get("source"))
+    page = document.metadata.get("page")
+    page_id = f"{source}:{page}"
+    page = page if isinstance(page, int) else -1
+    chunk_id = str(document.metadata.get("id", ""))
+    if chunk_id.startswith(f"{page_id}:"):
+        index = chunk_id[len(page_id) + 1 :]
+        if index.isdigit():
+            return source, page, int(index)
+    return source, page, None
+
+
+def overlap_length(head: str, tail: str) -> int:
+    """
+    Returns the length of the longest suffix of `head` that `tail` starts
+    with.
+    """
+
+    # Only positions where the start of `tail` occurs can begin an overlap.
+    probe = tail[:MIN_OVERLAP_CHARS]
+    start = head.find(probe, max(0, len(head) - len(tail)))
+    while start != -1:
+        if tail.startswith(head[start:]):
+            return len(head) - start
+        start = head.find(probe, start + 1)
+    return 0
+
+
+def truncate_tokens(text: str, tokens: int) -> str:
+    if tokens <= 0:
+        return ""
+    for count, match in enumerate(TOKEN_PATTERN.finditer(text), start=1):
+        if count == tokens:
+            return text[: match.end()]
+    return text
+
+
+@dataclass
+class Section:
+    page: tuple[str, int]
+    text: str
+    rank: int
+    first_index: Optional[int]
+    last_index: Optional[int]
+    chunk_ids: list = field(default_factory=list)
+
+    def extend(self, text: str, index: Optional[int], adjacent: bool) -> bool:
+        """
+        Appends a chunk that continues this section, or prepends one that
+        leads into it. Returns whether the chunk was merged.
+        """
+
+        overlap = overlap_length(self.text, text)
+        if overlap >= min(MIN_OVERLAP_CHARS, len(text)) or adjacent:
+            self.text += text[overlap:] if overlap else f"\n{text}"
+            self.last_index = index
+            return True
+        if self.first_index is None and index is None:
+            overlap = overlap_length(text, self.text)
+            if overlap >= MIN_OVERLAP_CHARS:
+                self.text = text + self.text[overlap:]
+                return True
+        return False
+
+
+@dataclass
+class BuiltContext:
+    text: str
+    tokens: int
+    original_tokens: int
+    chunks: int = 0
+    sections: int = 0
+    duplicates: int = 0
+    dropped_sections: int = 0
+    truncated: bool = False
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.original_tokens - self.tokens
+
+
+@dataclass
+class ContextStats:
+    contexts: int = 0
+    original_tokens: int = 0
+    tokens: int = 0
+    tokens_saved: int = 0
+    duplicates: int = 0
+    dropped_sections: int = 0
+    truncated: int = 0
+
+
+class ContextBuilder:
+    """
+    Assembles the prompt context from retrieved chunks. Chunks of the same
+    `source:page` that are neighbours or overlap, as chunks split with an
+    overlap do, are merged into one section with the repeated text removed;
+    chunks whose text is already in the context are dropped. Sections are
+    added in order of their best-ranked chunk while they fit in
+    `token_budget` tokens, the first one being cut short if it alone does
+    not, and are then laid out in document order.
+
+    Args:
+        token_budget (int): Maximum context length in tokens, counted as
+            chunks are at ingest.
+        separator (str): Text placed between sections.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        separator: str = CONTEXT_SEPARATOR,
+    ):
+        self.token_budget = token_budget
+        self.separator = separator
+        self.separator_tokens = count_tokens(separator)
+        self.stats = ContextStats()
+        self._lock = threading.Lock()
+
+    def _sections(self, documents: list[Document]) -> tuple[list[Section], int]:
+        seen: set[str] = set()
+        pages: dict[tuple[str, int], list] = {}
+        duplicates = 0
+        for rank, document in enumerate(documents):
+            normalized = normalize_text(document.page_content)
+            if not normalized or normalized in seen:
+                duplicates += 1
+                continue
+            seen.add(normalized)
+            source, page, index = chunk_position(document)
+            pages.setdefault((source, page), []).append((index, rank, document))
+
+        sections = []
+        for page, chunks in pages.items():
+            # Chunks with a known position are merged in page order; the
+            # others in rank order, in whichever direction they overlap.
+            chunks.sort(key=lambda chunk: (chunk[0] is None, chunk[0] or 0, chunk[1]))
+            page_sections: list[Section] = []
+            for index, rank, document in chunks:
+                text = document.page_content.strip()
+                chunk_id = document.metadata.get("id")
+                if any(text in section.text for section in page_sections):
+                    duplicates += 1
+                    continue
+                for section in page_sections:
+                    adjacent = (
+                        index is not None
+                        and section.last_index is not None
+                        and index == section.last_index + 1
+                    )
+                    if section.extend(text, index, adjacent):
+                        section.rank = min(section.rank, rank)
+                        section.chunk_ids.append(chunk_id)
+                        break
+                else:
+                    page_sections.append(
+                        Section(page, text, rank, index, index, [chunk_id])
+                    )
+            sections.extend(page_sections)
+        return sections, duplicates
+
+    def build(self, documents: list[Document]) -> BuiltContext:
+        """
+        Returns the context for `documents`, given best first, with the
+        tokens it takes and the tokens the chunks joined as they are would.
+        """
+
+        original_tokens = count_tokens(
+            self.separator.join(document.page_content for document in documents)
+        )
+        sections, duplicates = self._sections(documents)
+        kept = []
+        tokens = 0
+        truncated = False
+        for section in sorted(sections, key=lambda section: section.rank):
+            available = self.token_budget - tokens
+            if kept:
+                available -= self.separator_tokens
+            section_tokens = count_tokens(section.text)
+            if section_tokens > available:
+                if kept:
+                    continue
+                # The best section alone is cut to the budget rather than
+                # leaving the context empty.
+                section.text = truncate_tokens(section.text, available)
+                section_tokens = count_tokens(section.text)
+                truncated = True
+            tokens += section_tokens + (self.separator_tokens if kept else 0)
+            kept.append(section)
+
+        # Sections of one page keep the order they were merged in.
+        order = {id(section): position for position, section in enumerate(sections)}
+        kept.sort(key=lambda section: (section.page, order[id(section)]))
+        text = self.separator.join(section.text for section in kept)
+        context = BuiltContext(
+            text=text,
+            tokens=count_tokens(text),
+            original_tokens=original_tokens,
+            chunks=len(documents),
+            sections=len(kept),
+            duplicates=duplicates,
+            dropped_sections=len(sections) - len(kept),
+            truncated=truncated,
+        )
+        with self._lock:
+            self.stats.contexts += 1
+            self.stats.original_tokens += context.original_tokens
+            self.stats.tokens += context.tokens
+            self.stats.tokens_saved += context.tokens_saved
+            self.stats.duplicates += context.duplicates
+            self.stats.dropped_sections += context.dropped_sections
+            self.stats.truncated += context.truncated
+        return context
@@ -1,13 +1,123 @@
-from typing import Callable
+import hashlib
+import re
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
+import pypdf
 from langchain.schema.document import Document
-from langchain_community.document_loaders import PyPDFDirectoryLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from utils.text_splitter import RegexTokenSplitter
 
-def load_documents(source_path: str):
-    document_loader = PyPDFDirectoryLoader(source_path)
-    return document_loader.load()
+CONTENT_CHUNK_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+PDF_GLOB = "**/[!.]*.pdf"
+PAGES_PER_TASK = 25
+
+
+class ChunkIdMode(str, Enum):
+    POSITION = "position"
+    CONTENT = "content"
+
+
+class SplitMethod(str, Enum):
+    RECURSIVE = "recursive"
+    TOKEN = "token"
+
+
+def list_pdf_files(source_path: str) -> list[str]:
+    root = Path(source_path)
+    return sorted(
+        str(path)
+        for path in root.glob(PDF_GLOB)
+        if path.is_file()
+        and not any(part.startswith(".") for part in path.relative_to(root).parts)
+    )
+
+
+def count_pages(file_path: str) -> int:
+    return len(pypdf.PdfReader(file_path).pages)
+
+
+def parse_page_range(file_path: str, start: int, stop: int) -> list[Document]:
+    reader = pypdf.PdfReader(file_path)
+    return [
+        Document(
+            page_content=reader.pages[page].extract_text(),
+            metadata={"source": file_path, "page": page},
+        )
+        for page in range(start, stop)
+    ]
+
+
+def _page_ranges(
+    file_paths: Iterable[str], pages_per_task: int
+) -> Iterator[tuple[str, int, int]]:
+    for file_path in file_paths:
+        total_pages = count_pages(file_path)
+        for start in range(0, total_pages, pages_per_task):
+            yield file_path, start, min(start + pages_per_task, total_pages)
+
+
+def _ordered_map(
+    executor: Executor, fn: Callable, tasks: Iterable[tuple], max_in_flight: int
+) -> Iterator:
+    """
+    Maps `fn` over `tasks` in an executor, keeping at most `max_in_flight`
+    tasks pending and yielding results in submission order.
+    """
+
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, *task))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_documents(
+    file_paths: Iterable[str],
+    workers: int = 1,
+    pages_per_task: int = PAGES_PER_TASK,
+) -> Iterator[list[Document]]:
+    """
+    Parses PDF files page range by page range, yielding the pages of each
+    range in file and page order.
+
+    Args:
+        file_paths (Iterable[str]): The PDF files to parse.
+        workers (int): Number of worker processes. `1` parses in-process.
+        pages_per_task (int): Pages parsed per task, so large files are
+            spread across several workers.
+    """
+
+    tasks = _page_ranges(file_paths, pages_per_task)
+    if workers <= 1:
+        for task in tasks:
+            yield parse_page_range(*task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from _ordered_map(
+            executor, parse_page_range, tasks, max_in_flight=workers * 2
+        )
+
+
+def load_documents(
+    source_path: str,
+    workers: int = 1,
+    pages_per_task: int = PAGES_PER_TASK,
+):
+    documents = []
+    for pages in iter_documents(
+        list_pdf_files(source_path), workers=workers, pages_per_task=pages_per_task
+    ):
+        documents.extend(pages)
+    return documents
 
 
 def split_documents(
@@ -16,7 +126,16 @@ def split_documents(
     chunk_overlap: int,
     length_function: Callable[[str], int],
     is_separator_regex: bool,
+    method: SplitMethod = SplitMethod.RECURSIVE,
 ):
+    if method == SplitMethod.TOKEN:
+        text_splitter = RegexTokenSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+        )
+        return text_splitter.split_documents(documents)
+
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
@@ -26,7 +145,26 @@ def split_documents(
     return text_splitter.split_documents(documents)
 
 
-def generate_chunk_ids(chunks: list[Document]):
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def content_chunk_id(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def is_content_chunk_id(chunk_id: str) -> bool:
+    return CONTENT_CHUNK_ID_PATTERN.fullmatch(chunk_id or "") is not None
+
+
+def generate_chunk_ids(
+    chunks: list[Document], mode: ChunkIdMode = ChunkIdMode.POSITION
+):
+    if mode == ChunkIdMode.CONTENT:
+        for chunk in chunks:
+            chunk.metadata["id"] = content_chunk_id(chunk.page_content)
+        return chunks
+
     last_page_id = None
     current_chunk_index = 0
     for chunk in chunks:
@@ -0,0 +1,425 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Optional
+
+from langchain.schema.document import Document
+from loguru import logger
+
+from models.manifest import FileManifest
+from models.source_aliases import SourceAliases
+from utils.boilerplate import BoilerplateStripper
+from utils.document_loader import (
+    PAGES_PER_TASK,
+    ChunkIdMode,
+    SplitMethod,
+    generate_chunk_ids,
+    iter_documents,
+    split_documents,
+)
+from utils.metadata import MetadataExtractor
+from utils.text_splitter import count_tokens
+
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 120
+TOKEN_CHUNK_SIZE = 150
+TOKEN_CHUNK_OVERLAP = 30
+BATCH_SIZE = 256
+QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _StageClock:
+    # Time spent producing items, and the part of it spent waiting for the
+    # upstream queue; the difference is the time the stage did work.
+    def __init__(self):
+        self.running = 0.0
+        self.waiting = 0.0
+
+    @property
+    def busy(self) -> float:
+        return self.running - self.waiting
+
+
+@dataclass
+class IngestionStats:
+    pages: int = 0
+    chunks: int = 0
+    new_chunks: int = 0
+    batches: int = 0
+    skipped_files: int = 0
+    removed_files: int = 0
+    deleted_chunks: int = 0
+    split_seconds: float = 0.0
+    boilerplate_chars: int = 0
+    boilerplate_chunks: int = 0
+    stage_seconds: dict[str, float] = field(default_factory=dict)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _put(outbox: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _drain(
+    inbox: queue.Queue, stop: threading.Event, clock: Optional[_StageClock] = None
+) -> Iterator:
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            item = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        finally:
+            if clock is not None:
+                clock.waiting += time.perf_counter() - started
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def _run_stage(
+    produce: Callable[[], Iterable],
+    outbox: queue.Queue,
+    stop: threading.Event,
+    clock: _StageClock,
+):
+    items = None
+    try:
+        items = iter(produce())
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                clock.running += time.perf_counter() - started
+            _put(outbox, item, stop)
+            if stop.is_set():
+                return
+        _put(outbox, _DONE, stop)
+    except BaseException as error:
+        _put(outbox, _Failure(error), stop)
+    finally:
+        if hasattr(items, "close"):
+            items.close()
+
+
+def run_pipeline(
+    source: Iterable,
+    stages: list[Callable[[Iterable], Iterable]],
+    queue_size: int = QUEUE_SIZE,
+    stage_seconds: Optional[dict[str, float]] = None,
+) -> Iterator:
+    """
+    Runs `source` and each stage in its own thread, connected by bounded
+    queues, and yields the output of the last stage.
+
+    Each stage takes the iterator of its upstream items and returns an
+    iterator of items for the next one, so stages may regroup items. Once
+    a queue is full its producer blocks, which keeps the number of items in
+    flight at `queue_size` per stage. The first error raised by any stage
+    stops the pipeline and is re-raised to the caller.
+
+    Args:
+        source (Iterable): The items fed into the first stage.
+        stages (list[Callable]): The stages, in order.
+        queue_size (int): Maximum number of items waiting between stages.
+        stage_seconds (dict[str, float]): Optional dict that receives the
+            time each stage spent working, excluding time blocked on its
+            queues, keyed by "source" and by stage function name.
+    """
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    clocks = [_StageClock() for _ in range(len(stages) + 1)]
+    producers = [lambda: source]
+    producers.extend(
+        lambda stage=stage, inbox=inbox, clock=clock: stage(_drain(inbox, stop, clock))
+        for stage, inbox, clock in zip(stages, queues, clocks[1:])
+    )
+    threads = [
+        threading.Thread(
+            target=_run_stage, args=(produce, outbox, stop, clock), daemon=True
+        )
+        for produce, outbox, clock in zip(producers, queues, clocks)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from _drain(queues[-1], stop)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if stage_seconds is not None:
+            names = ["source"] + [stage.__name__ for stage in stages]
+            for name, clock in zip(names, clocks):
+                stage_seconds[name] = stage_seconds.get(name, 0.0) + clock.busy
+
+
+def ingest_documents(
+    chroma_db,
+    file_paths: Iterable[str],
+    batch_size: int = BATCH_SIZE,
+    workers: int = 1,
+    pages_per_task: int = PAGES_PER_TASK,
+    queue_size: int = QUEUE_SIZE,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    split_method: SplitMethod = SplitMethod.RECURSIVE,
+    manifest: Optional[FileManifest] = None,
+    source_root: Optional[str] = None,
+    chunk_id_mode: ChunkIdMode = ChunkIdMode.POSITION,
+    aliases: Optional[SourceAliases] = None,
+    boilerplate: Optional[BoilerplateStripper] = None,
+    metadata_extractor: Optional[MetadataExtractor] = None,
+) -> IngestionStats:
+    """
+    Streams PDF files into the vector store through a
+    load -> split -> id -> dedupe -> embed -> upsert pipeline.
+
+    Chunks move through the pipeline in batches of `batch_size`, and each
+    batch is written to the store as soon as it is embedded, so memory stays
+    flat as the corpus grows and a failure only loses the batch in flight.
+    Chunk IDs are deterministic, so re-running after a crash skips every
+    batch that was already written. With `ChunkIdMode.CONTENT` a chunk whose
+    text is already stored, from any file, is neither embedded nor written
+    again; `aliases` then records every `source:page` it appears in.
+
+    With a `manifest`, unchanged files are skipped before parsing, the
+    chunks of changed and removed files are deleted first, and each file is
+    recorded in the manifest once all of its chunks are written. A recorded
+    file counts as removed only if it lies under `source_root`.
+
+    With a `boilerplate` stripper, a strip stage between load and split
+    buffers the pages of each document and removes its repeated headers,
+    footers and notices before they are chunked. With a
+    `metadata_extractor`, the bank, document type, fiscal year and quarter
+    of each document are added to the metadata of its pages, and so of its
+    chunks, before anything is stripped.
+
+    Args:
+        chroma_db (ChromaDatabase): The vector store to write to.
+        file_paths (Iterable[str]): The PDF files to ingest.
+        batch_size (int): Number of chunks embedded and written together.
+        workers (int): Number of processes parsing PDFs.
+        pages_per_task (int): Pages parsed per worker task.
+        queue_size (int): Maximum number of batches waiting between stages.
+        chunk_size (int): Chunk size passed to the splitter, in characters
+            or, with `SplitMethod.TOKEN`, in tokens.
+        chunk_overlap (int): Chunk overlap passed to the splitter.
+        split_method (SplitMethod): The splitter to use.
+        manifest (FileManifest): Optional file manifest to plan against and
+            update.
+        source_root (str): The directory `file_paths` were listed from;
+            recorded files under it that are not in `file_paths` are
+            removed from the store. Without it no file is removed.
+        chunk_id_mode (ChunkIdMode): How chunk IDs are derived.
+        aliases (SourceAliases): Optional chunk to source alias table.
+        boilerplate (BoilerplateStripper): Optional boilerplate stripper.
+        metadata_extractor (MetadataExtractor): Optional document metadata
+            extractor.
+
+    Returns:
+        stats (IngestionStats): Counts of pages, chunks and written chunks,
+            and the time each pipeline stage spent working.
+    """
+
+    if split_method == SplitMethod.TOKEN:
+        length_function = count_tokens
+        chunk_size = chunk_size or TOKEN_CHUNK_SIZE
+        chunk_overlap = TOKEN_CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+    else:
+        length_function = len
+        chunk_size = chunk_size or CHUNK_SIZE
+        chunk_overlap = CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+
+    stats = IngestionStats()
+    if manifest is not None:
+        plan = manifest.plan(file_paths, root=source_root)
+        stale_ids = manifest.stale_chunk_ids(plan)
+        chroma_db.delete(stale_ids)
+        manifest.forget(plan.changed + plan.removed)
+        if aliases is not None:
+            aliases.remove_sources(plan.changed + plan.removed)
+        # Likewise, the deletes are persisted before the chunk IDs are
+        # forgotten.
+        chroma_db.flush()
+        manifest.save()
+        file_paths = plan.to_ingest
+        stats.skipped_files = len(plan.unchanged)
+        stats.removed_files = len(plan.removed)
+        stats.deleted_chunks = len(stale_ids)
+    # IDs that passed dedupe but may not be written yet; bounded by the
+    # number of batches in flight rather than by the collection size.
+    in_flight_ids = set()
+    in_flight_lock = threading.Lock()
+
+    def split_pages(pages: list[Document]) -> list[Document]:
+        return split_documents(
+            pages,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+            is_separator_regex=False,
+            method=split_method,
+        )
+
+    def strip_boilerplate(
+        page_batches: Iterable[list[Document]],
+    ) -> Iterator[list[Document]]:
+        def strip(pages: list[Document]) -> list[Document]:
+            removed_chars = boilerplate.stats.removed_chars
+            stripped = boilerplate.strip(pages)
+            if boilerplate.stats.removed_chars > removed_chars:
+                stats.boilerplate_chars += (
+                    boilerplate.stats.removed_chars - removed_chars
+                )
+                stats.boilerplate_chunks += len(split_pages(pages)) - len(
+                    split_pages(stripped)
+                )
+            return stripped
+
+        document = []
+        for pages in page_batches:
+            if (
+                document
+                and pages[0].metadata["source"] != document[0].metadata["source"]
+            ):
+                yield strip(document)
+                document = []
+            document.extend(pages)
+        if document:
+            yield strip(document)
+
+    def annotate(page_batches: Iterable[list[Document]]) -> Iterator[list[Document]]:
+        for pages in page_batches:
+            yield metadata_extractor.annotate(pages)
+
+    def split(page_batches: Iterable[list[Document]]) -> Iterator[list[Document]]:
+        for pages in page_batches:
+            stats.pages += len(pages)
+            started = time.perf_counter()
+            chunks = split_pages(pages)
+            stats.split_seconds += time.perf_counter() - started
+            yield chunks
+
+    def generate_ids(chunk_batches: Iterable[list[Document]]) -> Iterator[list]:
+        # Page ranges always hold whole pages, so positional IDs can be
+        # generated per range before regrouping into fixed-size batches.
+        chunks = (
+            chunk
+            for batch in chunk_batches
+            for chunk in generate_chunk_ids(batch, mode=chunk_id_mode)
+        )
+        yield from batched(chunks, batch_size)
+
+    def dedupe(chunk_batches: Iterable[list[Document]]) -> Iterator[tuple]:
+        for chunks in chunk_batches:
+            stats.chunks += len(chunks)
+            stored_ids = chroma_db.existing_ids(
+                chunk.metadata["id"] for chunk in chunks
+            )
+            new_chunks = []
+            with in_flight_lock:
+                for chunk in chunks:
+                    # Content IDs repeat across files and within a batch, so
+                    # an ID is claimed as soon as it is first seen.
+                    chunk_id = chunk.metadata["id"]
+                    if chunk_id not in stored_ids and chunk_id not in in_flight_ids:
+                        in_flight_ids.add(chunk_id)
+                        new_chunks.append(chunk)
+            yield chunks, new_chunks
+
+    def embed(chunk_batches: Iterable[tuple]) -> Iterator[tuple]:
+        for chunks, new_chunks in chunk_batches:
+            embeddings = chroma_db.embed_documents(new_chunks) if new_chunks else []
+            yield chunks, new_chunks, embeddings
+
+    def upsert(embedded_batches: Iterable[tuple]) -> Iterator[tuple]:
+        for chunks, new_chunks, embeddings in embedded_batches:
+            chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
+            if new_chunks:
+                chroma_db.upsert_embeddings(new_chunks, chunk_ids, embeddings)
+            yield chunks, chunk_ids
+
+    recorded = set()
+
+    def record_files(sources: Iterable[str], chunk_ids: dict[str, list[str]]):
+        for source in list(sources):
+            manifest.record(source, plan.records[source], chunk_ids.pop(source, []))
+            recorded.add(source)
+        # The vectors are persisted before the manifest marks their files as
+        # ingested, so a crash in between re-ingests them rather than losing
+        # them.
+        chroma_db.flush()
+        manifest.save()
+
+    page_batches = iter_documents(
+        file_paths, workers=workers, pages_per_task=pages_per_task
+    )
+    pending_ids: dict[str, list[str]] = {}
+    stages = [split, generate_ids, dedupe, embed, upsert]
+    if boilerplate is not None:
+        stages.insert(0, strip_boilerplate)
+    if metadata_extractor is not None:
+        stages.insert(0, annotate)
+    for chunks, written_ids in run_pipeline(
+        page_batches, stages, queue_size=queue_size, stage_seconds=stats.stage_seconds
+    ):
+        with in_flight_lock:
+            in_flight_ids.difference_update(written_ids)
+        if aliases is not None:
+            aliases.add(chunks)
+        if manifest is not None:
+            for chunk in chunks:
+                pending_ids.setdefault(chunk.metadata["source"], []).append(
+                    chunk.metadata["id"]
+                )
+            # Files arrive in order, so every file before the last one seen
+            # has had all of its chunks written.
+            last_source = chunks[-1].metadata["source"]
+            completed = [source for source in pending_ids if source != last_source]
+            if completed:
+                record_files(completed, pending_ids)
+        if written_ids:
+            stats.batches += 1
+            stats.new_chunks += len(written_ids)
+            logger.info(
+                f"Batch {stats.batches}: wrote {len(written_ids)} chunks "
+                f"({stats.new_chunks} new of {stats.chunks} seen)"
+            )
+
+    if manifest is not None:
+        record_files(
+            [source for source in file_paths if source not in recorded], pending_ids
+        )
+    else:
+        chroma_db.flush()
+    return stats
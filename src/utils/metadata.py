@@ -0,0 +1,207 @@
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from langchain.schema.document import Document
+
+# Canonical bank name and the patterns that name it. Acronyms are matched
+# case-sensitively so that words such as "td" inside prose do not match.
+BANK_PATTERNS = {
+    "RBC": [r"\bRBC\b", r"(?i:\broyal bank of canada\b)"],
+    "TD": [r"\bTD\b", r"(?i:\btoronto[- ]dominion\b)"],
+    "BMO": [r"\bBMO\b", r"(?i:\bbank of montreal\b)"],
+    "Scotiabank": [r"(?i:\bscotiabank\b)", r"(?i:\bbank of nova scotia\b)", r"\bBNS\b"],
+    "CIBC": [r"\bCIBC\b", r"(?i:\bcanadian imperial bank of commerce\b)"],
+    "National Bank": [r"(?i:\bnational bank\b)", r"\bNBC\b"],
+}
+DOCUMENT_TYPE_PATTERNS = {
+    "supplementary_financial_information": r"supplementa(?:ry|l) financial",
+    "report_to_shareholders": r"report to shareholders|quarterly report",
+    "earnings_release": r"earnings (?:news )?release|news release",
+    "annual_report": r"annual report",
+    "investor_presentation": r"investor presentation",
+    "regulatory_disclosure": r"pillar 3|regulatory capital disclosure",
+}
+QUARTER_WORDS = {"first": 1, "second": 2, "third": 3, "fourth": 4}
+# "Q1 2024", "Q1/24", "Q1-2024", "Q1 fiscal 2024", "first quarter of 2024",
+# "2024 Q1" and file name forms such as "q124".
+QUARTER_YEAR_PATTERNS = [
+    re.compile(r"\bq([1-4])[\s/'_-]*(?:fiscal\s+|fy\s*|f)?((?:20)?\d{2})\b", re.I),
+    re.compile(
+        r"\b(first|second|third|fourth) quarter(?: of)?(?: fiscal)?,? ((?:20)?\d{2})\b",
+        re.I,
+    ),
+    re.compile(r"\b((?:20)\d{2})[\s/_-]*q([1-4])\b", re.I),
+]
+QUARTER_PATTERN = re.compile(
+    r"\bq([1-4])\b|\b(first|second|third|fourth) quarter\b", re.I
+)
+YEAR_PATTERN = re.compile(r"\b(?:fiscal\s+)?(20\d{2})\b", re.I)
+HEADER_PAGES = 2
+
+
+def _year(text: str) -> int:
+    year = int(text)
+    return year + 2000 if year < 100 else year
+
+
+def find_quarter_years(text: str) -> list[tuple[int, int]]:
+    found = []
+    for number, pattern in enumerate(QUARTER_YEAR_PATTERNS):
+        for match in pattern.finditer(text):
+            first, second = match.groups()
+            if number == 2:
+                year, quarter = _year(first), int(second)
+            elif number == 1:
+                quarter, year = QUARTER_WORDS[first.lower()], _year(second)
+            else:
+                quarter, year = int(first), _year(second)
+            found.append((quarter, year))
+    return found
+
+
+def find_banks(text: str, ignore_case: bool = False) -> list[str]:
+    flags = re.I if ignore_case else 0
+    return [
+        bank
+        for bank, patterns in BANK_PATTERNS.items()
+        for pattern in patterns
+        for _match in re.finditer(pattern, text, flags)
+    ]
+
+
+def find_document_type(text: str) -> Optional[str]:
+    for document_type, pattern in DOCUMENT_TYPE_PATTERNS.items():
+        if re.search(pattern, text, re.I):
+            return document_type
+    return None
+
+
+def extract_document_metadata(source: str, header_text: str) -> dict:
+    """
+    Derives the bank, document type, fiscal year and quarter of a document
+    from its file name, falling back to the text of its first pages. Keys
+    that cannot be determined are left out, since Chroma metadata values
+    cannot be null.
+
+    Args:
+        source (str): The document's file path.
+        header_text (str): The text of the document's first pages.
+    """
+
+    name = os.path.splitext(os.path.basename(source))[0]
+    readable_name = re.sub(r"[_-]+", " ", name)
+    metadata = {}
+
+    # File names are often lowercase, so acronyms match in any case there.
+    banks = find_banks(readable_name, ignore_case=True) or find_banks(header_text)
+    if banks:
+        metadata["bank"] = Counter(banks).most_common(1)[0][0]
+
+    document_type = find_document_type(readable_name) or find_document_type(header_text)
+    if document_type:
+        metadata["document_type"] = document_type
+
+    periods = find_quarter_years(readable_name) or find_quarter_years(header_text)
+    if periods:
+        quarter, year = Counter(periods).most_common(1)[0][0]
+        metadata["quarter"] = quarter
+        metadata["fiscal_year"] = year
+    else:
+        years = YEAR_PATTERN.findall(readable_name) or YEAR_PATTERN.findall(header_text)
+        if years:
+            metadata["fiscal_year"] = int(Counter(years).most_common(1)[0][0])
+    return metadata
+
+
+class MetadataExtractor:
+    """
+    Adds document-level metadata to every page of each document as pages
+    stream by. Page ranges of a document arrive in order, so the first one
+    seen holds the document's first pages.
+    """
+
+    def __init__(self, header_pages: int = HEADER_PAGES):
+        self.header_pages = header_pages
+        self.documents: dict[str, dict] = {}
+
+    def annotate(self, pages: list[Document]) -> list[Document]:
+        for page in pages:
+            source = page.metadata["source"]
+            if source not in self.documents:
+                header_pages = [
+                    other.page_content
+                    for other in pages
+                    if other.metadata["source"] == source
+                ][: self.header_pages]
+                self.documents[source] = extract_document_metadata(
+                    source, "\n".join(header_pages)
+                )
+            page.metadata.update(self.documents[source])
+        return pages
+
+
+@dataclass
+class QueryFilters:
+    """
+    Metadata values a query asks about, as allowed values per field.
+    """
+
+    values: dict[str, list] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.values)
+
+    def __str__(self) -> str:
+        return ";".join(
+            f"{key}={','.join(map(str, values))}"
+            for key, values in sorted(self.values.items())
+        )
+
+    def to_where(self) -> Optional[dict]:
+        conditions = [
+            {key: values[0]} if len(values) == 1 else {key: {"$in": values}}
+            for key, values in sorted(self.values.items())
+        ]
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def matches(self, metadata: dict) -> bool:
+        return all(metadata.get(key) in values for key, values in self.values.items())
+
+
+def _unique(values: Iterable) -> list:
+    return sorted(set(values), key=str)
+
+
+def parse_query_filters(query_text: str) -> QueryFilters:
+    """
+    Turns the banks, document types, fiscal years and quarters named in a
+    query into metadata filters, so that "RBC net income Q3 2024 vs Q3
+    2023" only searches RBC chunks of the third quarters of 2023 and 2024.
+    """
+
+    values = {}
+    banks = _unique(find_banks(query_text))
+    if banks:
+        values["bank"] = banks
+    document_type = find_document_type(query_text)
+    if document_type:
+        values["document_type"] = [document_type]
+
+    periods = find_quarter_years(query_text)
+    years = [year for _quarter, year in periods] or [
+        int(year) for year in YEAR_PATTERN.findall(query_text)
+    ]
+    quarters = [quarter for quarter, _year in periods] or [
+        int(number) if number else QUARTER_WORDS[word.lower()]
+        for number, word in QUARTER_PATTERN.findall(query_text)
+    ]
+    if years:
+        values["fiscal_year"] = _unique(years)
+    if quarters:
+        values["quarter"] = _unique(quarters)
+    return QueryFilters(values)
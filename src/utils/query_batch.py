@@ -0,0 +1,400 @@
+import fcntl
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
+from typing import IO, Callable, ContextManager, Iterable, Optional
+
+from loguru import logger
+
+from models.query_cache import normalize_query
+from models.query_model import BATCH_WRITE_SIZE, QueryModel
+from models.rag import QueryResponse
+from models.rag_engine import PreparedQuery, RagEngine, RetrievalMode
+from utils.ingestion import batched
+
+BATCH_CONCURRENCY = 8
+RETRIEVAL_BATCH_SIZE = 32
+
+
+@dataclass
+class QueryBatchStats:
+    questions: int = 0
+    duplicates: int = 0
+    resumed: int = 0
+    answered: int = 0
+    cached: int = 0
+    failed: int = 0
+    stored: int = 0
+    retrieval_batches: int = 0
+    retrieval_seconds: float = 0.0
+    seconds: float = 0.0
+    questions_per_minute: float = 0.0
+    finished: bool = False
+    error: Optional[str] = None
+
+
+class BatchRunning(Exception):
+    """
+    Raised when another batch, in this process or another one, is writing
+    to the same output.
+    """
+
+
+class BatchLock:
+    """
+    Exclusive lock on the batch writing to `output_path`, held on an open
+    `<output>.lock` file with flock, so it is shared by every process on
+    the host and released by the system if the process holding it dies.
+    It may be released from another thread than the one that acquired it.
+    """
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.path = f"{output_path}.lock"
+        self._file: Optional[IO[str]] = None
+
+    def acquire(self):
+        """
+        Takes the lock, or raises `BatchRunning` if it is held.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            raise BatchRunning(f"A batch is already writing to {self.output_path}")
+        self._file = file
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def held(self) -> bool:
+        """
+        Returns whether a batch holds the lock.
+        """
+
+        try:
+            file = open(self.path)
+        except FileNotFoundError:
+            return False
+        with file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+
+    def __enter__(self) -> "BatchLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def batch_status_path(output_path: str) -> str:
+    return f"{output_path}.status.json"
+
+
+def write_batch_status(output_path: str, stats: QueryBatchStats):
+    # Written by the batch holding the lock only, and replaced at once so
+    # readers never see a partial file.
+    path = batch_status_path(output_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(stats), f)
+    os.replace(tmp_path, path)
+
+
+def read_batch_status(output_path: str) -> Optional[QueryBatchStats]:
+    """
+    Returns the progress last written by the batch writing to
+    `output_path`, or None if no batch has written there.
+    """
+
+    try:
+        with open(batch_status_path(output_path)) as f:
+            return QueryBatchStats(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def read_questions(lines: Iterable[str]) -> list[str]:
+    """
+    Returns the questions of JSONL `lines`, each a JSON string or an object
+    with a `query_text`, as sent to `/submit_query`.
+    """
+
+    questions = []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            question = record if isinstance(record, str) else record["query_text"]
+        except (ValueError, TypeError, KeyError) as error:
+            raise ValueError(f"Line {number} is not a question: {error}") from error
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError(f"Line {number} is not a question: {question!r}")
+        questions.append(question)
+    return questions
+
+
+def answered_questions(output_path: str) -> set[str]:
+    """
+    Returns the normalized questions answered without error in the results
+    at `output_path`, truncating a last line left incomplete by an
+    interrupted run.
+    """
+
+    answered: set[str] = set()
+    if not os.path.exists(output_path):
+        return answered
+    with open(output_path, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            record = json.loads(line)
+            if record.get("error") is None:
+                answered.add(normalize_query(record["query_text"]))
+        f.truncate(end)
+    return answered
+
+
+def pending_questions(
+    questions: list[str], output_path: str, stats: QueryBatchStats
+) -> list[str]:
+    """
+    Returns `questions` without repeats, compared as the query cache
+    compares them, and without those already answered at `output_path`.
+    """
+
+    unique: dict[str, str] = {}
+    for question in questions:
+        unique.setdefault(normalize_query(question), question)
+    answered = answered_questions(output_path)
+    pending = [question for key, question in unique.items() if key not in answered]
+    stats.questions = len(questions)
+    stats.duplicates = len(questions) - len(unique)
+    stats.resumed = len(unique) - len(pending)
+    return pending
+
+
+class _ResultWriter:
+    # Results are appended to the output only once they are stored, so the
+    # output alone tells a resumed run what is done. The status is written
+    # after them.
+    def __init__(
+        self,
+        output: IO[str],
+        output_path: str,
+        store: bool,
+        stats: QueryBatchStats,
+        started: float,
+    ):
+        self.output = output
+        self.output_path = output_path
+        self.store = store
+        self.stats = stats
+        self.started = started
+        self.unsaved: list[QueryModel] = []
+
+    def answered(self, query: QueryModel, response: QueryResponse):
+        query.answer_text = response.response_text
+        query.sources = response.sources
+        query.cached = response.cached
+        query.is_complete = True
+        self.stats.answered += 1
+        self.stats.cached += response.cached
+        self._add(query)
+
+    def failed(self, query: QueryModel, error: BaseException):
+        # Failures are only reported: a question left out of the output is
+        # retried by the next run, which would otherwise append another
+        # record for it.
+        logger.warning(f"Query {query.query_text!r} failed: {error}")
+        self.stats.failed += 1
+        self._update_rate()
+
+    def _add(self, query: QueryModel):
+        self.unsaved.append(query)
+        if not self.store or len(self.unsaved) >= BATCH_WRITE_SIZE:
+            self.flush()
+        self._update_rate()
+
+    def _update_rate(self):
+        seconds = time.perf_counter() - self.started
+        self.stats.seconds = seconds
+        self.stats.questions_per_minute = 60 * self.stats.answered / seconds
+
+    def flush(self):
+        if not self.unsaved:
+            return
+        if self.store:
+            QueryModel.batch_put_items(self.unsaved)
+            self.stats.stored += len(self.unsaved)
+        self.output.write(
+            "".join(json.dumps(query.dict()) + "\n" for query in self.unsaved)
+        )
+        self.output.flush()
+        self.unsaved.clear()
+        write_batch_status(self.output_path, self.stats)
+
+
+def _retrieve_batch(
+    rag_engine: RagEngine,
+    queries: list[QueryModel],
+    pool: ThreadPoolExecutor,
+    writer: _ResultWriter,
+    bypass_cache: bool,
+    mode: Optional[RetrievalMode],
+    query_slot: Callable[[], ContextManager],
+) -> list[tuple[QueryModel, QueryResponse]]:
+    def in_slot(function: Callable, *args):
+        with query_slot():
+            return function(*args)
+
+    # All embeddings are awaited before any search starts, so the searches
+    # reach the engine together. Each call takes a slot of its own.
+    embedding_futures = [
+        pool.submit(in_slot, rag_engine.embed_query, query.query_text)
+        for query in queries
+    ]
+    wait(embedding_futures)
+    preparing: dict[Future, QueryModel] = {}
+    for query, future in zip(queries, embedding_futures):
+        if future.exception() is not None:
+            writer.failed(query, future.exception())
+            continue
+        preparing[
+            pool.submit(
+                in_slot,
+                rag_engine.prepare,
+                query.query_text,
+                bypass_cache,
+                mode,
+                future.result(),
+            )
+        ] = query
+    wait(preparing)
+    prepared = []
+    for future, query in preparing.items():
+        if future.exception() is not None:
+            writer.failed(query, future.exception())
+            continue
+        cached, prepared_query = future.result()
+        if cached is not None:
+            writer.answered(query, cached)
+        else:
+            prepared.append((query, prepared_query))
+    return prepared
+
+
+def answer_questions(
+    rag_engine: RagEngine,
+    questions: list[str],
+    output_path: str,
+    concurrency: int = BATCH_CONCURRENCY,
+    batch_size: int = RETRIEVAL_BATCH_SIZE,
+    store: bool = True,
+    bypass_cache: bool = False,
+    mode: Optional[RetrievalMode] = None,
+    stats: Optional[QueryBatchStats] = None,
+    query_slot: Callable[[], ContextManager] = nullcontext,
+) -> QueryBatchStats:
+    """
+    Answers `questions`, as returned by `pending_questions`, and appends
+    each one, as the stored `QueryModel`, to the JSONL file at
+    `output_path`, so an interrupted run resumes where it stopped. With
+    `store`, results are written to DynamoDB with BatchWriteItem first.
+
+    Retrieval runs `batch_size` questions at a time: they are embedded
+    concurrently, then their searches are started together, so an engine
+    with micro-batching runs them as one batched search. Answers are
+    generated by `concurrency` chat model calls at once, which overlap the
+    retrieval of the next batch. Questions that fail are counted and
+    logged but not written, so the next run retries them.
+
+    Each embedding, search and answer runs within a `query_slot` of its
+    own, which lets a caller share a concurrency limit with other queries. The
+    progress is written to `<output>.status.json` with the results, and
+    once more when the batch finishes. The caller should hold the
+    `BatchLock` of `output_path`.
+    """
+
+    stats = stats or QueryBatchStats()
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    def answer(prepared_query: PreparedQuery) -> QueryResponse:
+        with query_slot():
+            return rag_engine.answer(prepared_query)
+
+    try:
+        with (
+            open(output_path, "a") as output,
+            ThreadPoolExecutor(
+                max_workers=batch_size, thread_name_prefix="batch-retrieval"
+            ) as retrieval_pool,
+            ThreadPoolExecutor(
+                max_workers=concurrency, thread_name_prefix="batch-answer"
+            ) as answer_pool,
+        ):
+            writer = _ResultWriter(output, output_path, store, stats, started)
+            answering: dict[Future, QueryModel] = {}
+
+            def collect(done: Iterable[Future]):
+                for future in done:
+                    query = answering.pop(future)
+                    if future.exception() is not None:
+                        writer.failed(query, future.exception())
+                    else:
+                        writer.answered(query, future.result())
+
+            try:
+                for batch in batched(questions, batch_size):
+                    retrieval_started = time.perf_counter()
+                    prepared = _retrieve_batch(
+                        rag_engine,
+                        [QueryModel(query_text=question) for question in batch],
+                        retrieval_pool,
+                        writer,
+                        bypass_cache,
+                        mode,
+                        query_slot,
+                    )
+                    stats.retrieval_batches += 1
+                    stats.retrieval_seconds += time.perf_counter() - retrieval_started
+                    for query, prepared_query in prepared:
+                        answering[answer_pool.submit(answer, prepared_query)] = query
+                    collect([future for future in answering if future.done()])
+                    # The next batch is retrieved once the chat model has fewer
+                    # calls queued than it runs at once.
+                    while len(answering) > concurrency:
+                        done, _pending = wait(answering, return_when=FIRST_COMPLETED)
+                        collect(done)
+                collect(wait(answering).done)
+                writer.flush()
+            except BaseException:
+                for future in answering:
+                    future.cancel()
+                raise
+    except BaseException as error:
+        stats.error = str(error) or type(error).__name__
+        raise
+    finally:
+        stats.seconds = time.perf_counter() - started
+        if stats.seconds:
+            stats.questions_per_minute = 60 * stats.answered / stats.seconds
+        stats.finished = True
+        write_batch_status(output_path, stats)
+    return stats
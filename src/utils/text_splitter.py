@@ -0,0 +1,171 @@
+import re
+from typing import Callable, Iterator
+
+from langchain.schema.document import Document
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+NON_ASCII_PATTERN = re.compile(r"[^\x00-\x7f]+")
+
+
+def token_class(char: str) -> str:
+    """
+    Returns "a" for a word character of `TOKEN_PATTERN`, "." for a
+    character that is a token by itself and " " for whitespace, keeping
+    newlines.
+    """
+
+    if char == "\n":
+        return char
+    if re.fullmatch(r"\s", char):
+        return " "
+    return "a" if re.fullmatch(r"\w", char) else "."
+
+
+ASCII_TOKEN_CLASSES = str.maketrans(
+    {chr(code): token_class(chr(code)) for code in range(128)}
+)
+
+
+def _mark_non_ascii(match: re.Match) -> str:
+    return "".join(token_class(char) for char in match.group())
+
+
+def mark_tokens(text: str) -> str:
+    # Replacing every character by its class keeps offsets and lines, and
+    # str.translate runs as a C loop over ASCII text, several times faster
+    # than matching TOKEN_PATTERN. The rare non-ASCII runs are classified
+    # first.
+    if not text.isascii():
+        text = NON_ASCII_PATTERN.sub(_mark_non_ascii, text)
+    return text.translate(ASCII_TOKEN_CLASSES)
+
+
+def _count_marked(marked: str) -> int:
+    return marked.count(".") + len(marked.replace(".", " ").split())
+
+
+def count_tokens(text: str) -> int:
+    """
+    Returns the number of `TOKEN_PATTERN` matches in `text`.
+    """
+
+    return _count_marked(mark_tokens(text))
+
+
+def line_token_counts(text: str) -> list[int]:
+    # The page is marked once, then each line is counted.
+    return [_count_marked(line) for line in mark_tokens(text).split("\n")]
+
+
+class RegexTokenSplitter:
+    """
+    Counts the tokens of every line of a page in a single pass, then
+    packs consecutive lines into chunks of at most `chunk_size` tokens,
+    repeating up to `chunk_overlap` tokens of trailing lines at the start of
+    the next chunk. Lines longer than `chunk_size` are cut on word
+    boundaries.
+
+    Args:
+        chunk_size (int): Maximum chunk length in tokens.
+        chunk_overlap (int): Target overlap between chunks in tokens.
+        length_function (Callable[[str], int]): Token counter. The default
+            tokenizer is counted per page instead of per line.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int,
+        chunk_overlap: int,
+        length_function: Callable[[str], int] = count_tokens,
+    ):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(
+                f"chunk_overlap ({chunk_overlap}) must be smaller than "
+                f"chunk_size ({chunk_size})"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
+
+    def _split_long_line(self, text: str) -> Iterator[str]:
+        # Windows are packed from the token count of each word, so none
+        # exceeds chunk_size however many tokens a word holds. A word that
+        # is longer than a chunk by itself is cut into its tokens.
+        marked = mark_tokens(text) if self.length_function is count_tokens else None
+        words = []
+        for match in re.finditer(r"\S+", text):
+            start, end = match.span()
+            if marked is None:
+                tokens = self.length_function(match.group())
+            else:
+                tokens = _count_marked(marked[start:end])
+            if tokens > self.chunk_size:
+                words.extend(
+                    (start + token.start(), start + token.end(), 1)
+                    for token in TOKEN_PATTERN.finditer(match.group())
+                )
+            else:
+                words.append((start, end, tokens))
+
+        i = 0
+        while i < len(words):
+            j, total = i, 0
+            while j < len(words) and total + words[j][2] <= self.chunk_size:
+                total += words[j][2]
+                j += 1
+            yield text[words[i][0] : words[j - 1][1]]
+            if j == len(words):
+                return
+
+            k, overlap = j, 0
+            while k - 1 > i and overlap + words[k - 1][2] <= self.chunk_overlap:
+                k -= 1
+                overlap += words[k][2]
+            i = k
+
+    def split_text(self, text: str) -> list[str]:
+        lines = text.split("\n")
+        if self.length_function is count_tokens:
+            counts = line_token_counts(text)
+        else:
+            counts = [self.length_function(line) for line in lines]
+        segments = []
+        start = 0
+        for line, tokens in zip(lines, counts):
+            if tokens:
+                segments.append((start, start + len(line), tokens))
+            start += len(line) + 1
+
+        chunks = []
+        i = 0
+        while i < len(segments):
+            start, end, tokens = segments[i]
+            if tokens > self.chunk_size:
+                chunks.extend(self._split_long_line(text[start:end]))
+                i += 1
+                continue
+
+            j, total = i, 0
+            while j < len(segments) and total + segments[j][2] <= self.chunk_size:
+                total += segments[j][2]
+                j += 1
+            chunks.append(text[start : segments[j - 1][1]].strip())
+            if j == len(segments):
+                break
+            if segments[j][2] > self.chunk_size:
+                i = j
+                continue
+
+            k, overlap = j, 0
+            while k - 1 > i and overlap + segments[k - 1][2] <= self.chunk_overlap:
+                k -= 1
+                overlap += segments[k][2]
+            i = k
+        return chunks
+
+    def split_documents(self, documents: list[Document]) -> list[Document]:
+        return [
+            Document(page_content=chunk, metadata=dict(document.metadata))
+            for document in documents
+            for chunk in self.split_text(document.page_content)
+        ]